@@ -0,0 +1,317 @@
+""" Pooled guest agent client over the virtio "agent" channels.
+
+Enabled with AGENT_POOL. The leader worker process of the host keeps
+one persistent connection per guest to /var/lib/libvirt/serial/vio-<name>
+(opened on first use), all served by one multiplexer thread. The other
+worker processes send their requests through the local control socket
+RUN_DIR/agent.sock, so requests of every process share the guest
+connections.
+
+Both sockets carry newline delimited JSON. Requests get an id and are
+pipelined; replies are matched by id, so many requests to many guests
+can be in flight at once. Each request has its own timeout.
+
+AGENT_PROTOCOL selects the guest side message format:
+qemu-ga     {"execute": command, "arguments": {...}, "id": id}
+            -> {"return": result, "id": id} or {"error": {...}, "id": id}
+circle      {"command": command, "args": {...}, "uuid": id}
+            -> {"response": result, "uuid": id} or {"error": ..., ...}
+
+As with the serial console, QEMU serves one client per channel socket,
+so the pool does not coexist with other agent clients of the guests.
+
+"""
+import itertools
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+import hostlock
+import warmpool
+from mux import Multiplexer
+
+enabled = os.getenv('AGENT_POOL', 'False').lower() in (
+    "true", "yes", "y", "t")
+AGENT_PROTOCOL = os.getenv('AGENT_PROTOCOL', 'qemu-ga')
+AGENT_TIMEOUT = float(os.getenv('AGENT_TIMEOUT', '5'))
+AGENT_SOCKET = '/var/lib/libvirt/serial/vio-%s'
+REAP_INTERVAL = 0.1
+MAX_LINE = 1048576
+
+# Batch query name -> guest agent command (qemu-ga)
+QUERIES = {'ping': 'guest-ping',
+           'filesystems': 'guest-get-fsinfo',
+           'addresses': 'guest-network-get-interfaces',
+           'os': 'guest-get-osinfo',
+           'users': 'guest-get-users',
+           'time': 'guest-get-time'}
+
+
+def encode(command, arguments, request_id, protocol=AGENT_PROTOCOL):
+    """ Return the guest request line. """
+    if protocol == 'circle':
+        message = {'command': command, 'args': arguments or {},
+                   'uuid': request_id}
+    else:
+        message = {'execute': command, 'id': request_id}
+        if arguments:
+            message['arguments'] = arguments
+    return (json.dumps(message) + '\n').encode('utf-8')
+
+
+def decode(message, protocol=AGENT_PROTOCOL):
+    """ Return (request id, result, error) of a guest reply. """
+    if protocol == 'circle':
+        return (message.get('uuid'), message.get('response'),
+                message.get('error'))
+    error = message.get('error')
+    if isinstance(error, dict):
+        error = error.get('desc') or error.get('class')
+    return message.get('id'), message.get('return'), error
+
+
+class Lines(object):
+
+    """ Split a byte stream into JSON messages. """
+
+    def __init__(self):
+        self.buffer = b''
+
+    def feed(self, data):
+        """ Return the complete messages received so far. """
+        self.buffer += data
+        lines = self.buffer.split(b'\n')
+        self.buffer = lines.pop()
+        if len(self.buffer) > MAX_LINE:
+            logging.warning("Dropped agent line longer than %d", MAX_LINE)
+            self.buffer = b''
+        messages = []
+        for line in lines:
+            # qemu-ga may send 0xff sync bytes
+            line = line.strip(b'\r\xff ')
+            if not line:
+                continue
+            try:
+                messages.append(json.loads(line.decode('utf-8')))
+            except ValueError:
+                logging.debug("Dropped non JSON agent line: %r", line)
+        return messages
+
+
+class AgentPool(object):
+
+    """ Guest connections and control socket of the leader. """
+
+    def __init__(self):
+        self.mux = Multiplexer('guest-agent')
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.guests = {}
+        self.streams = {}
+        self.pending = {}
+
+    def _reply(self, client, request_id, result=None, error=None):
+        line = json.dumps({'id': request_id, 'result': result,
+                           'error': error}) + '\n'
+        try:
+            self.mux.send(client, line.encode('utf-8'))
+        except socket.error:
+            pass  # Client gone
+
+    def _guest(self, name):
+        """ Return the socket of guest name (connected without blocking). """
+        sock = self.guests.get(name)
+        if sock is None:
+            sock = self.mux.connect_unix(
+                AGENT_SOCKET % warmpool.resolve(name),
+                self._on_guest_data, self._on_guest_close)
+            self.streams[sock.fileno()] = (name, Lines())
+            self.guests[name] = sock
+            logging.info("Guest agent of %s connected", name)
+        return sock
+
+    def _on_guest_data(self, sock, data):
+        name, lines = self.streams.get(sock.fileno(), (None, None))
+        if lines is None:
+            return
+        for message in lines.feed(data):
+            guest_id, result, error = decode(message)
+            with self.lock:
+                entry = self.pending.pop(guest_id, None)
+            if entry is not None:
+                self._reply(entry[0], entry[1], result, error)
+
+    def _on_guest_close(self, sock):
+        name, lines = self.streams.pop(sock.fileno(), (None, None))
+        with self.lock:
+            if self.guests.get(name) is sock:
+                del self.guests[name]
+            failed = [(gid, e) for gid, e in self.pending.items()
+                      if e[2] == name]
+            for guest_id, entry in failed:
+                del self.pending[guest_id]
+        for guest_id, entry in failed:
+            self._reply(entry[0], entry[1], error='agent disconnected')
+        logging.info("Guest agent of %s disconnected", name)
+
+    def _on_client(self, client):
+        lines = Lines()
+        self.mux.add(client,
+                     lambda sock, data: self._on_request(sock, lines, data),
+                     lambda sock: None)
+
+    def _on_request(self, client, lines, data):
+        for request in lines.feed(data):
+            name = request.get('name')
+            guest_id = next(self.ids)
+            timeout = request.get('timeout') or AGENT_TIMEOUT
+            try:
+                sock = self._guest(name)
+                with self.lock:
+                    self.pending[guest_id] = (client, request.get('id'),
+                                              name, time.time() + timeout)
+                self.mux.send(sock, encode(request.get('command'),
+                                           request.get('arguments'),
+                                           guest_id))
+            except (socket.error, IOError, OSError) as e:
+                with self.lock:
+                    self.pending.pop(guest_id, None)
+                self._reply(client, request.get('id'),
+                            error='agent not available: %s' % e)
+
+    def reap(self):
+        """ Answer the timed out requests. """
+        now = time.time()
+        with self.lock:
+            expired = [(gid, e) for gid, e in self.pending.items()
+                       if e[3] < now]
+            for guest_id, entry in expired:
+                del self.pending[guest_id]
+        for guest_id, entry in expired:
+            self._reply(entry[0], entry[1], error='timeout')
+
+    def serve(self, path):
+        self.mux.listen_unix(path, self._on_client)
+        self.mux.start()
+        while True:
+            time.sleep(REAP_INTERVAL)
+            try:
+                self.reap()
+            except Exception:
+                logging.exception("Guest agent reaper failed")
+
+
+class PoolClosed(Exception):
+
+    """ The control connection was closed before any reply. """
+
+
+class Client(object):
+
+    """ Control socket client of a worker process. """
+
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.lines = Lines()
+        self.ids = itertools.count(1)
+
+    def batch(self, requests, timeout=AGENT_TIMEOUT):
+        """ Send requests (name, command, arguments) at once.
+
+        Return the list of (result, error) in request order.
+
+        """
+        ids = {}
+        data = []
+        for index, (name, command, arguments) in enumerate(requests):
+            request_id = next(self.ids)
+            ids[request_id] = index
+            data.append(json.dumps({'id': request_id, 'name': name,
+                                    'command': command,
+                                    'arguments': arguments,
+                                    'timeout': timeout}))
+        if data:
+            try:
+                self.sock.sendall(('\n'.join(data) + '\n').encode('utf-8'))
+            except socket.error as e:
+                raise PoolClosed(str(e))
+        replies = [(None, 'timeout')] * len(requests)
+        # The leader answers every request within timeout
+        deadline = time.time() + timeout + 1
+        while ids:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise socket.timeout("Guest agent pool not responding")
+            self.sock.settimeout(remaining)
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                if len(ids) == len(requests):
+                    raise PoolClosed("Guest agent pool closed the "
+                                     "connection")
+                raise socket.error("Guest agent pool closed the connection")
+            for reply in self.lines.feed(chunk):
+                index = ids.pop(reply.get('id'), None)
+                if index is not None:
+                    replies[index] = (reply.get('result'),
+                                      reply.get('error'))
+        return replies
+
+
+_client = {'pid': None, 'client': None}
+_client_lock = threading.Lock()
+
+
+def batch(requests, timeout=AGENT_TIMEOUT):
+    """ Run (name, command, arguments) requests through the pool.
+
+    Return the list of (result, error) in request order.
+
+    """
+    if not enabled:
+        raise Exception("Guest agent pool is disabled (AGENT_POOL)")
+    with _client_lock:
+        if _client['pid'] != os.getpid():
+            _client['client'] = None
+        for attempt in (1, 2):
+            if _client['client'] is None:
+                _client['client'] = Client(hostlock.path('agent.sock'))
+                _client['pid'] = os.getpid()
+            try:
+                return _client['client'].batch(requests, timeout)
+            except PoolClosed:
+                # Leader restarted, nothing was answered: send again
+                _client['client'].sock.close()
+                _client['client'] = None
+                if attempt == 2:
+                    raise
+            except socket.error:
+                _client['client'].sock.close()
+                _client['client'] = None
+                raise
+
+
+def _run():
+    while not hostlock.leader('agent'):
+        time.sleep(10)
+    logging.info("Guest agent pool serving %s", hostlock.path('agent.sock'))
+    AgentPool().serve(hostlock.path('agent.sock'))
+
+
+def start(**kw):
+    """ Start the pool thread of this process. """
+    thread = threading.Thread(target=_run, name='guest-agent')
+    thread.daemon = True
+    thread.start()
+
+
+def install(app):
+    """ Run the agent pool in the worker pool processes (one leads). """
+    if not enabled:
+        return
+    from celery.signals import worker_process_init
+    worker_process_init.connect(start, weak=False,
+                                dispatch_uid='agent_process_init')
@@ -0,0 +1,263 @@
+""" asyncio facade over libvirt (Python 3 with libvirtaio).
+
+The blocking libvirt calls run on a bounded thread pool sharing one
+connection, while libvirt events are dispatched by the asyncio loop
+through libvirtaio. Domains are built from the same descriptors as the
+vmdriver tasks (see vm.py) and the create, migrate and device steps are
+shared with them (see domainops.py), but the celery task module is not
+imported, so this works without a broker and on Python versions celery
+3.1 does not support. The driver covers the domain lifecycle, save and
+restore, migration and disk and network hotplug; NUMA placement,
+admission control and the warm pool of the create task are not
+applied. Example:
+
+    driver = AsyncDriver()
+    await driver.open()
+    await driver.create(vm_desc)
+    await driver.resume(name)
+    await driver.shutdown(name)   # resolves on the STOPPED event
+    await driver.close()
+
+"""
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import libvirt
+import libvirtaio
+
+import domainops
+import metrics
+import warmpool
+from vm import VMDisk, VMInstance
+
+STATES = {0: 'NOSTATE', 1: 'RUNNING', 2: 'BLOCKED', 3: 'PAUSED',
+          4: 'SHUTDOWN', 5: 'SHUTOFF', 6: 'CRASHED', 7: 'PMSUSPENDED'}
+
+# Domain methods mirrored as coroutines taking the VM name
+DOMAIN_CALLS = {'start': 'create', 'suspend': 'suspend',
+                'resume': 'resume', 'reset': 'reset', 'reboot': 'reboot',
+                'destroy': 'destroy'}
+
+
+class AsyncDriver(object):
+
+    """ Drive many concurrent operations from one asyncio process. """
+
+    def __init__(self, uri=None, max_workers=32, loop=None):
+        self.uri = uri or os.getenv('LIBVIRT_URI', 'qemu:///system')
+        self.loop = loop or asyncio.get_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.connection = None
+        self.callback_ids = []
+        self.waiters = {}
+        self.queues = []
+
+    async def run(self, function, *args, **kw):
+        """ Run a blocking call on the executor. """
+        return await self.loop.run_in_executor(
+            self.executor, functools.partial(function, *args, **kw))
+
+    async def open(self):
+        """ Connect to libvirt and subscribe to the domain events. """
+        libvirtaio.virEventRegisterAsyncIOImpl(loop=self.loop)
+        self.connection = metrics.instrument(
+            await self.run(libvirt.open, self.uri))
+        for event_id, callback in (
+                (libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._on_lifecycle),
+                (libvirt.VIR_DOMAIN_EVENT_ID_JOB_COMPLETED,
+                 self._on_job_completed),
+                (libvirt.VIR_DOMAIN_EVENT_ID_BLOCK_JOB_2,
+                 self._on_block_job)):
+            self.callback_ids.append(self.connection.domainEventRegisterAny(
+                None, event_id, callback, None))
+        return self
+
+    async def close(self):
+        for callback_id in self.callback_ids:
+            self.connection.domainEventDeregisterAny(callback_id)
+        self.callback_ids = []
+        await self.run(self.connection.close)
+        self.executor.shutdown(wait=False)
+
+    def _name(self, dom):
+        return warmpool.alias_of(dom.name()) or dom.name()
+
+    def _publish(self, event):
+        for queue in self.queues:
+            queue.put_nowait(event)
+        for key in ((event['name'], event['type'], event.get('event')),
+                    (event['name'], event['type'], None)):
+            for future in self.waiters.pop(key, []):
+                if not future.done():
+                    future.set_result(event)
+
+    def _on_lifecycle(self, conn, dom, event, detail, opaque):
+        self._publish({'name': self._name(dom), 'type': 'lifecycle',
+                       'event': event, 'detail': detail})
+
+    def _on_job_completed(self, conn, dom, params, opaque):
+        self._publish({'name': self._name(dom), 'type': 'job',
+                       'event': None, 'stats': params})
+
+    def _on_block_job(self, conn, dom, disk, job_type, status, opaque):
+        self._publish({'name': self._name(dom), 'type': 'block_job',
+                       'event': status, 'disk': disk, 'job': job_type})
+
+    def wait_for(self, name, event_type='lifecycle', event=None,
+                 timeout=None):
+        """ Return an awaitable resolved by the next matching event.
+
+        The waiter is registered at once, so events of calls made
+        before awaiting it are not missed.
+
+        """
+        key = (name, event_type, event)
+        future = self.loop.create_future()
+        self.waiters.setdefault(key, []).append(future)
+        return self.loop.create_task(self._wait(key, future, timeout))
+
+    async def _wait(self, key, future, timeout):
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            waiters = self.waiters.get(key, [])
+            if future in waiters:
+                waiters.remove(future)
+            if not waiters:
+                self.waiters.pop(key, None)
+
+    async def events(self):
+        """ Iterate over every domain event as dict. """
+        queue = asyncio.Queue()
+        self.queues.append(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self.queues.remove(queue)
+
+    async def lookup(self, name):
+        """ Return the domain of the VM called name. """
+        return await self.run(self.connection.lookupByName,
+                              warmpool.resolve(name))
+
+    async def create(self, vm_desc):
+        """ Create a paused domain from a vmdriver descriptor.
+
+        Return the domain xml.
+
+        """
+        timer = metrics.PhaseTimer('create_phase_duration_seconds')
+        vm = VMInstance.deserialize(dict(vm_desc))
+        domainops.prepare(vm)
+        # lxml returns bytes, libvirt wants text
+        xml = vm.dump_xml().decode('utf-8')
+        await self.run(domainops.create_paused, self.connection, xml,
+                       vm.vm_type, timer)
+        with timer.phase('context'):
+            await self.run(domainops.notify_context, vm.boot_token, vm.name)
+        timer.result()
+        return xml
+
+    async def delete(self, name):
+        """ Destroy the VM called name. """
+        await self.destroy(name)
+        warmpool.release(name)
+
+    async def list_domains(self):
+        """ Return the names of the running VMs. """
+        domains = await self.run(self.connection.listAllDomains,
+                                 libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
+        names = [warmpool.alias_of(dom.name()) for dom in domains]
+        return [name for name in names if name is not None]
+
+    async def domain_info(self, name):
+        """ Return the info dict of the VM like vmdriver.domain_info. """
+        domain = await self.lookup(name)
+        info = dict(zip(['state', 'maxmem', 'memory', 'virtcpunum',
+                         'cputime'], await self.run(domain.info)))
+        info['state'] = STATES[info['state']]
+        return info
+
+    async def shutdown(self, name, timeout=120):
+        """ ACPI shutdown, resolved when the domain has stopped. """
+        stopped = self.wait_for(name, 'lifecycle',
+                                libvirt.VIR_DOMAIN_EVENT_STOPPED, timeout)
+        try:
+            domain = await self.lookup(name)
+            await self.run(domain.shutdown)
+        except Exception:
+            stopped.cancel()
+            raise
+        return await stopped
+
+    async def save(self, name, path):
+        """ Stop the VM and save its memory to path. """
+        domain = await self.lookup(name)
+        await self.run(domain.save, path)
+
+    async def restore(self, name, path):
+        """ Restore the VM saved to path, return its info dict. """
+        await self.run(self.connection.restore, path)
+        return await self.domain_info(name)
+
+    async def migrate(self, name, host, live=False, bandwidth=0,
+                      timeout=None):
+        """ Migrate the VM to host like vmdriver.migrate.
+
+        bandwidth is in MiB/s. Resolved by the job completed event of
+        the migration, return its statistics.
+
+        """
+        completed = self.wait_for(name, 'job', None, timeout)
+        try:
+            domain = await self.lookup(name)
+            await self.run(domainops.migrate, domain, name, host, live,
+                           bandwidth)
+        except Exception:
+            completed.cancel()
+            raise
+        event = await completed
+        # The disk overlays are on the datastore, they go with the VM
+        warmpool.forget(name)
+        return event['stats']
+
+    async def attach_disk(self, name, disk):
+        """ Attach the disk descriptor to the running VM. """
+        domain = await self.lookup(name)
+        xml = VMDisk.deserialize(disk).dump_xml().decode('utf-8')
+        await self.run(domain.attachDevice, xml)
+
+    async def detach_disk(self, name, disk):
+        """ Detach the disk descriptor from the running VM. """
+        domain = await self.lookup(name)
+        disk = VMDisk.deserialize(disk)
+        await self.run(domain.detachDevice, disk.dump_xml().decode('utf-8'))
+        await self.run(domainops.check_detached, domain, disk.source)
+
+    async def attach_network(self, name, net):
+        """ Attach the network descriptor to the running VM. """
+        domain = await self.lookup(name)
+        xml = await self.run(domainops.network_xml, domain, net)
+        await self.run(domain.attachDevice, xml.decode('utf-8'))
+
+    async def detach_network(self, name, net):
+        """ Detach the network descriptor from the running VM. """
+        domain = await self.lookup(name)
+        xml = await self.run(domainops.network_xml, domain, net)
+        await self.run(domain.detachDevice, xml.decode('utf-8'))
+
+
+def _domain_call(method):
+
+    async def call(self, name, *args):
+        domain = await self.lookup(name)
+        return await self.run(getattr(domain, method), *args)
+    call.__doc__ = """ Call virDomain.%s of the VM called name. """ % method
+    return call
+
+
+for _name, _method in DOMAIN_CALLS.items():
+    setattr(AsyncDriver, _name, _domain_call(_method))
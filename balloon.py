@@ -0,0 +1,277 @@
+""" Memory balloon controller.
+
+Enabled with BALLOON_CONTROL. Every BALLOON_INTERVAL seconds the leader
+worker process of the host reads the balloon statistics of all running
+domains with one getAllDomainStats call and computes a target size per
+guest: the memory it uses plus BALLOON_HEADROOM, never below its floor
+and never above its maximum. The floor is the memory_min of the domain
+(balloon metadata, see VMInstance) or BALLOON_FLOOR_RATIO of the
+maximum, at least BALLOON_MIN_FLOOR.
+
+Guests that need memory are grown at once, but while the host is under
+memory pressure (available memory below BALLOON_PRESSURE of the total)
+all guests together grow by at most BALLOON_STEP per round, the most
+undersized ones first. Guests are shrunk only under pressure, the most
+oversized ones first, by at most BALLOON_STEP per round, and only until
+the pressure is relieved. Changes smaller than BALLOON_HYSTERESIS of
+the current size and guests changed within BALLOON_COOLDOWN seconds are
+left alone.
+
+Domains backed by hugepages, locked or memfd memory are not ballooned:
+the memory returned by the guest is not given back to the host.
+
+Every change is logged and appended as JSON line to BALLOON_AUDIT_LOG.
+Memory is in KiB.
+
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+import libvirt
+import lxml.etree as ET
+from psutil import virtual_memory
+
+import hostlock
+import warmpool
+from vm import BALLOON_NS
+
+enabled = os.getenv('BALLOON_CONTROL', 'False').lower() in (
+    "true", "yes", "y", "t")
+BALLOON_INTERVAL = int(os.getenv('BALLOON_INTERVAL', '10'))
+BALLOON_STATS_PERIOD = int(os.getenv('BALLOON_STATS_PERIOD', '5'))
+BALLOON_HEADROOM = float(os.getenv('BALLOON_HEADROOM', '0.25'))
+BALLOON_FLOOR_RATIO = float(os.getenv('BALLOON_FLOOR_RATIO', '0.25'))
+BALLOON_MIN_FLOOR = int(os.getenv('BALLOON_MIN_FLOOR', '262144'))
+BALLOON_PRESSURE = float(os.getenv('BALLOON_PRESSURE', '0.15'))
+BALLOON_STEP = int(os.getenv('BALLOON_STEP', '262144'))
+BALLOON_HYSTERESIS = float(os.getenv('BALLOON_HYSTERESIS', '0.1'))
+BALLOON_COOLDOWN = int(os.getenv('BALLOON_COOLDOWN', '60'))
+BALLOON_AUDIT_LOG = os.getenv('BALLOON_AUDIT_LOG')
+
+
+def guest_used(stats):
+    """ Return the KiB used by the guest or None without guest stats. """
+    current = stats.get('balloon.current')
+    usable = stats.get('balloon.usable')
+    if current is not None and usable is not None:
+        return max(0, current - usable)
+    available = stats.get('balloon.available')
+    unused = stats.get('balloon.unused')
+    if available is not None and unused is not None:
+        return max(0, available - unused)
+    return None
+
+
+def target_size(used, floor, maximum):
+    """ Return the wanted balloon size of a guest using used KiB. """
+    return int(max(floor, min(maximum, used * (1 + BALLOON_HEADROOM))))
+
+
+def fixed_backing(xml):
+    """ Return whether the domain xml has memory ballooning can't free. """
+    backing = ET.fromstring(xml).find('memoryBacking')
+    if backing is None:
+        return False
+    source = backing.find('source')
+    return (backing.find('hugepages') is not None or
+            backing.find('locked') is not None or
+            (source is not None and source.get('type') == 'memfd'))
+
+
+def plan(domains, pressure_kib, now=None):
+    """ Return the changes for domains.
+
+    domains is a list of dicts with name, current, maximum, used,
+    floor and changed (time of the last change). pressure_kib is the
+    memory the host wants back (0 without pressure). Return a list of
+    (domain dict, new size, reason).
+
+    """
+    now = now or time.time()
+    changes = []
+    growing = []
+    shrinkable = []
+    for domain in domains:
+        if domain['used'] is None:
+            continue
+        current = domain['current']
+        target = target_size(domain['used'], domain['floor'],
+                             domain['maximum'])
+        domain['target'] = target
+        if now - domain.get('changed', 0) <= BALLOON_COOLDOWN:
+            continue
+        margin = max(BALLOON_HYSTERESIS * current, 1)
+        if target > current + margin or (
+                target > current and current < domain['floor']):
+            growing.append(domain)
+        elif target < current - margin:
+            shrinkable.append(domain)
+    # Most undersized first, limited while the host wants memory
+    growing.sort(key=lambda d: d['current'] - d['target'])
+    budget = BALLOON_STEP if pressure_kib > 0 else None
+    for domain in growing:
+        step = domain['target'] - domain['current']
+        if budget is not None:
+            if budget <= 0:
+                break
+            step = min(step, budget)
+            budget -= step
+        changes.append((domain, domain['current'] + step, 'grow'))
+    # Most oversized first while the host wants memory
+    shrinkable.sort(key=lambda d: d['target'] - d['current'])
+    for domain in shrinkable:
+        if pressure_kib <= 0:
+            break
+        step = min(BALLOON_STEP, domain['current'] - domain['target'],
+                   pressure_kib)
+        changes.append((domain, domain['current'] - step, 'reclaim'))
+        pressure_kib -= step
+    return changes
+
+
+def host_pressure():
+    """ Return the KiB the host wants back (0 without pressure). """
+    memory = virtual_memory()
+    wanted = BALLOON_PRESSURE * memory.total - memory.available
+    return max(0, int(wanted / 1024))
+
+
+class Controller(object):
+
+    """ Balloon loop state of the leader. """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.floors = {}
+        self.fixed = {}
+        self.changed = {}
+        self.periods = set()
+        self.live = set()
+
+    def floor(self, dom, maximum):
+        uuid = dom.UUIDString()
+        floor = self.floors.get(uuid)
+        if floor is None:
+            floor = max(BALLOON_MIN_FLOOR, int(BALLOON_FLOOR_RATIO * maximum))
+            try:
+                element = ET.fromstring(dom.metadata(
+                    libvirt.VIR_DOMAIN_METADATA_ELEMENT, BALLOON_NS,
+                    libvirt.VIR_DOMAIN_AFFECT_LIVE))
+                floor = int(element.get('min'))
+            except (libvirt.libvirtError, ET.XMLSyntaxError,
+                    TypeError, ValueError):
+                pass
+            self.floors[uuid] = floor = min(floor, maximum)
+        return floor
+
+    def fixed_backing(self, dom):
+        uuid = dom.UUIDString()
+        if uuid not in self.fixed:
+            self.fixed[uuid] = fixed_backing(dom.XMLDesc(0))
+        return self.fixed[uuid]
+
+    def collect(self):
+        """ Return the domain dicts of the running domains. """
+        domains = []
+        self.live = set()
+        for dom, stats in self.conn.getAllDomainStats(
+                libvirt.VIR_DOMAIN_STATS_BALLOON,
+                libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE):
+            self.live.add(dom.UUIDString())
+            name = warmpool.alias_of(dom.name())
+            if name is None or 'balloon.current' not in stats or \
+                    self.fixed_backing(dom):
+                continue
+            uuid = dom.UUIDString()
+            if uuid not in self.periods:
+                # The guest only reports statistics with a period set
+                try:
+                    dom.setMemoryStatsPeriod(
+                        BALLOON_STATS_PERIOD, libvirt.VIR_DOMAIN_AFFECT_LIVE)
+                except libvirt.libvirtError as e:
+                    logging.debug("No balloon stats period for %s: %s",
+                                  name, e.get_error_message())
+                self.periods.add(uuid)
+            maximum = stats.get('balloon.maximum', stats['balloon.current'])
+            domains.append({'name': name, 'dom': dom, 'uuid': uuid,
+                            'current': stats['balloon.current'],
+                            'maximum': maximum,
+                            'used': guest_used(stats),
+                            'floor': self.floor(dom, maximum),
+                            'changed': self.changed.get(uuid, 0)})
+        return domains
+
+    def audit(self, entry):
+        logging.info("Balloon %(reason)s %(name)s: %(current)d -> "
+                     "%(size)d KiB (used %(used)s, floor %(floor)d, "
+                     "host pressure %(pressure)d)", entry)
+        path = BALLOON_AUDIT_LOG or hostlock.path('balloon-audit.log')
+        with open(path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+    def run_once(self):
+        domains = self.collect()
+        pressure = host_pressure()
+        now = time.time()
+        for domain, size, reason in plan(domains, pressure, now):
+            entry = {'time': now, 'name': domain['name'], 'reason': reason,
+                     'current': domain['current'], 'size': size,
+                     'target': domain['target'], 'used': domain['used'],
+                     'floor': domain['floor'], 'pressure': pressure}
+            try:
+                domain['dom'].setMemoryFlags(
+                    size, libvirt.VIR_DOMAIN_AFFECT_LIVE)
+            except libvirt.libvirtError as e:
+                entry['error'] = e.get_error_message()
+            self.changed[domain['uuid']] = now
+            self.audit(entry)
+        for cache in (self.floors, self.fixed, self.changed):
+            for uuid in set(cache) - self.live:
+                del cache[uuid]
+        self.periods &= self.live
+        hostlock.save('balloon', {
+            'time': now, 'pressure': pressure,
+            'domains': dict((d['name'], {
+                'current': d['current'], 'maximum': d['maximum'],
+                'used': d['used'], 'floor': d['floor'],
+                'target': d.get('target')}) for d in domains)})
+
+
+def info():
+    """ Return the state of the last controller round. """
+    return hostlock.load('balloon', {})
+
+
+def _run():
+    while not hostlock.leader('balloon'):
+        time.sleep(BALLOON_INTERVAL)
+    controller = None
+    while True:
+        try:
+            if controller is None:
+                controller = Controller(libvirt.open(
+                    os.getenv('LIBVIRT_URI', 'qemu:///system')))
+            controller.run_once()
+        except Exception:
+            logging.exception("Balloon controller round failed")
+            controller = None
+        time.sleep(BALLOON_INTERVAL)
+
+
+def start(**kw):
+    """ Start the balloon controller thread of this process. """
+    thread = threading.Thread(target=_run, name='balloon')
+    thread.daemon = True
+    thread.start()
+
+
+def install(app):
+    """ Run the controller in the worker pool processes (one leads). """
+    if not enabled:
+        return
+    from celery.signals import worker_process_init
+    worker_process_init.connect(start, weak=False,
+                                dispatch_uid='balloon_process_init')
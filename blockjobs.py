@@ -0,0 +1,111 @@
+""" Host wide I/O budget for concurrent block jobs.
+
+BLOCKJOB_MAX_JOBS       block jobs allowed to run at once on the host
+BLOCKJOB_BANDWIDTH      total MiB/s shared by the running jobs (0: no limit)
+
+A job holds a slot from start to finish. Its bandwidth is its requested
+limit capped by an equal share of the budget, recomputed while the other
+jobs come and go.
+
+"""
+import errno
+import os
+import time
+
+import lxml.etree as ET
+
+import hostlock
+
+BLOCKJOB_MAX_JOBS = int(os.getenv('BLOCKJOB_MAX_JOBS', '2'))
+BLOCKJOB_BANDWIDTH = int(os.getenv('BLOCKJOB_BANDWIDTH', '0'))
+POLL_INTERVAL = float(os.getenv('BLOCKJOB_POLL_INTERVAL', '2'))
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _prune(state):
+    for key, job in list(state['jobs'].items()):
+        if not _alive(job['pid']):
+            del state['jobs'][key]
+
+
+def acquire(key, bandwidth=0, aborted=None):
+    """ Wait for a free job slot and register job key in it.
+
+    aborted is an optional callable, waiting stops when it returns True.
+    Return True when the slot is held, False if aborted. Raise an
+    exception if another live process holds key, as only one job may
+    run on a disk.
+
+    """
+    while True:
+        with hostlock.locked('blockjobs'):
+            state = hostlock.load('blockjobs', {'jobs': {}})
+            _prune(state)
+            job = state['jobs'].get(key)
+            if job is not None and job['pid'] != os.getpid():
+                raise Exception("A block job is already running on %s "
+                                "(pid %d)" % (key, job['pid']))
+            if job is not None or len(state['jobs']) < BLOCKJOB_MAX_JOBS:
+                state['jobs'][key] = {'pid': os.getpid(),
+                                      'bandwidth': int(bandwidth or 0),
+                                      'started': time.time()}
+                hostlock.save('blockjobs', state)
+                return True
+        if aborted is not None and aborted():
+            return False
+        time.sleep(POLL_INTERVAL)
+
+
+def release(key):
+    """ Free the slot of job key held by this process. """
+    with hostlock.locked('blockjobs'):
+        state = hostlock.load('blockjobs', {'jobs': {}})
+        if state['jobs'].get(key, {}).get('pid') == os.getpid():
+            del state['jobs'][key]
+        _prune(state)
+        hostlock.save('blockjobs', state)
+
+
+def share(key):
+    """ Return the MiB/s job key may use now (0 means unlimited). """
+    state = hostlock.load('blockjobs', {'jobs': {}})
+    job = state['jobs'].get(key, {})
+    requested = job.get('bandwidth', 0)
+    if not BLOCKJOB_BANDWIDTH:
+        return requested
+    fair = max(BLOCKJOB_BANDWIDTH // max(len(state['jobs']), 1), 1)
+    return min(requested, fair) if requested else fair
+
+
+def mirror_ready(xml, disk):
+    """ Return True if the copy job of disk in domain xml is ready.
+
+    disk is the target device or the source file of the disk. The
+    mirror of copy and active commit jobs turns ready when the
+    destination is in sync and the job can pivot.
+
+    """
+    for element in ET.fromstring(xml).findall('devices/disk'):
+        target = element.find('target')
+        source = element.find('source')
+        if ((target is not None and target.get('dev') == disk) or
+                (source is not None and disk in (source.get('file'),
+                                                 source.get('dev')))):
+            mirror = element.find('mirror')
+            return mirror is not None and mirror.get('ready') == 'yes'
+    return False
+
+
+def jobs():
+    """ Return the registered jobs of the host. """
+    with hostlock.locked('blockjobs'):
+        state = hostlock.load('blockjobs', {'jobs': {}})
+        _prune(state)
+    return state['jobs']
@@ -0,0 +1,171 @@
+""" Host wide boot throttling (token bucket and concurrency limit).
+
+Enabled with BOOT_THROTTLE. A guest boots when a defined domain is
+started or a freshly created (paused) domain is resumed the first time.
+Before that, the task takes a boot slot. Tasks never block a pool
+process: without a free slot the task is retried after
+BOOT_RETRY_INTERVAL seconds and keeps its place in the queue with the
+ticket returned by try_acquire.
+
+BOOT_CONCURRENCY    domains allowed to boot at the same time (4)
+BOOT_RATE           boot slots granted per second on average (1.0)
+BOOT_BURST          slots that can be granted at once (4)
+BOOT_TIMEOUT        seconds after which a slot is freed without a
+                    boot_completed signal (300)
+BOOT_QUEUE_TIMEOUT  seconds a task waits at most, then boots anyway (900)
+BOOT_RETRY_INTERVAL seconds between the attempts of a waiting task (1)
+
+Waiting tasks are served by priority class (high, normal, low), then
+in arrival order. Slots are freed by boot_completed (context server
+handshake or guest agent ping), when the domain is stopped, or after
+BOOT_TIMEOUT. The state is shared by the worker processes in the
+'bootstorm' state file.
+
+"""
+import logging
+import os
+import time
+
+import hostlock
+import metrics
+
+enabled = os.getenv('BOOT_THROTTLE', 'False').lower() in (
+    "true", "yes", "y", "t")
+BOOT_CONCURRENCY = int(os.getenv('BOOT_CONCURRENCY', '4'))
+BOOT_RATE = float(os.getenv('BOOT_RATE', '1.0'))
+BOOT_BURST = float(os.getenv('BOOT_BURST', '4'))
+BOOT_TIMEOUT = int(os.getenv('BOOT_TIMEOUT', '300'))
+BOOT_QUEUE_TIMEOUT = int(os.getenv('BOOT_QUEUE_TIMEOUT', '900'))
+BOOT_RETRY_INTERVAL = float(os.getenv('BOOT_RETRY_INTERVAL', '1'))
+# Waiting tasks not retried for this long are dropped from the queue
+WAITING_EXPIRY = max(60, 30 * BOOT_RETRY_INTERVAL)
+
+PRIORITIES = {'high': 0, 'normal': 1, 'low': 2}
+
+
+def _state(now):
+    """ Load the state with refilled tokens and expired entries dropped. """
+    state = hostlock.load('bootstorm', None) or {
+        'tokens': BOOT_BURST, 'updated': now, 'booting': {},
+        'waiting': {}, 'pending': {}}
+    state['tokens'] = min(BOOT_BURST, state['tokens'] +
+                          (now - state['updated']) * BOOT_RATE)
+    state['updated'] = now
+    for name, entry in list(state['booting'].items()):
+        if now - entry['since'] > BOOT_TIMEOUT:
+            logging.warning("Boot slot of %s timed out", name)
+            del state['booting'][name]
+    for ticket, entry in list(state['waiting'].items()):
+        if now - entry.get('seen', entry['since']) > WAITING_EXPIRY:
+            del state['waiting'][ticket]
+    return state
+
+
+def _first(waiting):
+    return min(waiting, key=lambda t: (
+        PRIORITIES.get(waiting[t]['priority'], 1), waiting[t]['since'],
+        t))
+
+
+def mark_pending(name, priority='normal'):
+    """ Remember that the next resume of name boots the guest. """
+    if not enabled:
+        return
+    with hostlock.locked('bootstorm'):
+        state = _state(time.time())
+        state['pending'][name] = priority
+        hostlock.save('bootstorm', state)
+
+
+def pending_priority(name):
+    """ Return the priority of a pending boot of name (or None).
+
+    The boot stays pending until try_acquire grants its slot.
+
+    """
+    if not enabled:
+        return None
+    with hostlock.locked('bootstorm'):
+        return _state(time.time())['pending'].get(name)
+
+
+def try_acquire(name, priority='normal', ticket=None):
+    """ Take a boot slot for name without waiting.
+
+    ticket is returned by the previous attempt of the same request and
+    keeps its place in the queue. Return (seconds waited, None) when the
+    slot is granted, otherwise (None, ticket) to retry with.
+
+    """
+    if not enabled:
+        return 0.0, None
+    if priority not in PRIORITIES:
+        raise Exception("Unknown boot priority: %s" % priority)
+    now = time.time()
+    with hostlock.locked('bootstorm'):
+        state = _state(now)
+        if ticket is None or ticket not in state['waiting']:
+            ticket = ticket or '%d-%d-%s' % (os.getpid(), now * 1000000,
+                                             name)
+            state['waiting'][ticket] = {'name': name, 'priority': priority,
+                                        'since': now}
+        entry = state['waiting'][ticket]
+        entry['seen'] = now
+        start = entry['since']
+        timed_out = now - start > BOOT_QUEUE_TIMEOUT
+        granted = timed_out or (
+            _first(state['waiting']) == ticket and
+            state['tokens'] >= 1 and
+            len(state['booting']) < BOOT_CONCURRENCY)
+        if granted:
+            del state['waiting'][ticket]
+            state['pending'].pop(name, None)
+            state['tokens'] = max(0.0, state['tokens'] - 1)
+            state['booting'][name] = {'since': now,
+                                      'priority': priority,
+                                      'queued': now - start}
+        hostlock.save('bootstorm', state)
+    if not granted:
+        return None, ticket
+    waited = now - start
+    if timed_out:
+        logging.warning("Boot of %s admitted after queue timeout", name)
+    logging.info("Boot slot granted to %s (%s) after %.1fs", name,
+                 priority, waited)
+    metrics.observe('boot_queue_seconds', waited, priority=priority)
+    return waited, None
+
+
+def release(name):
+    """ Free the boot slot of name (boot completed or domain gone). """
+    if not enabled:
+        return False
+    with hostlock.locked('bootstorm'):
+        state = _state(time.time())
+        entry = state['booting'].pop(name, None)
+        state['pending'].pop(name, None)
+        hostlock.save('bootstorm', state)
+    if entry is not None:
+        seconds = time.time() - entry['since']
+        metrics.observe('boot_seconds', seconds,
+                        priority=entry['priority'])
+        logging.info("Boot of %s completed in %.1fs", name, seconds)
+    return entry is not None
+
+
+def info():
+    """ Return tokens, booting and waiting domains with their ages. """
+    now = time.time()
+    with hostlock.locked('bootstorm'):
+        state = _state(now)
+    return {'enabled': enabled,
+            'tokens': state['tokens'],
+            'concurrency': BOOT_CONCURRENCY,
+            'booting': dict((name, {'seconds': now - e['since'],
+                                    'priority': e['priority'],
+                                    'queued': e['queued']})
+                            for name, e in state['booting'].items()),
+            'waiting': [{'name': e['name'], 'priority': e['priority'],
+                         'seconds': now - e['since']}
+                        for t, e in sorted(state['waiting'].items(),
+                                           key=lambda i: i[1]['since'])]}
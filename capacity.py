@@ -0,0 +1,225 @@
+""" Host capacity model and admission control.
+
+The model keeps the vcpus, memory and hugepage backed memory committed
+to the running domains, updated from libvirt lifecycle events, and
+checks new domains against the host size and the overcommit ratios:
+
+CPU_OVERCOMMIT      vcpus allowed per host cpu (default 4.0)
+MEMORY_OVERCOMMIT   guest memory allowed per host memory (default 1.0)
+RESERVED_MEMORY     KiB of memory kept for the host (default 1 GiB)
+
+Every worker process follows the running domains itself, admissions
+are shared by the processes of the host: the check and the reservation
+of an admitted domain happen under one host wide lock, and the
+reservation is stored in RUN_DIR. It counts until the domain runs,
+stops or RESERVATION_TIMEOUT expires, so no process admits a domain
+against capacity another one has just handed out.
+
+"""
+import libvirt
+import logging
+import os
+import threading
+import time
+import lxml.etree as ET
+
+import events
+import hostlock
+import hugepages
+
+CPU_OVERCOMMIT = float(os.getenv('CPU_OVERCOMMIT', '4.0'))
+MEMORY_OVERCOMMIT = float(os.getenv('MEMORY_OVERCOMMIT', '1.0'))
+RESERVED_MEMORY = int(os.getenv('RESERVED_MEMORY', '1048576'))
+RESERVATION_TIMEOUT = int(os.getenv('RESERVATION_TIMEOUT', '600'))
+
+
+def domain_resources(xml):
+    """ Return (vcpus, memory KiB, hugepage memory KiB) of domain xml. """
+    root = ET.fromstring(xml)
+    vcpus = int(root.findtext('vcpu', '1'))
+    memory = root.find('memory')
+    kib = int(memory.text) if memory is not None else 0
+    unit = memory.get('unit', 'KiB') if memory is not None else 'KiB'
+    kib = kib * {'b': 1, 'bytes': 1, 'KiB': 1024, 'k': 1024,
+                 'MiB': 1024 ** 2, 'M': 1024 ** 2,
+                 'GiB': 1024 ** 3, 'G': 1024 ** 3}.get(unit, 1024) // 1024
+    if root.find('memoryBacking/hugepages') is not None:
+        return vcpus, 0, kib
+    return vcpus, kib, 0
+
+
+class CapacityModel(object):
+
+    """ Committed resources against the host capacity. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.domains = {}
+        self.committed = [0, 0, 0]
+        self.cpus = 0
+        self.memory = 0
+        self.hugepage_memory = 0
+        self.synced = False
+
+    def _apply(self, resources, sign):
+        for i, value in enumerate(resources):
+            self.committed[i] += sign * value
+
+    def _drop(self, name):
+        old = self.domains.pop(name, None)
+        if old is not None:
+            self._apply(old, -1)
+
+    def add(self, name, resources):
+        """ Commit resources to the running domain name. """
+        with self.lock:
+            self._drop(name)
+            self.domains[name] = tuple(resources)
+            self._apply(resources, 1)
+
+    def remove(self, name):
+        """ Release the resources of domain name. """
+        with self.lock:
+            self._drop(name)
+
+    def limits(self):
+        """ Return the (vcpus, memory, hugepage memory) limits. """
+        memory = self.memory - self.hugepage_memory - RESERVED_MEMORY
+        return (int(self.cpus * CPU_OVERCOMMIT),
+                int(max(memory, 0) * MEMORY_OVERCOMMIT),
+                self.hugepage_memory)
+
+    def _reservations(self):
+        """ Return the unexpired reservations (host lock held). """
+        now = time.time()
+        reservations = hostlock.load('capacity', {})
+        for name, (resources, expires) in list(reservations.items()):
+            if expires < now:
+                logging.info("Capacity reservation of %s expired", name)
+                del reservations[name]
+        return reservations
+
+    def _committed(self, reservations):
+        """ Return the running and the reserved resources. """
+        committed = list(self.committed)
+        for name, (resources, expires) in reservations.items():
+            if name not in self.domains:
+                for i, value in enumerate(resources):
+                    committed[i] += value
+        return committed
+
+    def check(self, resources, reservations=None):
+        """ Return None if resources fit, otherwise the reason. """
+        if reservations is None:
+            with hostlock.locked('capacity'):
+                reservations = self._reservations()
+        with self.lock:
+            names = ('vcpus', 'memory', 'hugepage memory')
+            for name, used, wanted, limit in zip(
+                    names, self._committed(reservations), resources,
+                    self.limits()):
+                if wanted and used + wanted > limit:
+                    return ("not enough %s: %d requested, %d of %d "
+                            "committed" % (name, wanted, used, limit))
+        return None
+
+    def reserve(self, name, resources, timeout=RESERVATION_TIMEOUT):
+        """ Admit and hold resources until name runs or timeout.
+
+        Raise an exception if domain name does not fit.
+
+        """
+        with hostlock.locked('capacity'):
+            reservations = self._reservations()
+            reservations.pop(name, None)
+            reason = self.check(resources, reservations)
+            if reason is not None:
+                logging.warning("Admission of %s rejected: %s", name, reason)
+                raise Exception("Host capacity exceeded for %s: %s" %
+                                (name, reason))
+            reservations[name] = [list(resources), time.time() + timeout]
+            hostlock.save('capacity', reservations)
+
+    admit = reserve
+
+    def release(self, name):
+        """ Drop the reservation of name (start failed or stopped). """
+        with hostlock.locked('capacity'):
+            reservations = self._reservations()
+            if reservations.pop(name, None) is not None:
+                hostlock.save('capacity', reservations)
+
+    def headroom(self):
+        """ Return the limits, committed and free resources. """
+        with hostlock.locked('capacity'):
+            reservations = self._reservations()
+        with self.lock:
+            limits = self.limits()
+            committed = self._committed(reservations)
+            keys = ('vcpus', 'memory', 'hugepage_memory')
+            return {
+                'domains': len(self.domains),
+                'reservations': len(reservations),
+                'limit': dict(zip(keys, limits)),
+                'committed': dict(zip(keys, committed)),
+                'free': dict((k, l - c) for k, l, c in zip(
+                    keys, limits, committed))}
+
+    def sync(self, conn):
+        """ Rebuild the model from the host and its running domains. """
+        info = conn.getInfo()
+        domains = {}
+        for dom in conn.listAllDomains(
+                libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE):
+            try:
+                domains[dom.name()] = domain_resources(dom.XMLDesc(0))
+            except libvirt.libvirtError:
+                continue  # Stopped meanwhile
+        pages = hugepages.host_hugepages()
+        with self.lock:
+            self.cpus = info[2]
+            self.memory = info[1] * 1024
+            self.hugepage_memory = sum(
+                size * counters['total'] for node in pages.values()
+                for size, counters in node.items())
+            self.domains = domains
+            self.committed = [0, 0, 0]
+            for resources in domains.values():
+                self._apply(resources, 1)
+            self.synced = True
+        logging.info("Capacity model synced: %d domains", len(domains))
+
+    def on_lifecycle(self, dom, event, detail):
+        """ Update the model from a domain lifecycle event. """
+        if event == libvirt.VIR_DOMAIN_EVENT_STARTED:
+            try:
+                self.add(dom.name(), domain_resources(dom.XMLDesc(0)))
+            except libvirt.libvirtError:
+                logging.exception("Unable to read started domain")
+        elif event == libvirt.VIR_DOMAIN_EVENT_STOPPED:
+            self.remove(dom.name())
+            self.release(dom.name())
+
+
+model = CapacityModel()
+_subscribed = False
+
+
+def start():
+    """ Follow lifecycle events and sync the model in this process.
+
+    The model is synced again after every event reconnection. A failed
+    sync is retried by the next call without subscribing again.
+
+    """
+    global _subscribed
+    if model.synced:
+        return model
+    if not _subscribed:
+        _subscribed = True
+        events.subscribe(libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                         model.on_lifecycle)
+        events.on_connect(model.sync)
+    else:
+        model.sync(events.start())
+    return model
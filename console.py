@@ -0,0 +1,287 @@
+""" Capture of the guest serial consoles into bounded buffers.
+
+Enabled with CONSOLE_CAPTURE. New domains get a chardev log on their
+serial console: QEMU (through virtlogd) appends the console output to
+CONSOLE_DIR/<name>.serial, next to the socket the context server uses,
+so the capture never connects to the console socket. The leader worker
+process of the host follows the log files of the running domains, also
+across the rotations of virtlogd. The output of each domain is kept in
+CONSOLE_DIR/<name>.log, which holds the most recent CONSOLE_BUFFER to
+2 * CONSOLE_BUFFER bytes behind a header with the absolute offset of
+its first byte, so any worker process can serve tail and incremental
+reads.
+
+Domains created without the chardev log are not captured. The files
+of a domain that has not been running for CONSOLE_EXPIRY seconds are
+removed (0 keeps them).
+
+"""
+import logging
+import os
+import re
+import threading
+import time
+
+import hostlock
+
+enabled = os.getenv('CONSOLE_CAPTURE', 'False').lower() in (
+    "true", "yes", "y", "t")
+CONSOLE_DIR = os.getenv('CONSOLE_DIR', '/var/lib/libvirt/console')
+CONSOLE_BUFFER = int(os.getenv('CONSOLE_BUFFER', '65536'))
+CONSOLE_SCAN_INTERVAL = int(os.getenv('CONSOLE_SCAN_INTERVAL', '5'))
+CONSOLE_POLL_INTERVAL = float(os.getenv('CONSOLE_POLL_INTERVAL', '0.5'))
+CONSOLE_EXPIRY = int(os.getenv('CONSOLE_EXPIRY', str(7 * 24 * 3600)))
+HEADER_SIZE = 21
+READ_SIZE = 65536
+# Ring, ring being rewritten, chardev log and its rotations
+_FILE_RE = re.compile(r'^(.+)\.(log|log\.tmp|serial|serial\.\d+)$')
+
+
+def _path(name):
+    return os.path.join(CONSOLE_DIR, name + '.log')
+
+
+def log_path(name):
+    """ Return the chardev log file of the serial console of name. """
+    return os.path.join(CONSOLE_DIR, name + '.serial')
+
+
+class RingFile(object):
+
+    """ Bounded console log of one domain (written by the leader). """
+
+    def __init__(self, name):
+        self.name = name
+        self.path = _path(name)
+        self.start = 0
+        self.size = 0
+        if os.path.exists(self.path):
+            self.start, data = read_buffer(name)
+            self.size = len(data)
+        else:
+            self._rewrite(b'')
+        self.file = open(self.path, 'ab')
+
+    def _rewrite(self, data):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(('%020d\n' % self.start).encode('ascii'))
+            f.write(data)
+        os.rename(tmp, self.path)
+
+    def append(self, data):
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data)
+        if self.size > 2 * CONSOLE_BUFFER:
+            # Keep the newest CONSOLE_BUFFER bytes
+            self.file.close()
+            start, current = read_buffer(self.name)
+            keep = current[-CONSOLE_BUFFER:]
+            self.start = start + len(current) - len(keep)
+            self.size = len(keep)
+            self._rewrite(keep)
+            self.file = open(self.path, 'ab')
+
+    def close(self):
+        self.file.close()
+
+
+def read_buffer(name):
+    """ Return (absolute offset of the first byte, data) of domain name. """
+    try:
+        with open(_path(name), 'rb') as f:
+            header = f.read(HEADER_SIZE)
+            data = f.read()
+    except IOError:
+        return 0, b''
+    if len(header) < HEADER_SIZE:
+        return 0, b''
+    return int(header), data
+
+
+def read(name, offset=None, size=4096):
+    """ Return the console output of domain name.
+
+    If offset is None the last size bytes are returned, otherwise at most
+    size bytes from the absolute offset. Return dict:
+    data        output decoded as UTF-8 (invalid bytes replaced)
+    offset      offset to continue reading from
+    start       oldest offset still buffered
+    truncated   True if output between offset and start was dropped
+
+    """
+    start, data = read_buffer(name)
+    end = start + len(data)
+    truncated = False
+    if offset is None:
+        offset = max(end - size, start)
+    elif offset < start:
+        truncated = True
+        offset = start
+    offset = min(offset, end)
+    chunk = data[offset - start:offset - start + size]
+    return {'data': chunk.decode('utf-8', 'replace'),
+            'offset': offset + len(chunk),
+            'start': start,
+            'truncated': truncated}
+
+
+class LogTail(object):
+
+    """ Copy the growth of the console log of one domain to its ring. """
+
+    def __init__(self, name):
+        self.name = name
+        self.path = log_path(name)
+        self.file = None
+        self.inode = None
+        # A new ring starts with the recent output, an existing one
+        # continues at the end of the log
+        self.backlog = 0 if os.path.exists(_path(name)) else CONSOLE_BUFFER
+        self.ring = RingFile(name)
+
+    def _open(self):
+        try:
+            self.file = open(self.path, 'rb')
+        except IOError:
+            return False
+        stat = os.fstat(self.file.fileno())
+        self.inode = stat.st_ino
+        if self.backlog is not None:
+            self.file.seek(max(stat.st_size - self.backlog, 0))
+        # Files appearing later are read from the start
+        self.backlog = None
+        return True
+
+    def _copy(self):
+        while True:
+            data = self.file.read(READ_SIZE)
+            if not data:
+                return
+            self.ring.append(data)
+
+    def poll(self):
+        """ Append the new output, follow rotation and truncation. """
+        if self.file is None and not self._open():
+            self.backlog = None
+            return
+        self._copy()
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return
+        if stat.st_ino != self.inode:
+            # Rotated, the old file is read to its end already
+            self.file.close()
+            self.file = None
+            if self._open():
+                self._copy()
+        elif stat.st_size < self.file.tell():
+            self.file.seek(0)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        self.ring.close()
+
+
+class ConsoleCapture(object):
+
+    """ Follow the console logs of the running domains. """
+
+    def __init__(self):
+        self.attached = {}
+
+    def poll(self):
+        for name, tail in list(self.attached.items()):
+            try:
+                tail.poll()
+            except (IOError, OSError):
+                logging.exception("Console capture of %s failed", name)
+
+    def scan(self, conn):
+        """ Attach to the running domains, detach from stopped ones. """
+        running = set()
+        for i in conn.listDomainsID():
+            try:
+                running.add(conn.lookupByID(i).name())
+            except Exception:
+                continue  # Stopped meanwhile
+        for name in running - set(self.attached):
+            self.attached[name] = LogTail(name)
+            logging.info("Console capture of %s attached", name)
+        for name in set(self.attached) - running:
+            tail = self.attached.pop(name)
+            tail.poll()
+            tail.close()
+            logging.info("Console capture of %s detached", name)
+        self.expire(running)
+
+    def expire(self, running, now=None):
+        """ Remove the files of domains not running for CONSOLE_EXPIRY. """
+        if not CONSOLE_EXPIRY:
+            return
+        if now is None:
+            now = time.time()
+        files = {}
+        for filename in os.listdir(CONSOLE_DIR):
+            match = _FILE_RE.match(filename)
+            if match is None or match.group(1) in running:
+                continue
+            path = os.path.join(CONSOLE_DIR, filename)
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            files.setdefault(match.group(1), []).append((mtime, path))
+        for name, paths in files.items():
+            if now - max(paths)[0] < CONSOLE_EXPIRY:
+                continue
+            for mtime, path in paths:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass  # Removed meanwhile
+            logging.info("Console files of %s expired", name)
+
+
+def _run():
+    import libvirt
+    capture = None
+    conn = None
+    scanned = 0
+    while True:
+        try:
+            if hostlock.leader('console'):
+                if capture is None:
+                    if not os.path.isdir(CONSOLE_DIR):
+                        os.makedirs(CONSOLE_DIR)
+                    capture = ConsoleCapture()
+                if time.time() - scanned >= CONSOLE_SCAN_INTERVAL:
+                    if conn is None:
+                        conn = libvirt.openReadOnly(
+                            os.getenv('LIBVIRT_URI', 'qemu:///system'))
+                    scanned = time.time()
+                    capture.scan(conn)
+                capture.poll()
+        except Exception:
+            logging.exception("Console capture scan failed")
+            conn = None
+        time.sleep(CONSOLE_POLL_INTERVAL)
+
+
+def start(**kw):
+    """ Start the console capture thread of this process. """
+    thread = threading.Thread(target=_run, name='console-scan')
+    thread.daemon = True
+    thread.start()
+
+
+def install(app):
+    """ Start the capture in the worker pool processes (one leads). """
+    if not enabled:
+        return
+    from celery.signals import worker_process_init
+    worker_process_init.connect(start, weak=False,
+                                dispatch_uid='console_process_init')
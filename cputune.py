@@ -0,0 +1,325 @@
+""" CPU scheduler tuning of running domains.
+
+The scheduler parameters (cpu_shares, vcpu_period, vcpu_quota,
+emulator_period, emulator_quota, iothread_period, iothread_quota,
+global_period, global_quota) are changed live with
+setSchedulerParameters. Quotas are microseconds per period, -1 is
+unlimited.
+
+Enabled with CPU_TUNE, the leader worker process of the host also runs
+a policy loop every CPU_TUNE_INTERVAL seconds. It measures the CPU time
+of every running domain with one getAllDomainStats call and
+
+- sets cpu_shares to CPU_TUNE_BASE_SHARES * class weight * vCPUs,
+  scaled by the cpu_shares the domain was created with (the cpu_share
+  of VMInstance, 100 keeps the scale),
+- while the domains use more than CPU_TUNE_CONTENTION of the host CPUs,
+  caps the domains using more than their weighted max-min fair share at
+  that share (plus CPU_TUNE_SLACK) and limits their emulator and I/O
+  threads to CPU_TUNE_THREAD_LIMIT CPUs,
+- lifts the caps after CPU_TUNE_RELAX rounds without contention.
+
+The tenant class of a domain is its cputune metadata (see VMInstance and
+set_class), classes and weights are set with CPU_CLASSES
+("high:4,normal:2,low:1"). Domains tuned by hand with hold are left
+alone by the policy.
+
+The parameters set by the policy and the create-time shares are kept in
+RUN_DIR, so a new leader lifts the caps set by the previous one.
+
+"""
+import logging
+import os
+import threading
+import time
+
+import libvirt
+import lxml.etree as ET
+from psutil import NUM_CPUS
+
+import hostlock
+import warmpool
+from vm import CPUTUNE_NS
+
+enabled = os.getenv('CPU_TUNE', 'False').lower() in (
+    "true", "yes", "y", "t")
+CPU_TUNE_INTERVAL = int(os.getenv('CPU_TUNE_INTERVAL', '10'))
+CPU_TUNE_BASE_SHARES = int(os.getenv('CPU_TUNE_BASE_SHARES', '512'))
+CPU_TUNE_CONTENTION = float(os.getenv('CPU_TUNE_CONTENTION', '0.9'))
+CPU_TUNE_SLACK = float(os.getenv('CPU_TUNE_SLACK', '0.1'))
+CPU_TUNE_THREAD_LIMIT = float(os.getenv('CPU_TUNE_THREAD_LIMIT', '0.5'))
+CPU_TUNE_RELAX = int(os.getenv('CPU_TUNE_RELAX', '3'))
+CPU_TUNE_PERIOD = int(os.getenv('CPU_TUNE_PERIOD', '100000'))
+CPU_DEFAULT_CLASS = os.getenv('CPU_DEFAULT_CLASS', 'normal')
+CPU_CLASSES = dict(
+    (item.split(':')[0].strip(), float(item.split(':')[1]))
+    for item in os.getenv('CPU_CLASSES', 'high:4,normal:2,low:1').split(',')
+    if item.strip())
+# Minimal quota accepted by the kernel (microseconds)
+MIN_QUOTA = 1000
+
+PARAMETERS = ('cpu_shares', 'vcpu_period', 'vcpu_quota',
+              'emulator_period', 'emulator_quota',
+              'iothread_period', 'iothread_quota',
+              'global_period', 'global_quota')
+UNLIMITED = {'vcpu_quota': -1, 'emulator_quota': -1, 'iothread_quota': -1}
+
+
+def get(dom):
+    """ Return the live scheduler parameters of dom. """
+    return dom.schedulerParametersFlags(libvirt.VIR_DOMAIN_AFFECT_LIVE)
+
+
+def apply(dom, params, config=False):
+    """ Set the scheduler parameters of the running dom.
+
+    With config the persistent definition is changed too.
+
+    """
+    unknown = set(params) - set(PARAMETERS)
+    if unknown:
+        raise Exception("Unknown scheduler parameters: %s" %
+                        ', '.join(sorted(unknown)))
+    flags = libvirt.VIR_DOMAIN_AFFECT_LIVE
+    if config and dom.isPersistent():
+        flags |= libvirt.VIR_DOMAIN_AFFECT_CONFIG
+    dom.setSchedulerParametersFlags(
+        dict((key, int(value)) for key, value in params.items()), flags)
+
+
+def get_class(dom):
+    """ Return the tenant class of dom. """
+    try:
+        element = ET.fromstring(dom.metadata(
+            libvirt.VIR_DOMAIN_METADATA_ELEMENT, CPUTUNE_NS,
+            libvirt.VIR_DOMAIN_AFFECT_LIVE))
+    except (libvirt.libvirtError, ET.XMLSyntaxError):
+        return CPU_DEFAULT_CLASS
+    return element.get('class') or CPU_DEFAULT_CLASS
+
+
+def set_class(dom, cpu_class):
+    """ Set the tenant class of dom (live and persistent). """
+    if cpu_class not in CPU_CLASSES:
+        raise Exception("Unknown CPU class: %s" % cpu_class)
+    flags = libvirt.VIR_DOMAIN_AFFECT_LIVE
+    if dom.isPersistent():
+        flags |= libvirt.VIR_DOMAIN_AFFECT_CONFIG
+    dom.setMetadata(libvirt.VIR_DOMAIN_METADATA_ELEMENT,
+                    '<cputune class="%s"/>' % cpu_class, 'cputune',
+                    CPUTUNE_NS, flags)
+
+
+def hold(name, params):
+    """ Keep the policy away from name (params None releases it). """
+    with hostlock.locked('cputune-hold'):
+        holds = hostlock.load('cputune-hold', {})
+        if params is None:
+            holds.pop(name, None)
+        else:
+            holds[name] = params
+        hostlock.save('cputune-hold', holds)
+
+
+def holds():
+    """ Return the domains tuned by hand (name -> parameters). """
+    return hostlock.load('cputune-hold', {})
+
+
+def fair_shares(demands, capacity):
+    """ Weighted max-min fair allocation of capacity CPUs.
+
+    demands is a dict key -> (used CPUs, weight). Return key ->
+    allocated CPUs, domains using less than their share keep their use.
+
+    """
+    allocation = {}
+    pending = dict((key, value) for key, value in demands.items()
+                   if value[1] > 0)
+    while pending:
+        weight = sum(w for used, w in pending.values())
+        satisfied = dict(
+            (key, used) for key, (used, w) in pending.items()
+            if used <= capacity * w / weight)
+        if not satisfied:
+            for key, (used, w) in pending.items():
+                allocation[key] = capacity * w / weight
+            break
+        for key, used in satisfied.items():
+            allocation[key] = used
+            capacity -= used
+            del pending[key]
+    return allocation
+
+
+def plan(domains, capacity, contended):
+    """ Return name -> scheduler parameters to apply.
+
+    domains is a list of dicts with name, vcpus, used (CPUs), class
+    and created (create-time cpu_shares, 100 if missing).
+
+    """
+    wanted = {}
+    demands = {}
+    for domain in domains:
+        weight = CPU_CLASSES.get(domain['class'],
+                                 CPU_CLASSES.get(CPU_DEFAULT_CLASS, 1))
+        vcpus = max(1, domain['vcpus'])
+        scale = domain.get('created', 100) / 100.0
+        wanted[domain['name']] = {'cpu_shares': max(2, int(
+            CPU_TUNE_BASE_SHARES * weight * vcpus * scale))}
+        demands[domain['name']] = (domain['used'], weight * vcpus)
+    if not contended:
+        return wanted
+    allocation = fair_shares(demands, capacity)
+    for domain in domains:
+        name = domain['name']
+        share = allocation.get(name)
+        if share is None or domain['used'] <= share:
+            continue
+        vcpus = max(1, domain['vcpus'])
+        quota = share * (1 + CPU_TUNE_SLACK) / vcpus * CPU_TUNE_PERIOD
+        thread = CPU_TUNE_THREAD_LIMIT * CPU_TUNE_PERIOD
+        wanted[name].update({
+            'vcpu_period': CPU_TUNE_PERIOD,
+            'vcpu_quota': max(MIN_QUOTA, int(quota)),
+            'emulator_period': CPU_TUNE_PERIOD,
+            'emulator_quota': max(MIN_QUOTA, int(thread)),
+            'iothread_period': CPU_TUNE_PERIOD,
+            'iothread_quota': max(MIN_QUOTA, int(thread))})
+    return wanted
+
+
+class Policy(object):
+
+    """ CPU tuning loop state of the leader. """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.samples = {}
+        state = hostlock.load('cputune-applied', {})
+        self.applied = state.get('applied', {})
+        self.created = state.get('created', {})
+        self.calm = 0
+
+    def collect(self, now):
+        """ Return the domain dicts of the running domains. """
+        domains = []
+        samples = {}
+        for dom, stats in self.conn.getAllDomainStats(
+                libvirt.VIR_DOMAIN_STATS_CPU_TOTAL |
+                libvirt.VIR_DOMAIN_STATS_VCPU,
+                libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE):
+            name = warmpool.alias_of(dom.name())
+            if name is None or 'cpu.time' not in stats:
+                continue
+            uuid = dom.UUIDString()
+            samples[uuid] = (now, stats['cpu.time'])
+            last = self.samples.get(uuid)
+            if last is None or now <= last[0]:
+                continue  # Usage is known from the second round
+            used = (stats['cpu.time'] - last[1]) / 1e9 / (now - last[0])
+            if uuid not in self.created:
+                # Not tuned yet, the shares are the create-time ones
+                try:
+                    self.created[uuid] = get(dom).get('cpu_shares', 100)
+                except libvirt.libvirtError:
+                    continue  # Stopped meanwhile
+            domains.append({'name': name, 'dom': dom, 'uuid': uuid,
+                            'vcpus': stats.get('vcpu.current', 1),
+                            'used': max(0.0, used),
+                            'class': get_class(dom),
+                            'created': self.created[uuid]})
+        self.samples = samples
+        return domains
+
+    def tune(self, domains, wanted, capping):
+        """ Apply the changed parameters of wanted. """
+        for domain in domains:
+            uuid = domain['uuid']
+            params = wanted[domain['name']]
+            applied = self.applied.get(uuid, {})
+            if capping and 'vcpu_quota' in applied and \
+                    'vcpu_quota' not in params:
+                params = dict(applied, cpu_shares=params['cpu_shares'])
+            elif 'vcpu_quota' in applied and 'vcpu_quota' not in params:
+                params = dict(params, **UNLIMITED)
+            changed = dict((key, value) for key, value in params.items()
+                           if applied.get(key) != value)
+            if not changed:
+                continue
+            try:
+                apply(domain['dom'], changed)
+            except libvirt.libvirtError as e:
+                logging.warning("Unable to tune CPU of %s: %s",
+                                domain['name'], e.get_error_message())
+                continue
+            logging.info("CPU tune of %s (%s, using %.2f CPUs): %s",
+                         domain['name'], domain['class'], domain['used'],
+                         changed)
+            if params.get('vcpu_quota', -1) == -1:
+                params = {'cpu_shares': params['cpu_shares']}
+            self.applied[uuid] = params
+
+    def run_once(self):
+        now = time.time()
+        held = holds()
+        domains = [d for d in self.collect(now) if d['name'] not in held]
+        used = sum(d['used'] for d in domains)
+        contended = used > CPU_TUNE_CONTENTION * NUM_CPUS
+        self.calm = 0 if contended else self.calm + 1
+        # Keep the caps until the host stays calm for a while
+        capping = contended or self.calm < CPU_TUNE_RELAX
+        wanted = plan(domains, NUM_CPUS, contended)
+        try:
+            self.tune(domains, wanted, capping)
+        finally:
+            for cache in (self.applied, self.created):
+                for uuid in set(cache) - set(self.samples):
+                    del cache[uuid]
+            hostlock.save('cputune-applied', {'applied': self.applied,
+                                              'created': self.created})
+        hostlock.save('cputune', {
+            'time': now, 'used': used, 'cpus': NUM_CPUS,
+            'contended': contended, 'held': sorted(held),
+            'domains': dict((d['name'], {
+                'class': d['class'], 'vcpus': d['vcpus'], 'used': d['used'],
+                'params': self.applied.get(d['uuid'], {})})
+                for d in domains)})
+
+
+def info():
+    """ Return the state of the last policy round. """
+    return hostlock.load('cputune', {})
+
+
+def _run():
+    while not hostlock.leader('cputune'):
+        time.sleep(CPU_TUNE_INTERVAL)
+    policy = None
+    while True:
+        try:
+            if policy is None:
+                policy = Policy(libvirt.open(
+                    os.getenv('LIBVIRT_URI', 'qemu:///system')))
+            policy.run_once()
+        except Exception:
+            logging.exception("CPU tune round failed")
+            policy = None
+        time.sleep(CPU_TUNE_INTERVAL)
+
+
+def start(**kw):
+    """ Start the CPU tune policy thread of this process. """
+    thread = threading.Thread(target=_run, name='cputune')
+    thread.daemon = True
+    thread.start()
+
+
+def install(app):
+    """ Run the policy in the worker pool processes (one leads). """
+    if not enabled:
+        return
+    from celery.signals import worker_process_init
+    worker_process_init.connect(start, weak=False,
+                                dispatch_uid='cputune_process_init')
@@ -0,0 +1,96 @@
+""" Domain operations shared by vmdriver and aiodriver.
+
+Nothing here imports celery: the create, migrate and device steps are
+run by the vmdriver tasks and, on its thread pool, by the asyncio
+driver (see aiodriver.py), so both behave the same.
+
+"""
+import json
+import libvirt
+import logging
+import os
+import socket
+
+import lxml.etree as ET
+
+import console
+from vm import VMNetwork
+
+CONTEXT_SERVER = ('127.0.0.1', 1235)
+SERIAL_DIR = '/var/lib/libvirt/serial'
+
+
+def prepare(vm):
+    """ Set the hypervisor type and the console log of vm. """
+    vm.vm_type = os.getenv("HYPERVISOR_TYPE", "test")
+    if console.enabled:
+        vm.console_log = console.log_path(vm.name)
+    if vm.vm_type == "test":
+        vm.arch = "i686"
+
+
+def create_paused(conn, xml, vm_type, timer):
+    """ Create the domain of xml paused and return it.
+
+    The phases are timed with timer (a metrics.PhaseTimer). The test
+    driver has no VIR_DOMAIN_START_PAUSED, its domain is suspended
+    after the start.
+
+    """
+    if vm_type == "test":
+        with timer.phase('create_xml'):
+            domain = conn.createXML(xml, libvirt.VIR_DOMAIN_NONE)
+        with timer.phase('suspend'):
+            domain.suspend()
+    else:
+        with timer.phase('create_xml'):
+            domain = conn.createXML(xml, libvirt.VIR_DOMAIN_START_PAUSED)
+    return domain
+
+
+def notify_context(boot_token, domain_name):
+    """ Send the boot token and serial socket to the context server. """
+    try:
+        sock = socket.create_connection(CONTEXT_SERVER, 3)
+        data = {'boot_token': boot_token,
+                'socket': os.path.join(SERIAL_DIR, domain_name)}
+        sock.sendall(json.dumps(data).encode('utf-8'))
+        sock.close()
+    except socket.error:
+        logging.error('Unable to connect to context server')
+
+
+def migrate(domain, name, host, live=False, bandwidth=0):
+    """ Migrate domain to host as name, bandwidth in MiB/s. """
+    flags = libvirt.VIR_MIGRATE_PEER2PEER
+    if live:
+        flags = flags | libvirt.VIR_MIGRATE_LIVE
+    domain.migrateToURI(
+        duri="qemu+tcp://" + host + "/system",
+        flags=flags,
+        dname=name,
+        bandwidth=bandwidth)
+
+
+def network_xml(domain, net):
+    """ Return the interface xml of the net descriptor for domain.
+
+    Multiqueue is sized from the vcpu count of the domain the same way
+    as at create time.
+
+    """
+    return VMNetwork.deserialize(net).dump_xml(vcpu=domain.info()[3])
+
+
+def check_detached(domain, source):
+    """ Raise if the disk of source is still in the domain xml.
+
+    Libvirt does not report a failed detach.
+
+    """
+    devices = ET.fromstring(domain.XMLDesc()).find('devices')
+    for d in devices.findall("disk"):
+        if source in list(d.find('source').attrib.values())[0]:
+            raise Exception("Disk could not been detached. "
+                            "Check if hot plug support is "
+                            "enabled (acpiphp module on Linux).")
@@ -0,0 +1,86 @@
+""" Parsing and rate computation for libvirt bulk domain statistics. """
+import hostlock
+from metrics import clock
+
+NET_KEYS = {'rx.bytes': 'rx_bytes', 'rx.pkts': 'rx_packets',
+            'rx.errs': 'rx_errs', 'rx.drop': 'rx_drop',
+            'tx.bytes': 'tx_bytes', 'tx.pkts': 'tx_packets',
+            'tx.errs': 'tx_errs', 'tx.drop': 'tx_drop'}
+
+BLOCK_KEYS = {'rd.reqs': 'rd_req', 'rd.bytes': 'rd_bytes',
+              'rd.times': 'rd_times', 'wr.reqs': 'wr_req',
+              'wr.bytes': 'wr_bytes', 'wr.times': 'wr_times',
+              'fl.reqs': 'fl_req', 'fl.times': 'fl_times',
+              'allocation': 'allocation', 'capacity': 'capacity',
+              'physical': 'physical'}
+
+# Gauges have no meaningful rate
+GAUGES = ('allocation', 'capacity', 'physical')
+
+
+def parse_devices(stats, group, keys):
+    """ Return device name -> counters of a getAllDomainStats record.
+
+    group is 'net' or 'block', keys maps libvirt to returned names.
+
+    """
+    devices = {}
+    for i in range(stats.get('%s.count' % group, 0)):
+        prefix = '%s.%d.' % (group, i)
+        name = stats.get(prefix + 'name')
+        if name is None:
+            continue
+        devices[name] = dict((new, stats[prefix + old])
+                             for old, new in keys.items()
+                             if prefix + old in stats)
+    return devices
+
+
+class RateCache(object):
+
+    """ Previous samples of counters to compute per second rates.
+
+    The samples are kept in the RUN_DIR state file name, shared by the
+    worker processes of the host: the rates are averaged since the
+    previous call served by any of them.
+
+    """
+
+    def __init__(self, name='domstats'):
+        self.name = name
+
+    def rates(self, samples, now=None):
+        """ Store samples and return their rates per second.
+
+        samples maps string keys to counters and replaces all the
+        stored samples. Return key -> rates, None for a key without a
+        previous sample or with a counter that went backwards (e.g. the
+        domain was restarted).
+
+        """
+        if now is None:
+            now = clock()
+        with hostlock.locked(self.name):
+            previous = hostlock.load(self.name, {})
+            hostlock.save(self.name, dict(
+                (key, [now, counters]) for key, counters in samples.items()))
+        return dict((key, _rates(previous.get(key), now, counters))
+                    for key, counters in samples.items())
+
+
+def _rates(previous, now, counters):
+    if previous is None or now <= previous[0]:
+        return None
+    elapsed = now - previous[0]
+    rates = {}
+    for name, value in counters.items():
+        if name in GAUGES or name not in previous[1]:
+            continue
+        delta = value - previous[1][name]
+        if delta < 0:
+            return None
+        rates[name] = delta / elapsed
+    return rates
+
+
+rate_cache = RateCache()
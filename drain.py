@@ -0,0 +1,209 @@
+""" Evacuation of a host with concurrent, ordered live migrations.
+
+Drain migrates the running domains to the target hosts with at most
+max_parallel migrations at a time. The bandwidth budget (MiB/s, 0 is
+unlimited) is shared evenly by the running migrations and rebalanced
+with migrateSetMaxSpeed whenever one starts or ends. A failed domain
+is retried on the next target up to retries times before it is
+reported as failed.
+
+"""
+import logging
+import threading
+import time
+
+import libvirt
+
+DRAIN_POLL_INTERVAL = 2
+
+# order name -> sort key of a candidate dict (name, memory, vcpus)
+ORDERS = {
+    'memory': lambda c: c['memory'],
+    'largest': lambda c: -c['memory'],
+    'vcpus': lambda c: (c['vcpus'], c['memory']),
+    'name': lambda c: c['name'],
+    'dirty_rate': lambda c: (c['dirty_rate'] is None, c['dirty_rate'],
+                             c['memory']),
+}
+
+
+class Drain(object):
+
+    """ One drain job, run() blocks until every domain is handled.
+
+    migrate(domain, name, host, live, bandwidth, dirty_rate) performs
+    a single migration and raises on failure. sample(conn, domains)
+    returns the dirty rates by domain name for the dirty_rate order.
+
+    """
+
+    def __init__(self, conn, targets, migrate, max_parallel=2,
+                 bandwidth_budget=0, order='memory', live=True,
+                 retries=1, sample=None):
+        if not targets:
+            raise Exception("No target host given")
+        if order not in ORDERS:
+            raise Exception("Unknown drain order: %s" % order)
+        self.conn = conn
+        self.targets = list(targets)
+        self.migrate = migrate
+        self.max_parallel = max(1, int(max_parallel))
+        self.bandwidth_budget = int(bandwidth_budget)
+        self.order = order
+        self.live = live
+        self.retries = int(retries)
+        self.sample = sample
+        self.lock = threading.Lock()
+        self.active = {}
+        self.queue = []
+        self.migrated = []
+        self.failed = {}
+        self.load = dict((target, 0) for target in self.targets)
+        self.total = 0
+        self.stopped = False
+
+    def candidates(self, resolve):
+        """ Return the running domains to move in drain order.
+
+        resolve maps libvirt names to VM names (None to skip).
+
+        """
+        found = []
+        for i in self.conn.listDomainsID():
+            try:
+                domain = self.conn.lookupByID(i)
+                name = resolve(domain.name())
+                if name is None:
+                    continue
+                state, maxmem, memory, vcpus, cputime = domain.info()
+            except libvirt.libvirtError:
+                continue  # Stopped meanwhile
+            found.append({'name': name, 'domain': domain,
+                          'memory': memory, 'vcpus': vcpus,
+                          'dirty_rate': None, 'attempts': 0, 'tried': []})
+        if self.order == 'dirty_rate' and self.sample is not None:
+            # Unmeasured domains go last
+            rates = self.sample(self.conn, [c['domain'] for c in found])
+            for candidate in found:
+                candidate['dirty_rate'] = rates.get(
+                    candidate['domain'].name())
+        return sorted(found, key=ORDERS[self.order])
+
+    def share(self):
+        """ Bandwidth of one migration in MiB/s (0 is unlimited). """
+        if not self.bandwidth_budget:
+            return 0
+        return max(1, self.bandwidth_budget // max(1, len(self.active)))
+
+    def _rebalance(self):
+        speed = self.share()
+        if not speed:
+            return
+        for name, entry in list(self.active.items()):
+            try:
+                entry['domain'].migrateSetMaxSpeed(speed, 0)
+            except libvirt.libvirtError as e:
+                logging.debug("Unable to set migration speed of %s: %s",
+                              name, e.get_error_message())
+
+    def _target(self, candidate):
+        """ The least loaded target not tried yet for candidate. """
+        untried = [t for t in self.targets if t not in candidate['tried']]
+        return min(untried or self.targets,
+                   key=lambda t: (self.load[t], self.targets.index(t)))
+
+    def _worker(self, candidate, host, speed):
+        name = candidate['name']
+        error = None
+        try:
+            self.migrate(candidate['domain'], name, host, self.live, speed,
+                         candidate['dirty_rate'])
+        except Exception as e:
+            error = e
+        with self.lock:
+            self.active.pop(name, None)
+            self.load[host] -= 1
+            if error is None:
+                self.migrated.append({'name': name, 'target': host,
+                                      'attempts': candidate['attempts']})
+                logging.info("Drain: %s migrated to %s", name, host)
+            elif self.stopped:
+                self.failed[name] = 'aborted'
+            elif candidate['attempts'] <= self.retries:
+                logging.warning("Drain: migration of %s to %s failed, "
+                                "retrying: %s", name, host, error)
+                self.queue.append(candidate)
+            else:
+                self.failed[name] = str(error)
+                logging.error("Drain: migration of %s failed: %s",
+                              name, error)
+            self._rebalance()
+
+    def _start(self, candidate):
+        host = self._target(candidate)
+        candidate['attempts'] += 1
+        candidate['tried'].append(host)
+        self.load[host] += 1
+        self.active[candidate['name']] = {
+            'domain': candidate['domain'], 'target': host,
+            'started': time.time()}
+        speed = self.share()
+        thread = threading.Thread(target=self._worker,
+                                  name='drain-%s' % candidate['name'],
+                                  args=(candidate, host, speed))
+        thread.daemon = True
+        thread.start()
+        self._rebalance()
+
+    def progress(self):
+        """ Overall and per migration progress as dict. """
+        active = {}
+        for name, entry in list(self.active.items()):
+            item = {'target': entry['target'],
+                    'seconds': time.time() - entry['started']}
+            try:
+                info = entry['domain'].jobInfo()
+                # total, processed and remaining memory bytes
+                total, processed = info[6], info[7]
+                item['percent'] = (100.0 * processed / total
+                                   if total else 0.0)
+                item['remaining'] = info[8]
+            except libvirt.libvirtError:
+                pass
+            active[name] = item
+        done = len(self.migrated) + len(self.failed)
+        return {'total': self.total, 'migrated': len(self.migrated),
+                'failed': len(self.failed), 'queued': len(self.queue),
+                'active': active,
+                'percent': 100.0 * done / self.total if self.total else 100.0}
+
+    def run(self, resolve, report=None, aborted=None):
+        """ Drain the host and return the result dict.
+
+        report(progress) is called every DRAIN_POLL_INTERVAL seconds,
+        aborted() stops scheduling and cancels the running migrations.
+
+        """
+        self.queue = self.candidates(resolve)
+        self.total = len(self.queue)
+        while True:
+            with self.lock:
+                if (not self.stopped and aborted is not None and
+                        aborted()):
+                    self.stopped = True
+                    self.queue = []
+                    for name, entry in list(self.active.items()):
+                        try:
+                            entry['domain'].abortJob()
+                        except libvirt.libvirtError:
+                            pass
+                while self.queue and len(self.active) < self.max_parallel:
+                    self._start(self.queue.pop(0))
+                finished = not self.queue and not self.active
+            if report is not None:
+                report(self.progress())
+            if finished:
+                break
+            time.sleep(DRAIN_POLL_INTERVAL)
+        return {'migrated': self.migrated, 'failed': self.failed,
+                'aborted': self.stopped}
@@ -0,0 +1,202 @@
+""" Publish domain events to AMQP so the manager need not poll.
+
+Enabled with EVENT_PUBLISH. The leader worker process of the host
+follows the lifecycle, reboot, watchdog, I/O error and balloon events
+of libvirt and publishes them as JSON messages on the fanout exchange
+EVENT_EXCHANGE.<host> (host is the first part of the worker hostname).
+
+Events of the same domain and kind arriving within EVENT_COALESCE
+seconds are coalesced into one message carrying the latest values and
+the number of events merged. Every message has the publisher epoch and
+a sequence number increasing by one within the epoch; a gap (events
+dropped after EVENT_MAX_PENDING) or a new epoch means the subscriber
+has to resync with list_domains_info.
+
+Message example:
+    {"host": "node1", "epoch": "1476870000-4242", "seq": 17,
+     "name": "vm-12", "type": "lifecycle", "event": "STOPPED",
+     "detail": 2, "time": 1476870001.25, "count": 1}
+
+"""
+import logging
+import os
+import threading
+import time
+
+import libvirt
+
+import events
+import hostlock
+import warmpool
+
+enabled = os.getenv('EVENT_PUBLISH', 'False').lower() in (
+    "true", "yes", "y", "t")
+EVENT_EXCHANGE = os.getenv('EVENT_EXCHANGE', 'vmevents')
+EVENT_COALESCE = float(os.getenv('EVENT_COALESCE', '0.5'))
+EVENT_MAX_PENDING = int(os.getenv('EVENT_MAX_PENDING', '10000'))
+
+LIFECYCLE_EVENTS = {0: 'DEFINED', 1: 'UNDEFINED', 2: 'STARTED',
+                    3: 'SUSPENDED', 4: 'RESUMED', 5: 'STOPPED',
+                    6: 'SHUTDOWN', 7: 'PMSUSPENDED', 8: 'CRASHED'}
+WATCHDOG_ACTIONS = {0: 'NONE', 1: 'PAUSE', 2: 'RESET', 3: 'POWEROFF',
+                    4: 'SHUTDOWN', 5: 'DEBUG', 6: 'INJECTNMI'}
+IO_ERROR_ACTIONS = {0: 'NONE', 1: 'PAUSE', 2: 'REPORT'}
+
+
+def host_name(hostname):
+    """ Return the host part of a hostname.module.priority name. """
+    parts = hostname.rsplit('.', 2)
+    return parts[0] if len(parts) == 3 else hostname.split('.')[0]
+
+
+class Publisher(object):
+
+    """ Coalesce events and publish them from one thread. """
+
+    def __init__(self, amqp_uri, host):
+        self.amqp_uri = amqp_uri
+        self.host = host
+        self.exchange_name = '%s.%s' % (EVENT_EXCHANGE, host)
+        self.epoch = '%d-%d' % (time.time(), os.getpid())
+        self.seq = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.connection = None
+        self.producer = None
+
+    def push(self, dom, kind, key=None, **fields):
+        """ Queue an event of dom, merging it with a pending one. """
+        name = warmpool.alias_of(dom.name())
+        if name is None:
+            return  # unclaimed warm pool domain
+        with self.lock:
+            entry = self.pending.pop((name, kind, key), None)
+            count = entry['count'] + 1 if entry else 1
+            if len(self.pending) >= EVENT_MAX_PENDING:
+                dropped = min(self.pending, key=lambda k:
+                              self.pending[k]['time'])
+                del self.pending[dropped]
+                # Leave a sequence gap so subscribers resync
+                self.dropped += 1
+                logging.warning("Event buffer full, dropped %s", dropped)
+            fields.update(name=name, type=kind, time=time.time(),
+                          count=count)
+            self.pending[(name, kind, key)] = fields
+
+    def on_lifecycle(self, dom, event, detail):
+        self.push(dom, 'lifecycle', event=LIFECYCLE_EVENTS.get(event, event),
+                  detail=detail)
+
+    def on_reboot(self, dom):
+        self.push(dom, 'reboot')
+
+    def on_watchdog(self, dom, action):
+        self.push(dom, 'watchdog',
+                  action=WATCHDOG_ACTIONS.get(action, action))
+
+    def on_io_error(self, dom, src_path, dev_alias, action, reason):
+        self.push(dom, 'io_error', key=dev_alias, path=src_path,
+                  device=dev_alias, reason=reason,
+                  action=IO_ERROR_ACTIONS.get(action, action))
+
+    def on_balloon(self, dom, actual):
+        self.push(dom, 'balloon', actual=actual)
+
+    def subscribe(self):
+        for event_id, callback in (
+                (libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self.on_lifecycle),
+                (libvirt.VIR_DOMAIN_EVENT_ID_REBOOT, self.on_reboot),
+                (libvirt.VIR_DOMAIN_EVENT_ID_WATCHDOG, self.on_watchdog),
+                (libvirt.VIR_DOMAIN_EVENT_ID_IO_ERROR_REASON,
+                 self.on_io_error),
+                (libvirt.VIR_DOMAIN_EVENT_ID_BALLOON_CHANGE,
+                 self.on_balloon)):
+            events.subscribe(event_id, callback)
+
+    def _connect(self):
+        from kombu import Connection, Exchange, Producer
+        self.connection = Connection(self.amqp_uri)
+        exchange = Exchange(self.exchange_name, type='fanout',
+                            durable=False)
+        self.producer = Producer(self.connection.channel(),
+                                 exchange=exchange, serializer='json')
+        exchange(self.producer.channel).declare()
+
+    def _disconnect(self):
+        if self.connection is not None:
+            try:
+                self.connection.release()
+            except Exception:
+                pass
+        self.connection = self.producer = None
+
+    def flush(self):
+        """ Publish the pending events oldest first. """
+        with self.lock:
+            batch = sorted(self.pending.items(),
+                           key=lambda item: item[1]['time'])
+            self.pending = {}
+            self.seq += self.dropped
+            self.dropped = 0
+        sent = 0
+        try:
+            if batch and self.producer is None:
+                self._connect()
+            for key, message in batch:
+                message.update(host=self.host, epoch=self.epoch,
+                               seq=self.seq + 1)
+                self.producer.publish(message, routing_key='')
+                self.seq += 1
+                sent += 1
+        except Exception:
+            logging.exception("Unable to publish domain events")
+            self._disconnect()
+            # Put back what was not sent unless a newer event arrived
+            with self.lock:
+                for key, message in batch[sent:]:
+                    self.pending.setdefault(key, message)
+        if sent:
+            hostlock.save('eventpub', self.info())
+        return sent
+
+    def info(self):
+        return {'exchange': self.exchange_name, 'epoch': self.epoch,
+                'seq': self.seq}
+
+    def run(self):
+        while True:
+            time.sleep(EVENT_COALESCE)
+            self.flush()
+
+
+def info():
+    """ Return the exchange, epoch and last sequence number published. """
+    return hostlock.load('eventpub', {})
+
+
+def _run(amqp_uri, host):
+    while not hostlock.leader('eventpub'):
+        time.sleep(10)
+    publisher = Publisher(amqp_uri, host)
+    events.start()
+    publisher.subscribe()
+    hostlock.save('eventpub', publisher.info())
+    logging.info("Publishing domain events to %s", publisher.exchange_name)
+    publisher.run()
+
+
+def install(app, hostname):
+    """ Publish from the worker pool processes (one leads). """
+    if not enabled:
+        return
+    from celery.signals import worker_process_init
+
+    def start(**kw):
+        thread = threading.Thread(
+            target=_run, name='eventpub',
+            args=(app.conf.BROKER_URL, host_name(hostname)))
+        thread.daemon = True
+        thread.start()
+    worker_process_init.connect(start, weak=False,
+                                dispatch_uid='eventpub_process_init')
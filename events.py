@@ -0,0 +1,132 @@
+""" libvirt event loop shared by the worker subsystems.
+
+A worker process runs at most one event loop thread with its own
+read-only connection (LIBVIRT_URI). Subsystems subscribe callbacks
+per event id; callbacks are called with the domain and the event
+specific arguments (without the libvirt opaque value). Events are lost
+while the connection is down, so subsystems keeping state rebuild it
+from on_connect callbacks.
+
+"""
+import libvirt
+import logging
+import os
+import threading
+import time
+
+EVENT_URI = os.getenv('LIBVIRT_URI', 'qemu:///system')
+RECONNECT_INTERVAL = 5
+
+_lock = threading.RLock()
+_callbacks = {}
+_connect_callbacks = []
+_registered = {}
+_connection = None
+_pid = None
+_impl_registered = False
+
+
+def _dispatch(conn, dom, *args):
+    """ Call the subscribers of the event id passed as opaque. """
+    event_id = args[-1]
+    for callback in list(_callbacks.get(event_id, [])):
+        try:
+            callback(dom, *args[:-1])
+        except Exception:
+            logging.exception("Unhandled exception in event callback %s",
+                              callback)
+
+
+def _register(event_id):
+    _registered[event_id] = _connection.domainEventRegisterAny(
+        None, event_id, _dispatch, event_id)
+
+
+def _close_callback(conn, reason, opaque):
+    global _connection
+    logging.warning("Event connection closed (reason %d)", reason)
+    with _lock:
+        _connection = None
+
+
+def _open():
+    global _connection
+    _connection = libvirt.openReadOnly(EVENT_URI)
+    _connection.setKeepAlive(5, 3)
+    _connection.registerCloseCallback(_close_callback, None)
+    _registered.clear()
+    for event_id in _callbacks:
+        _register(event_id)
+    logging.info("Event connection established to %s", EVENT_URI)
+
+
+def _connected(conn):
+    for callback in list(_connect_callbacks):
+        try:
+            callback(conn)
+        except Exception:
+            logging.exception("Unhandled exception in connect callback %s",
+                              callback)
+
+
+def _run_loop():
+    while True:
+        reconnected = None
+        with _lock:
+            if _connection is None:
+                try:
+                    _open()
+                    reconnected = _connection
+                except libvirt.libvirtError as e:
+                    logging.error("Unable to open event connection: %s",
+                                  e.get_error_message())
+        if reconnected is not None:
+            # Events were lost while disconnected
+            _connected(reconnected)
+        if _connection is None:
+            time.sleep(RECONNECT_INTERVAL)
+            continue
+        libvirt.virEventRunDefaultImpl()
+
+
+def start():
+    """ Start the event loop of this process if it is not running.
+
+    Return the event connection.
+
+    """
+    global _pid, _impl_registered
+    with _lock:
+        if _pid == os.getpid():
+            return _connection
+        if not _impl_registered:
+            libvirt.virEventRegisterDefaultImpl()
+            _impl_registered = True
+        _pid = os.getpid()
+        _open()
+        thread = threading.Thread(target=_run_loop, name='libvirt-events')
+        thread.daemon = True
+        thread.start()
+        return _connection
+
+
+def connection():
+    """ Return the event connection (started on demand). """
+    return start()
+
+
+def on_connect(callback):
+    """ Call callback(connection) now and after every reconnection. """
+    conn = start()
+    with _lock:
+        _connect_callbacks.append(callback)
+    callback(conn)
+
+
+def subscribe(event_id, callback):
+    """ Call callback(domain, *event_args) on every event_id event. """
+    with _lock:
+        _callbacks.setdefault(event_id, []).append(callback)
+        if (_connection is not None and _pid == os.getpid() and
+                event_id not in _registered):
+            _register(event_id)
@@ -0,0 +1,169 @@
+""" Multi-table OpenFlow pipeline against MAC and IP spoofing.
+
+Enabled with FLOW_PIPELINE, netdriver installs the port rules as a
+pipeline instead of 6-8 table 0 flows per port:
+
+table 0  classification: in_port -> reg0 = port, continue in table 1
+table 1  MAC validation: reg0 + dl_src -> table 2 (managed ports) or
+         normal (unmanaged ports), anything else is dropped
+table 2  IP validation: DHCP server replies are dropped and DHCP client
+         requests allowed for every port, then reg0 + source address
+         (IPv4 and ARP, IPv6 and neighbor advertisement) -> normal,
+         anything else is dropped
+
+The rules shared by every port are installed once per bridge, so a port
+costs one flow in table 0, one in table 1 and two per address in table
+2. Ports may have several IPv4 and IPv6 addresses (list or comma
+separated string). Every port flow carries the cookie of the port, so
+a port is removed with one del-flows and installed with one add-flows.
+
+Run this module to compare the flow counts at 1k-10k ports.
+
+"""
+import os
+
+enabled = os.getenv('FLOW_PIPELINE', 'False').lower() in (
+    "true", "yes", "y", "t")
+
+CLASSIFY_TABLE = 0
+MAC_TABLE = 1
+IP_TABLE = 2
+COOKIE_BASE = 0xc12c1e0000000000
+LINKLOCAL_SUBNET = "fe80::/64"
+ICMPv6_NA = 136  # The type of IPv6 Neighbor Advertisement
+
+
+def addresses(value):
+    """ Return the list of addresses of a VMNetwork ipv4/ipv6 value. """
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        items = value
+    else:
+        items = str(value).split(',')
+    return [item.strip() for item in items
+            if item and item.strip() and item.strip() != "None"]
+
+
+def cookie(port_number):
+    """ Return the cookie of the flows of port_number (0 is global). """
+    return COOKIE_BASE | int(port_number)
+
+
+def cookie_match(port_number):
+    """ Return the del-flows match of every flow of port_number. """
+    return "cookie=0x%x/-1" % cookie(port_number)
+
+
+def _flow(table, priority, match, actions, port_number=0):
+    return "cookie=0x%x,table=%d,priority=%d,%s%sactions=%s" % (
+        cookie(port_number), table, priority, match,
+        "," if match else "", actions)
+
+
+def global_flows():
+    """ Return the flows shared by every port of a bridge. """
+    return [
+        # Spoofed source MAC
+        _flow(MAC_TABLE, 0, "", "drop"),
+        # Guests must not act as DHCP server
+        _flow(IP_TABLE, 300, "udp,tp_dst=68", "drop"),
+        # MAC is validated already, the address is requested
+        _flow(IP_TABLE, 250, "udp,tp_dst=67", "normal"),
+        # Not allowed traffic
+        _flow(IP_TABLE, 0, "", "drop"),
+    ]
+
+
+def port_flows(port_number, mac, managed=True, ipv4=None, ipv6=None):
+    """ Return the flows of one port. """
+    port_number = int(port_number)
+    flows = [_flow(CLASSIFY_TABLE, 100, "in_port=%d" % port_number,
+                   "load:%d->NXM_NX_REG0[],resubmit(,%d)" % (
+                       port_number, MAC_TABLE), port_number)]
+    reg = "reg0=%d" % port_number
+    if not managed:
+        # Allow all traffic from source MAC address
+        flows.append(_flow(MAC_TABLE, 100, "%s,dl_src=%s" % (reg, mac),
+                           "normal", port_number))
+        return flows
+    flows.append(_flow(MAC_TABLE, 100, "%s,dl_src=%s" % (reg, mac),
+                       "resubmit(,%d)" % IP_TABLE, port_number))
+    for address in addresses(ipv4):
+        flows.append(_flow(IP_TABLE, 200, "%s,ip,nw_src=%s" % (
+            reg, address), "normal", port_number))
+        flows.append(_flow(IP_TABLE, 200, "%s,arp,arp_spa=%s" % (
+            reg, address), "normal", port_number))
+    for address in addresses(ipv6):
+        flows.append(_flow(IP_TABLE, 200, "%s,ipv6,ipv6_src=%s" % (
+            reg, address), "normal", port_number))
+        # Neighbor Advertisement from linklocal address for the address
+        flows.append(_flow(
+            IP_TABLE, 201, "%s,icmp6,ipv6_src=%s,icmp_type=%d,"
+            "nd_target=%s" % (reg, LINKLOCAL_SUBNET, ICMPv6_NA, address),
+            "normal", port_number))
+    return flows
+
+
+def network_flows(network, port_number):
+    """ Return the global and port flows of a VMNetwork. """
+    return global_flows() + port_flows(
+        port_number, network.mac, network.managed, network.ipv4,
+        network.ipv6)
+
+
+def legacy_flow_count(managed=True, ipv4=1, ipv6=1):
+    """ Return the table 0 flows of a port without the pipeline.
+
+    ipv4 and ipv6 are the address counts, the filters of netdriver
+    repeated per address.
+
+    """
+    if not managed:
+        return 2  # mac filter, deny
+    # dhcp ban, dhcp client, deny, ipv4 and arp, ipv6 and NA
+    return 3 + 2 * ipv4 + 2 * ipv6
+
+
+def _table(flow):
+    return int(flow.split('table=')[1].split(',')[0])
+
+
+def benchmark(sizes=(1000, 2000, 5000, 10000), per_port=(1, 1)):
+    """ Return the flow counts of the pipeline for sizes ports.
+
+    Every port has per_port (IPv4, IPv6) addresses.
+
+    """
+    import time
+    results = []
+    for size in sizes:
+        start = time.time()
+        flows = global_flows()
+        for port in range(1, size + 1):
+            ipv4 = ["10.%d.%d.%d" % (i, (port >> 8) & 255, port & 255)
+                    for i in range(per_port[0])]
+            ipv6 = ["2001:db8::%x:%x" % (port, i)
+                    for i in range(per_port[1])]
+            flows.extend(port_flows(
+                port, "02:00:%02x:%02x:%02x:00" % (
+                    port >> 16, (port >> 8) & 255, port & 255),
+                True, ipv4, ipv6))
+        seconds = time.time() - start
+        tables = {}
+        for flow in flows:
+            tables[_table(flow)] = tables.get(_table(flow), 0) + 1
+        legacy = size * legacy_flow_count(True, *per_port)
+        results.append({'ports': size, 'flows': len(flows),
+                        'tables': tables, 'legacy_table0': legacy,
+                        'compile_seconds': seconds})
+    return results
+
+
+if __name__ == '__main__':
+    for per_port in ((1, 1), (2, 2)):
+        print("IPv4/IPv6 addresses per port: %d/%d" % per_port)
+        for result in benchmark(per_port=per_port):
+            print("%(ports)6d ports: %(flows)7d flows %(tables)s, "
+                  "legacy table 0: %(legacy_table0)7d flows, "
+                  "compiled in %(compile_seconds).3fs" % result)
@@ -0,0 +1,107 @@
+""" Cached facts about the host parsed from the libvirt capabilities. """
+import logging
+import os
+import threading
+import lxml.etree as ET
+
+from psutil import NUM_CPUS, virtual_memory
+
+import placement
+
+_lock = threading.Lock()
+_facts = None
+
+
+def parse_capabilities(xml):
+    """ Parse the capabilities XML into a dict.
+
+    arch            host architecture
+    cpu_model       host cpu model
+    cpu_vendor      host cpu vendor
+    cpu_features    list of host cpu feature names
+    topology        dict of sockets, cores and threads
+    numa_cells      NUMA cells, see placement.parse_topology
+    hugepage_sizes  supported page sizes larger than the base page (KiB)
+    machine_types   guest arch -> list of supported machine types
+
+    """
+    root = ET.fromstring(xml)
+    cpu = root.find('host/cpu')
+    topology = cpu.find('topology') if cpu is not None else None
+    page_sizes = sorted(int(page.get('size')) for page in
+                        root.findall('host/cpu/pages'))
+    machine_types = {}
+    for arch in root.findall('guest/arch'):
+        machines = machine_types.setdefault(arch.get('name'), [])
+        for machine in arch.findall('machine') + arch.findall(
+                'domain/machine'):
+            for name in (machine.text, machine.get('canonical')):
+                if name and name not in machines:
+                    machines.append(name)
+    return {
+        'arch': root.findtext('host/cpu/arch'),
+        'cpu_model': root.findtext('host/cpu/model'),
+        'cpu_vendor': root.findtext('host/cpu/vendor'),
+        'cpu_features': [f.get('name')
+                         for f in root.findall('host/cpu/feature')],
+        'topology': dict((k, int(topology.get(k, 1)))
+                         for k in ('sockets', 'cores', 'threads'))
+        if topology is not None else None,
+        'numa_cells': placement.parse_topology(xml),
+        'hugepage_sizes': page_sizes[1:],
+        'machine_types': machine_types}
+
+
+def driver_version():
+    """ Return branch and commit of the driver git repository. """
+    from git import Repo
+    try:
+        repo = Repo(path=os.getcwd())
+        lc = repo.head.commit
+        return {'branch': repo.active_branch.name,
+                'commit': lc.hexsha,
+                'commit_text': lc.summary,
+                'is_dirty': repo.is_dirty()}
+    except Exception as e:
+        logging.exception("Unhandled exception: %s", e)
+        return None
+
+
+def refresh(conn):
+    """ Rebuild the cached facts from conn and return them. """
+    global _facts
+    facts = parse_capabilities(conn.getCapabilities())
+    facts['core_num'] = NUM_CPUS
+    facts['ram_size'] = virtual_memory().total
+    facts['driver_version'] = driver_version()
+    with _lock:
+        _facts = facts
+    logging.info("Host facts loaded: %s, %d NUMA cells",
+                 facts['arch'], len(facts['numa_cells']))
+    return facts
+
+
+def cached():
+    """ Return the cached facts or None if not loaded yet. """
+    return _facts
+
+
+def get(conn):
+    """ Return the cached facts, loading them from conn on first use. """
+    facts = _facts
+    if facts is None:
+        facts = refresh(conn)
+    return facts
+
+
+def install(app, loader):
+    """ Call loader() in every worker process at start. """
+    from celery.signals import worker_process_init
+
+    def load(**kw):
+        try:
+            loader()
+        except Exception:
+            logging.exception("Unable to load host facts")
+    worker_process_init.connect(load, weak=False,
+                                dispatch_uid='hostfacts_process_init')
@@ -0,0 +1,76 @@
+""" Host wide locks shared by the worker processes.
+
+Celery runs the tasks of a worker in several pool processes. Background
+subsystems elect a single leader process with leader(), and shared state
+files are guarded with locked(). Lock files live in RUN_DIR.
+
+"""
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+
+RUN_DIR = os.getenv('RUN_DIR', '/var/run/vmdriver')
+
+_held = {}
+
+
+def path(name):
+    """ Return the path of name inside RUN_DIR (created on demand). """
+    if not os.path.isdir(RUN_DIR):
+        try:
+            # Only the worker user may read the state or take the locks
+            os.makedirs(RUN_DIR, 0o700)
+        except OSError:
+            if not os.path.isdir(RUN_DIR):
+                raise
+    return os.path.join(RUN_DIR, name)
+
+
+def leader(name):
+    """ Try to become the leader for name on this host.
+
+    Return True if this process holds the leadership. It is kept
+    until the process exits.
+
+    """
+    held = _held.get(name)
+    if held is not None and held[0] == os.getpid():
+        return True
+    fd = os.open(path(name + '.leader'), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        os.close(fd)
+        return False
+    _held[name] = (os.getpid(), fd)
+    return True
+
+
+@contextmanager
+def locked(name):
+    """ Hold the exclusive host wide lock called name. """
+    fd = os.open(path(name + '.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def load(name, default=None):
+    """ Return the JSON state file name (call with the lock held). """
+    try:
+        with open(path(name + '.json')) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return default
+
+
+def save(name, state):
+    """ Atomically replace the JSON state file name. """
+    target = path(name + '.json')
+    tmp = '%s.%d' % (target, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.rename(tmp, target)
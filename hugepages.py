@@ -0,0 +1,95 @@
+""" Host hugepage accounting from sysfs. """
+import logging
+import os
+import re
+
+from placement import parse_cpuset
+
+SYSFS_NODE_PATH = '/sys/devices/system/node'
+MEMINFO_PATH = '/proc/meminfo'
+
+_size_re = re.compile(r'^hugepages-(\d+)kB$')
+
+
+def _read_int(path):
+    with open(path) as f:
+        return int(f.read().strip())
+
+
+def default_size():
+    """ Return the default hugepage size of the host in KiB. """
+    try:
+        with open(MEMINFO_PATH) as f:
+            for line in f:
+                if line.startswith('Hugepagesize:'):
+                    return int(line.split()[1])
+    except IOError:
+        logging.exception("Unable to read %s", MEMINFO_PATH)
+    return None
+
+
+def host_hugepages():
+    """ Return hugepage counters per NUMA node.
+
+    Return dict: node id -> page size in KiB -> dict with
+    total   number of reserved hugepages
+    free    number of free hugepages
+
+    """
+    nodes = {}
+    if not os.path.isdir(SYSFS_NODE_PATH):
+        return nodes
+    for node in os.listdir(SYSFS_NODE_PATH):
+        if not node.startswith('node') or not node[4:].isdigit():
+            continue
+        path = os.path.join(SYSFS_NODE_PATH, node, 'hugepages')
+        if not os.path.isdir(path):
+            continue
+        sizes = {}
+        for entry in os.listdir(path):
+            match = _size_re.match(entry)
+            if match is None:
+                continue
+            try:
+                sizes[int(match.group(1))] = {
+                    'total': _read_int(os.path.join(path, entry,
+                                                    'nr_hugepages')),
+                    'free': _read_int(os.path.join(path, entry,
+                                                   'free_hugepages'))}
+            except (IOError, ValueError):
+                logging.exception("Unable to read hugepages of %s", node)
+        nodes[int(node[4:])] = sizes
+    return nodes
+
+
+def free_pages(size, nodeset=None, nodes=None):
+    """ Return the number of free pages of size KiB on nodeset.
+
+    nodeset is a libvirt style node list, None means every node.
+
+    """
+    if nodes is None:
+        nodes = host_hugepages()
+    wanted = parse_cpuset(nodeset) if nodeset else set(nodes)
+    return sum(nodes[node].get(size, {}).get('free', 0)
+               for node in wanted if node in nodes)
+
+
+def pages_needed(memory, size):
+    """ Return the number of size KiB pages to back memory KiB. """
+    return (int(memory) + size - 1) // size
+
+
+def fits(memory, size=None, nodeset=None):
+    """ Check whether memory KiB can be backed by free hugepages.
+
+    Return tuple (fits, needed pages, free pages, page size).
+
+    """
+    if size is None:
+        size = default_size()
+    if not size:
+        return False, 0, 0, size
+    needed = pages_needed(memory, size)
+    free = free_pages(size, nodeset)
+    return needed <= free, needed, free, size
@@ -0,0 +1,263 @@
+""" Versioned table of the running domains for incremental listing.
+
+Enabled with INVENTORY. The leader worker process of the host keeps
+the table up to date from libvirt lifecycle and balloon events, with a
+full resync every INVENTORY_RESYNC seconds to cover missed events. The
+table is shared with the other worker processes as the 'inventory'
+state file (see hostlock.py).
+
+Every change increments the table version. Clients pass the token
+"<epoch>:<version>" of their previous reply and get only what changed
+since then. A token of an other epoch (the leader restarted) or older
+than the oldest kept tombstone gets a full reply. Changes of cputime
+alone do not count as change, so the cputime in the replies is the
+value read at the last counted change.
+
+The leader saves the table at least after every resync. A table older
+than INVENTORY_STALE seconds (the leader is gone) is not served.
+
+"""
+import logging
+import os
+import threading
+import time
+
+import libvirt
+
+import events
+import hostlock
+import warmpool
+
+enabled = os.getenv('INVENTORY', 'False').lower() in (
+    "true", "yes", "y", "t")
+INVENTORY_INTERVAL = float(os.getenv('INVENTORY_INTERVAL', '1'))
+INVENTORY_RESYNC = int(os.getenv('INVENTORY_RESYNC', '60'))
+INVENTORY_TOMBSTONES = int(os.getenv('INVENTORY_TOMBSTONES', '1000'))
+INVENTORY_STALE = int(os.getenv('INVENTORY_STALE',
+                                str(3 * INVENTORY_RESYNC)))
+
+# Keys of an entry compared to detect a change
+COMPARED_KEYS = ('state', 'maxmem', 'memory', 'virtcpunum')
+
+_cache = {'mtime': None, 'state': None}
+
+
+class Table(object):
+
+    """ The versioned domain table kept by the leader. """
+
+    def __init__(self, parse_info):
+        self.parse_info = parse_info
+        self.epoch = '%d-%d' % (time.time(), os.getpid())
+        self.version = 0
+        self.floor = 0
+        self.domains = {}
+        # libvirt name -> VM name of the entries, as the warm pool alias
+        # is gone when the stop is seen
+        self.names = {}
+        self.tombstones = {}
+        self.lock = threading.Lock()
+        self.dirty = set()
+
+    def _bump(self):
+        self.version += 1
+        return self.version
+
+    def put(self, name, info):
+        """ Add or update name, return True if the table changed. """
+        entry = self.domains.get(name)
+        if entry is not None and all(
+                entry['info'].get(k) == info.get(k) for k in COMPARED_KEYS):
+            return False
+        version = self._bump()
+        info = dict(info, name=name)
+        if entry is None:
+            self.tombstones.pop(name, None)
+            self.domains[name] = {'info': info, 'added': version,
+                                  'changed': version}
+        else:
+            entry.update(info=info, changed=version)
+        return True
+
+    def remove(self, name):
+        if self.domains.pop(name, None) is None:
+            return False
+        self.tombstones[name] = self._bump()
+        if len(self.tombstones) > INVENTORY_TOMBSTONES:
+            oldest = min(self.tombstones, key=self.tombstones.get)
+            self.floor = self.tombstones.pop(oldest)
+        return True
+
+    def _read(self, dom):
+        domain_name = dom.name()
+        name = warmpool.alias_of(domain_name)
+        if name is None:
+            return None, None  # Unclaimed warm pool domain
+        self.names[domain_name] = name
+        return name, self.parse_info(dom.info())
+
+    def refresh(self, conn, names):
+        """ Re-read the domains called names (libvirt names). """
+        changed = False
+        for domain_name in names:
+            try:
+                dom = conn.lookupByName(domain_name)
+                running = dom.isActive()
+            except libvirt.libvirtError as e:
+                if e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+                    raise
+                running = False
+            if running:
+                name, info = self._read(dom)
+                if name is not None:
+                    changed |= self.put(name, info)
+            else:
+                name = (self.names.pop(domain_name, None) or
+                        warmpool.alias_of(domain_name) or domain_name)
+                changed |= self.remove(name)
+        return changed
+
+    def resync(self, conn):
+        """ Compare the whole table with the running domains. """
+        changed = False
+        seen = set()
+        for i in conn.listDomainsID():
+            try:
+                name, info = self._read(conn.lookupByID(i))
+            except libvirt.libvirtError:
+                continue  # Stopped meanwhile
+            if name is not None:
+                seen.add(name)
+                changed |= self.put(name, info)
+        for name in set(self.domains) - seen:
+            changed |= self.remove(name)
+        self.names = dict((domain_name, name) for domain_name, name
+                          in self.names.items() if name in seen)
+        return changed
+
+    def mark(self, dom, *args):
+        """ Event callback: re-read dom at the next update. """
+        with self.lock:
+            self.dirty.add(dom.name())
+
+    def update(self, conn):
+        with self.lock:
+            names, self.dirty = self.dirty, set()
+        return self.refresh(conn, names)
+
+    def state(self):
+        return {'epoch': self.epoch, 'version': self.version,
+                'time': time.time(),
+                'floor': self.floor, 'domains': self.domains,
+                'tombstones': self.tombstones}
+
+
+def _load():
+    """ Return the shared table state, re-read only if it changed. """
+    try:
+        st = os.stat(hostlock.path('inventory.json'))
+    except OSError:
+        return None
+    # Saved by rename, so a new inode means new content
+    mtime = (st.st_ino, st.st_mtime)
+    if _cache['mtime'] != mtime:
+        _cache['state'] = hostlock.load('inventory')
+        _cache['mtime'] = mtime
+    return _cache['state']
+
+
+def token(state):
+    return '%s:%d' % (state['epoch'], state['version'])
+
+
+def since(since_token):
+    """ Return the changes since since_token as dict.
+
+    token       token of this reply
+    full        True if domains holds the whole table
+    domains     entries added or changed since the token
+    added       names added since the token
+    removed     names removed since the token
+
+    None is returned if no table is maintained on this host or the
+    table is stale.
+
+    """
+    state = _load()
+    if state is None:
+        return None
+    if time.time() - state.get('time', 0) > INVENTORY_STALE:
+        logging.warning("Inventory is stale, listing domains instead")
+        return None
+    version = None
+    if since_token:
+        epoch, _, value = since_token.rpartition(':')
+        if epoch == state['epoch'] and value.isdigit():
+            version = int(value)
+            if version < state['floor'] or version > state['version']:
+                version = None
+    entries = state['domains'].values()
+    if version is None:
+        return {'token': token(state), 'full': True,
+                'domains': [e['info'] for e in entries],
+                'added': [e['info']['name'] for e in entries],
+                'removed': []}
+    return {'token': token(state), 'full': False,
+            'domains': [e['info'] for e in entries
+                        if e['changed'] > version],
+            'added': [e['info']['name'] for e in entries
+                      if e['added'] > version],
+            'removed': [name for name, removed in
+                        state['tombstones'].items() if removed > version]}
+
+
+def _run(parse_info):
+    while not hostlock.leader('inventory'):
+        time.sleep(10)
+    table = Table(parse_info)
+    events.start()
+    for event_id in (libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                     libvirt.VIR_DOMAIN_EVENT_ID_BALLOON_CHANGE):
+        events.subscribe(event_id, table.mark)
+    last_conn = last_resync = None
+    while True:
+        try:
+            conn = events.connection()
+            if conn is None:
+                time.sleep(INVENTORY_INTERVAL)
+                continue
+            # Events may have been missed while reconnecting
+            if (conn is not last_conn or
+                    time.time() - last_resync > INVENTORY_RESYNC):
+                table.resync(conn)
+                # Saved even if unchanged, the snapshot time tells
+                # the readers the leader is alive
+                changed = True
+                last_conn, last_resync = conn, time.time()
+            else:
+                changed = table.update(conn)
+            if changed:
+                hostlock.save('inventory', table.state())
+        except Exception:
+            logging.exception("Inventory update failed")
+            last_conn = None
+        time.sleep(INVENTORY_INTERVAL)
+
+
+def install(app, parse_info):
+    """ Maintain the table from the worker pool processes (one leads).
+
+    parse_info converts virDomain.info() values to the entry dict.
+
+    """
+    if not enabled:
+        return
+    from celery.signals import worker_process_init
+
+    def start(**kw):
+        thread = threading.Thread(target=_run, name='inventory',
+                                  args=(parse_info, ))
+        thread.daemon = True
+        thread.start()
+    worker_process_init.connect(start, weak=False,
+                                dispatch_uid='inventory_process_init')
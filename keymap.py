@@ -0,0 +1,100 @@
+""" Text and chord notation to linux keycodes (US layout).
+
+The maps are built once from linuxkeys.py. Chords are written as
+key names joined with "+", e.g. "ctrl+alt+f2" or "shift+tab"; names
+are the linuxkeys constants without the KEY_ prefix (case insensitive)
+or one of the ALIASES.
+
+"""
+import linuxkeys
+
+# libvirt VIR_DOMAIN_SEND_KEY_MAX_KEYS
+MAX_KEYS = 16
+
+KEYS = dict((name[4:].lower(), value)
+            for name, value in vars(linuxkeys).items()
+            if name.startswith('KEY_'))
+
+ALIASES = {'ctrl': 'leftctrl', 'control': 'leftctrl',
+           'alt': 'leftalt', 'altgr': 'rightalt',
+           'shift': 'leftshift',
+           'super': 'leftmeta', 'meta': 'leftmeta', 'win': 'leftmeta',
+           'del': 'delete', 'ins': 'insert', 'return': 'enter',
+           'escape': 'esc', 'pgup': 'pageup', 'pgdn': 'pagedown',
+           'bksp': 'backspace'}
+
+_UNSHIFTED = {' ': 'space', '\n': 'enter', '\t': 'tab',
+              '-': 'minus', '=': 'equal', '[': 'leftbrace',
+              ']': 'rightbrace', ';': 'semicolon', "'": 'apostrophe',
+              '`': 'grave', '\\': 'backslash', ',': 'comma', '.': 'dot',
+              '/': 'slash'}
+_SHIFTED = {'!': '1', '@': '2', '#': '3', '$': '4', '%': '5', '^': '6',
+            '&': '7', '*': '8', '(': '9', ')': '0', '_': 'minus',
+            '+': 'equal', '{': 'leftbrace', '}': 'rightbrace',
+            ':': 'semicolon', '"': 'apostrophe', '~': 'grave',
+            '|': 'backslash', '<': 'comma', '>': 'dot', '?': 'slash'}
+
+
+def _build_char_map():
+    chars = {}
+    for c in 'abcdefghijklmnopqrstuvwxyz0123456789':
+        chars[c] = (False, KEYS[c])
+    for c in 'abcdefghijklmnopqrstuvwxyz':
+        chars[c.upper()] = (True, KEYS[c])
+    for c, name in _UNSHIFTED.items():
+        chars[c] = (False, KEYS[name])
+    for c, name in _SHIFTED.items():
+        chars[c] = (True, KEYS[name])
+    return chars
+
+
+# char -> (needs shift, keycode)
+CHARS = _build_char_map()
+
+
+def key_code(name):
+    """ Return the keycode of a key name or alias. """
+    name = name.strip().lower()
+    if name.startswith('key_'):
+        name = name[4:]
+    name = ALIASES.get(name, name)
+    try:
+        return KEYS[name]
+    except KeyError:
+        raise Exception("Unknown key name: %s" % name)
+
+
+def parse_chord(chord):
+    """ Return the keycodes of chord notation like "ctrl+alt+f2". """
+    if chord == '+':
+        return [KEYS['leftshift'], KEYS['equal']]
+    codes = [key_code(name) for name in chord.split('+')]
+    if len(codes) > MAX_KEYS:
+        raise Exception("Too many keys in chord: %s" % chord)
+    return codes
+
+
+def text_to_calls(text, pack=True):
+    """ Return the sendKey keycode lists needed to type text.
+
+    With pack consecutive characters sharing the shift state are sent
+    in one call (pressed in order, released together) as long as no
+    key repeats and the MAX_KEYS limit holds.
+
+    """
+    calls = []
+    current = None
+    shifted = None
+    for c in text:
+        try:
+            shift, code = CHARS[c]
+        except KeyError:
+            raise Exception("Character %r can not be typed" % c)
+        if (pack and current is not None and shift == shifted and
+                code not in current and len(current) < MAX_KEYS):
+            current.append(code)
+            continue
+        current = [KEYS['leftshift'], code] if shift else [code]
+        shifted = shift
+        calls.append(current)
+    return calls
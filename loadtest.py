@@ -0,0 +1,373 @@
+""" End-to-end load generator running without hypervisor and Open vSwitch.
+
+The vmdriver and netdriver task bodies are applied eagerly (in-memory
+broker) against libvirt's test:///default driver. Stub sudo, ovs-vsctl,
+ovs-ofctl and ip executables are put in front of PATH; they record every
+call and sleep --latency seconds. Example:
+
+    python loadtest.py --operations 500 --concurrency 8 \\
+        --mix create=4,resume=2,attach=2,shutdown=1,delete=2 \\
+        --mix port_create=1,port_delete=1
+
+Every mix reports its throughput, the latency percentiles of each
+operation, and the subprocess and libvirt call counts it caused.
+
+"""
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from argparse import ArgumentParser
+
+OPERATIONS = ('create', 'resume', 'attach', 'shutdown', 'delete',
+              'port_create', 'port_delete')
+DEFAULT_MIX = 'create=4,resume=2,attach=2,shutdown=1,delete=2,' \
+    'port_create=2,port_delete=2'
+PERCENTILES = (50, 90, 99)
+
+SUDO_STUB = '#!/bin/sh\nexec "$@"\n'
+COMMAND_STUB = '''#!/bin/sh
+echo "%(name)s $*" >> "$LOADTEST_CALL_LOG"
+sleep "${LOADTEST_LATENCY:-0}"
+%(output)s
+'''
+# command -> shell snippet producing its output
+COMMAND_OUTPUT = {'ovs-vsctl': 'if [ "$1" = "get" ]; then echo 1; fi',
+                  'ovs-ofctl': '',
+                  'ip': ''}
+
+
+def install_stubs(latency):
+    """ Create the stub executables and the environment of the drivers.
+
+    Must run before vmdriver and netdriver are imported, both read
+    their configuration at import time. Return the stub directory.
+
+    """
+    stub_dir = tempfile.mkdtemp(prefix='loadtest-')
+    stubs = dict((name, COMMAND_STUB % {'name': name, 'output': output})
+                 for name, output in COMMAND_OUTPUT.items())
+    stubs['sudo'] = SUDO_STUB
+    for name, content in stubs.items():
+        path = os.path.join(stub_dir, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        os.chmod(path, 0o755)
+    log = os.path.join(stub_dir, 'calls.log')
+    open(log, 'w').close()
+    os.environ.update({
+        'PATH': stub_dir + os.pathsep + os.environ.get('PATH', ''),
+        'LOADTEST_CALL_LOG': log,
+        'LOADTEST_LATENCY': str(latency),
+        'LIBVIRT_TEST': 'True',
+        'LIBVIRT_URI': 'test:///default',
+        'LIBVIRT_KEEPALIVE': 'True',
+        'HYPERVISOR_TYPE': 'test',
+        'AMQP_URI': 'memory://',
+        'NATIVE_OVS': 'False'})
+    # Metrics count the libvirt calls, no endpoint is started
+    os.environ.setdefault('METRICS_PORT', '9900')
+    return stub_dir
+
+
+def parse_mix(text):
+    """ Return {operation: weight} from "create=4,delete=2". """
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.strip().partition('=')
+        if name not in OPERATIONS:
+            raise Exception("Unknown operation: %s" % name)
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def percentile(values, p):
+    """ Nearest-rank percentile of sorted values. """
+    if not values:
+        return None
+    rank = max(int(math.ceil(p / 100.0 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def vm_desc(name):
+    return {'name': name, 'vcpu': 1, 'memory_max': 131072,
+            'memory': 131072, 'disk_list': [], 'network_list': []}
+
+
+def net_desc(name, index):
+    return {'name': name, 'bridge': 'cloud', 'vlan': 10,
+            'mac': '02:00:%02x:%02x:%02x:%02x' % (
+                (index >> 24) & 0xff, (index >> 16) & 0xff,
+                (index >> 8) & 0xff, index & 0xff),
+            'ipv4': '10.%d.%d.%d' % ((index >> 16) & 0xff,
+                                     (index >> 8) & 0xff, index & 0xff),
+            'ipv6': 'None', 'managed': True}
+
+
+class LoadGenerator(object):
+
+    """ Apply a weighted mix of operations from concurrent threads.
+
+    Operations needing an existing domain or port fall back to
+    create or port_create while there is none.
+
+    """
+
+    def __init__(self, vmdriver, netdriver, seed=None):
+        self.vmdriver = vmdriver
+        self.netdriver = netdriver
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counter = 0
+        self.domains = []
+        self.ports = []
+
+    def _next(self):
+        with self.lock:
+            self.counter += 1
+            return self.counter
+
+    def _take(self, pool, remove):
+        with self.lock:
+            if not pool:
+                return None
+            index = self.random.randrange(len(pool))
+            return pool.pop(index) if remove else pool[index]
+
+    def _apply(self, task, *args):
+        return task.apply(args=args).get()
+
+    def create(self):
+        name = 'load-%d' % self._next()
+        self._apply(self.vmdriver.create, vm_desc(name))
+        with self.lock:
+            self.domains.append(name)
+
+    def resume(self, name):
+        self._apply(self.vmdriver.resume, name)
+
+    def attach(self, name):
+        index = self._next()
+        self._apply(self.vmdriver.attach_network, name,
+                    net_desc('vm-%d' % index, index))
+
+    def shutdown(self, name):
+        self._apply(self.vmdriver.shutdown, [name])
+
+    def delete(self, name):
+        self._apply(self.vmdriver.delete, name)
+
+    def port_create(self):
+        index = self._next()
+        desc = net_desc('port-%d' % index, index)
+        self._apply(self.netdriver.create, dict(desc))
+        with self.lock:
+            self.ports.append(desc)
+
+    def port_delete(self, desc):
+        self._apply(self.netdriver.delete, dict(desc))
+
+    def step(self, operation):
+        """ Run one operation, return the name it actually ran as. """
+        if operation in ('resume', 'attach', 'shutdown', 'delete'):
+            name = self._take(self.domains,
+                              operation in ('shutdown', 'delete'))
+            if name is None:
+                self.create()
+                return 'create'
+            getattr(self, operation)(name)
+        elif operation == 'port_delete':
+            desc = self._take(self.ports, True)
+            if desc is None:
+                self.port_create()
+                return 'port_create'
+            self.port_delete(desc)
+        else:
+            getattr(self, operation)()
+        return operation
+
+    def cleanup(self):
+        """ Remove the domains and ports left by the previous mix. """
+        for name in self.domains:
+            try:
+                self.delete(name)
+            except Exception:
+                pass
+        for desc in self.ports:
+            try:
+                self.port_delete(desc)
+            except Exception:
+                pass
+        self.domains, self.ports = [], []
+
+    def run(self, mix, operations, concurrency):
+        """ Run operations picked from mix, return the per-op samples. """
+        names = sorted(mix)
+        weights = [mix[name] for name in names]
+        samples = dict((name, []) for name in OPERATIONS)
+        errors = dict((name, 0) for name in OPERATIONS)
+        remaining = [operations]
+
+        def worker():
+            while True:
+                with self.lock:
+                    if remaining[0] <= 0:
+                        return
+                    remaining[0] -= 1
+                    operation = self._pick(names, weights)
+                start = time.time()
+                try:
+                    operation = self.step(operation)
+                except Exception:
+                    with self.lock:
+                        errors[operation] += 1
+                    continue
+                elapsed = time.time() - start
+                with self.lock:
+                    samples[operation].append(elapsed)
+
+        threads = [threading.Thread(target=worker, name='load-%d' % i)
+                   for i in range(concurrency)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return samples, errors
+
+    def _pick(self, names, weights):
+        point = self.random.uniform(0, sum(weights))
+        for name, weight in zip(names, weights):
+            point -= weight
+            if point <= 0:
+                return name
+        return names[-1]
+
+
+def _call_counts(log, offset):
+    """ Return ({command: calls} logged after offset, new offset). """
+    counts = {}
+    with open(log) as f:
+        f.seek(offset)
+        for line in f:
+            command = line.split(' ', 1)[0]
+            counts[command] = counts.get(command, 0) + 1
+        return counts, f.tell()
+
+
+def _rpc_counts(metrics):
+    series = metrics.snapshot()['histograms'].get(
+        'libvirt_call_duration_seconds', {})
+    return dict((dict(labels)['call'], data['count'])
+                for labels, data in series.items())
+
+
+def run_mix(generator, metrics, log, offset, mix, operations, concurrency):
+    """ Run one mix and return its report dict and the new log offset. """
+    rpc_before = _rpc_counts(metrics)
+    start = time.time()
+    samples, errors = generator.run(mix, operations, concurrency)
+    elapsed = time.time() - start
+    subprocess_calls, offset = _call_counts(log, offset)
+    rpc_calls = dict((call, count - rpc_before.get(call, 0))
+                     for call, count in _rpc_counts(metrics).items()
+                     if count > rpc_before.get(call, 0))
+    report = {'mix': mix, 'operations': operations,
+              'concurrency': concurrency,
+              'seconds': elapsed,
+              'throughput': operations / elapsed if elapsed else None,
+              'latency': {},
+              'subprocess_calls': subprocess_calls,
+              'libvirt_calls': rpc_calls}
+    for name in OPERATIONS:
+        values = sorted(samples[name])
+        if not values and not errors[name]:
+            continue
+        latency = {'count': len(values), 'errors': errors[name],
+                   'max': values[-1] if values else None}
+        for p in PERCENTILES:
+            latency['p%d' % p] = percentile(values, p)
+        report['latency'][name] = latency
+    return report, offset
+
+
+def _ms(value):
+    return '-' if value is None else '%.1f' % (value * 1000)
+
+
+def format_report(report):
+    lines = ['mix %s: %d operations in %.2fs (%.1f ops/s, concurrency %d)'
+             % (','.join('%s=%g' % item for item in sorted(
+                 report['mix'].items())),
+                report['operations'], report['seconds'],
+                report['throughput'] or 0, report['concurrency']),
+             '  %-12s %7s %6s %9s %9s %9s %9s' % (
+                 'operation', 'count', 'errors', 'p50 ms', 'p90 ms',
+                 'p99 ms', 'max ms')]
+    for name in OPERATIONS:
+        latency = report['latency'].get(name)
+        if latency is None:
+            continue
+        lines.append('  %-12s %7d %6d %9s %9s %9s %9s' % (
+            name, latency['count'], latency['errors'],
+            _ms(latency['p50']), _ms(latency['p90']), _ms(latency['p99']),
+            _ms(latency['max'])))
+    total = report['operations'] or 1
+    for title, calls in (('subprocess', report['subprocess_calls']),
+                         ('libvirt', report['libvirt_calls'])):
+        lines.append('  %s calls: %s' % (title, ', '.join(
+            '%s=%d (%.2f/op)' % (name, count, float(count) / total)
+            for name, count in sorted(calls.items())) or 'none'))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--mix', action='append',
+                        help='operation weights, e.g. create=4,delete=2 '
+                        '(repeatable, default %s)' % DEFAULT_MIX)
+    parser.add_argument('--operations', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='seconds every stub command sleeps')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--json', action='store_true',
+                        help='print the reports as JSON')
+    args = parser.parse_args(argv)
+    mixes = [parse_mix(text) for text in args.mix or [DEFAULT_MIX]]
+
+    stub_dir = install_stubs(args.latency)
+    try:
+        import metrics
+        import netdriver
+        import vmdriver
+        from netcelery import celery as net_celery
+        from vmcelery import celery as vm_celery
+        for app in (vm_celery, net_celery):
+            app.conf.update(CELERY_ALWAYS_EAGER=True)
+        generator = LoadGenerator(vmdriver, netdriver, args.seed)
+        log = os.environ['LOADTEST_CALL_LOG']
+        offset = 0
+        reports = []
+        for mix in mixes:
+            report, offset = run_mix(generator, metrics, log, offset, mix,
+                                     args.operations, args.concurrency)
+            generator.cleanup()
+            offset = _call_counts(log, offset)[1]
+            reports.append(report)
+            if not args.json:
+                print(format_report(report))
+        if args.json:
+            print(json.dumps(reports, indent=2, sort_keys=True))
+    finally:
+        shutil.rmtree(stub_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
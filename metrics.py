@@ -0,0 +1,496 @@
+""" Latency histograms and error counters in Prometheus text format.
+
+Instrumentation is enabled by setting METRICS_PORT. Every worker process
+writes its metrics to RUN_DIR/metrics after each task and every
+METRICS_FLUSH_INTERVAL seconds, and one process of the host (the
+leader) serves the sum of all of them on METRICS_PORT. The files of
+exited pool processes are folded into one retired totals file, so the
+counters never go backwards; the worker main process clears them at
+startup. When disabled, the recording functions return immediately and
+nothing is wrapped or connected.
+
+"""
+import errno
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import hostlock
+
+METRICS_PORT = os.getenv('METRICS_PORT')
+METRICS_FLUSH_INTERVAL = int(os.getenv('METRICS_FLUSH_INTERVAL', '5'))
+enabled = bool(METRICS_PORT)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _monotonic():
+    """ Return a clock_gettime(CLOCK_MONOTONIC) function (Python 2). """
+    import ctypes
+    import ctypes.util
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    librt = ctypes.CDLL(ctypes.util.find_library('rt') or
+                        ctypes.util.find_library('c'), use_errno=True)
+    clock_gettime = librt.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    CLOCK_MONOTONIC = 1
+
+    def monotonic():
+        t = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return t.tv_sec + t.tv_nsec * 1e-9
+    monotonic()
+    return monotonic
+
+
+# Monotonic clock, the wall clock is only used if there is none
+if hasattr(time, 'monotonic'):
+    clock = time.monotonic
+else:
+    try:
+        clock = _monotonic()
+    except (AttributeError, OSError, TypeError):
+        clock = time.time
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+_server = None
+_flusher = {'pid': None, 'file': None}
+
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def observe(name, value, **labels):
+    """ Record value (seconds) in the histogram called name. """
+    if not enabled:
+        return
+    key = _key(labels)
+    with _lock:
+        series = _histograms.setdefault(name, {})
+        data = series.get(key)
+        if data is None:
+            data = series[key] = [0] * (len(DEFAULT_BUCKETS) + 2)
+        for i, bound in enumerate(DEFAULT_BUCKETS):
+            if value <= bound:
+                data[i] += 1
+                break
+        data[-2] += value
+        data[-1] += 1
+
+
+def inc(name, value=1, **labels):
+    """ Increment the counter called name. """
+    if not enabled:
+        return
+    key = _key(labels)
+    with _lock:
+        series = _counters.setdefault(name, {})
+        series[key] = series.get(key, 0) + value
+
+
+@contextmanager
+def timed(name, errors=None, **labels):
+    """ Time the block into histogram name.
+
+    If the block raises, the counter called errors is incremented.
+
+    """
+    if not enabled:
+        yield
+        return
+    start = clock()
+    try:
+        yield
+    except Exception:
+        if errors is not None:
+            inc(errors, **labels)
+        raise
+    finally:
+        observe(name, clock() - start, **labels)
+
+
+class PhaseTimer(object):
+
+    """ Time consecutive phases of an operation.
+
+    Every phase is recorded in the histogram called name labeled
+    with the phase, and kept for the result of the operation.
+
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.start = clock()
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, phase):
+        start = clock()
+        try:
+            yield
+        finally:
+            duration = clock() - start
+            self.phases[phase] = self.phases.get(phase, 0.0) + duration
+            observe(self.name, duration, phase=phase)
+
+    def result(self):
+        """ Return phase -> seconds dict including the total. """
+        result = dict(self.phases)
+        result['total'] = clock() - self.start
+        observe(self.name, result['total'], phase='total')
+        return result
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels)
+    if extra is not None:
+        items.append(extra)
+    if not items:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n')) for k, v in items)
+
+
+def _merge(state, counters, histograms):
+    """ Add counters and histograms to the (counters, histograms) state. """
+    for name, series in counters.items():
+        target = state[0].setdefault(name, {})
+        for labels, value in series.items():
+            target[labels] = target.get(labels, 0) + value
+    for name, series in histograms.items():
+        target = state[1].setdefault(name, {})
+        for labels, data in series.items():
+            if labels in target:
+                target[labels] = [
+                    a + b for a, b in zip(target[labels], data)]
+            else:
+                target[labels] = list(data)
+
+
+def render(state=None):
+    """ Return the metrics in Prometheus text exposition format.
+
+    state is a (counters, histograms) tuple, the metrics of this
+    process by default.
+
+    """
+    if state is None:
+        with _lock:
+            state = ({}, {})
+            _merge(state, _counters, _histograms)
+    counters, histograms = state
+    lines = []
+    for name in sorted(counters):
+        lines.append('# TYPE %s counter' % name)
+        for labels, value in sorted(counters[name].items()):
+            lines.append('%s%s %s' % (name, _format_labels(labels), value))
+    for name in sorted(histograms):
+        lines.append('# TYPE %s histogram' % name)
+        for labels, data in sorted(histograms[name].items()):
+            cumulative = 0
+            for bound, count in zip(DEFAULT_BUCKETS, data):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (
+                    name, _format_labels(labels, ('le', bound)),
+                    cumulative))
+            lines.append('%s_bucket%s %d' % (
+                name, _format_labels(labels, ('le', '+Inf')), data[-1]))
+            lines.append('%s_sum%s %f' % (name, _format_labels(labels),
+                                          data[-2]))
+            lines.append('%s_count%s %d' % (name, _format_labels(labels),
+                                            data[-1]))
+    return '\n'.join(lines) + '\n'
+
+
+def snapshot():
+    """ Return the raw counters and histogram counts/sums as dict. """
+    with _lock:
+        return {
+            'counters': dict((name, dict(series))
+                             for name, series in _counters.items()),
+            'histograms': dict(
+                (name, dict((labels, {'count': data[-1], 'sum': data[-2]})
+                            for labels, data in series.items()))
+                for name, series in _histograms.items())}
+
+
+def _directory():
+    directory = hostlock.path('metrics')
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+    return directory
+
+
+def _series(metrics):
+    return [[name, [list(item) for item in labels], value]
+            for name, series in metrics.items()
+            for labels, value in series.items()]
+
+
+def _unseries(items):
+    metrics = {}
+    for name, labels, value in items:
+        metrics.setdefault(name, {})[
+            tuple(tuple(item) for item in labels)] = value
+    return metrics
+
+
+def flush():
+    """ Write the metrics of this process to the metrics directory. """
+    if not enabled or _flusher['pid'] != os.getpid():
+        return
+    with _lock:
+        data = {'counters': _series(_counters),
+                'histograms': _series(_histograms)}
+    target = _flusher['file']
+    try:
+        with open(target + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.rename(target + '.tmp', target)
+    except (IOError, OSError) as e:
+        logging.warning("Unable to write metrics: %s", e)
+
+
+def _read(path):
+    """ Return the (counters, histograms) of a metrics file or None. """
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None  # Replaced meanwhile
+    return _unseries(data['counters']), _unseries(data['histograms'])
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def _exited(filenames):
+    """ Return the <pid>-<ms>.json files of exited processes. """
+    started = {}
+    for filename in filenames:
+        try:
+            pid, ms = [int(part) for part in filename[:-5].split('-')]
+        except ValueError:
+            continue  # retired.json
+        started.setdefault(pid, []).append((ms, filename))
+    exited = []
+    for pid, files in started.items():
+        files.sort()
+        # A reused pid: only the newest file can be of a live process
+        exited.extend(filename for ms, filename in files[:-1])
+        if not _pid_alive(pid):
+            exited.append(files[-1][1])
+    return exited
+
+
+def retire():
+    """ Fold the files of exited processes into the retired totals. """
+    directory = _directory()
+    with hostlock.locked('metrics'):
+        filenames = [f for f in os.listdir(directory) if f.endswith('.json')]
+        exited = _exited(filenames)
+        if not exited:
+            return 0
+        retired = os.path.join(directory, 'retired.json')
+        state = _read(retired) or ({}, {})
+        for filename in exited:
+            data = _read(os.path.join(directory, filename))
+            if data is not None:
+                _merge(state, *data)
+        with open(retired + '.tmp', 'w') as f:
+            json.dump({'counters': _series(state[0]),
+                       'histograms': _series(state[1])}, f)
+        os.rename(retired + '.tmp', retired)
+        for filename in exited:
+            os.unlink(os.path.join(directory, filename))
+    return len(exited)
+
+
+def collect():
+    """ Return the (counters, histograms) summed over every process. """
+    try:
+        retire()
+    except (IOError, OSError) as e:
+        logging.warning("Unable to retire metrics files: %s", e)
+    state = ({}, {})
+    directory = _directory()
+    # Not while exited files are folded into the retired totals
+    with hostlock.locked('metrics'):
+        for filename in os.listdir(directory):
+            if not filename.endswith('.json'):
+                continue
+            data = _read(os.path.join(directory, filename))
+            if data is not None:
+                _merge(state, *data)
+    return state
+
+
+def clear():
+    """ Drop the metrics files of the previous worker run. """
+    directory = _directory()
+    for filename in os.listdir(directory):
+        try:
+            os.unlink(os.path.join(directory, filename))
+        except OSError:
+            pass
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = render(collect()).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("Metrics request: " + format, *args)
+
+
+def start_server(port=None):
+    """ Serve the metrics of every process of the host over HTTP.
+
+    Only the leader process of the host listens, on port
+    (METRICS_PORT by default). Return the server or None.
+
+    """
+    global _server
+    if not enabled or not hostlock.leader('metrics'):
+        return None
+    if _server is not None:
+        return _server
+    port = int(port or METRICS_PORT)
+    try:
+        _server = HTTPServer(('127.0.0.1', port), _MetricsHandler)
+    except (IOError, OSError) as e:
+        logging.error("Unable to serve metrics on port %d: %s", port, e)
+        return None
+    thread = threading.Thread(target=_server.serve_forever,
+                              name='metrics-server')
+    thread.daemon = True
+    thread.start()
+    logging.info("Metrics endpoint listening on 127.0.0.1:%d (pid %d)",
+                 port, os.getpid())
+    return _server
+
+
+def _run():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        flush()
+        # Take over the endpoint when the leader process has exited
+        start_server()
+
+
+def start(**kw):
+    """ Start flushing the metrics of this (pool) process. """
+    if not enabled or _flusher['pid'] == os.getpid():
+        return
+    _flusher['pid'] = os.getpid()
+    _flusher['file'] = os.path.join(_directory(), '%d-%d.json' % (
+        os.getpid(), int(time.time() * 1000)))
+    start_server()
+    thread = threading.Thread(target=_run, name='metrics-flush')
+    thread.daemon = True
+    thread.start()
+
+
+class Instrumented(object):
+
+    """ Proxy timing every public method call of a libvirt object.
+
+    virDomain and virStream objects returned by the calls are
+    wrapped as well. Private attributes (like _o used inside the
+    libvirt bindings) are passed through untouched.
+
+    """
+
+    _wrapped_types = ('virDomain', 'virStream')
+
+    def __init__(self, target):
+        object.__setattr__(self, '_target', target)
+
+    def __getattr__(self, attr):
+        value = getattr(self._target, attr)
+        if attr.startswith('_') or not callable(value):
+            return value
+
+        def call(*args, **kw):
+            with timed('libvirt_call_duration_seconds',
+                       errors='libvirt_call_errors_total', call=attr):
+                return instrument(value(*args, **kw))
+        return call
+
+    def __setattr__(self, attr, value):
+        setattr(self._target, attr, value)
+
+
+def instrument(obj):
+    """ Return obj wrapped for libvirt call timing if enabled. """
+    if (not enabled or isinstance(obj, Instrumented) or
+            type(obj).__name__ not in ('virConnect', ) +
+            Instrumented._wrapped_types):
+        return obj
+    return Instrumented(obj)
+
+
+_task_start = {}
+
+
+def _task_prerun(task_id=None, **kw):
+    _task_start[task_id] = clock()
+
+
+def _task_postrun(task_id=None, task=None, state=None, **kw):
+    start = _task_start.pop(task_id, None)
+    if start is not None:
+        observe('task_duration_seconds', clock() - start,
+                task=task.name)
+    if state == 'FAILURE':
+        inc('task_failures_total', task=task.name)
+    flush()
+
+
+def install(app):
+    """ Connect task timing and metrics flushing to celery signals. """
+    if not enabled:
+        return
+    from celery.signals import (task_prerun, task_postrun,
+                                worker_process_init, worker_init)
+    task_prerun.connect(_task_prerun, weak=False,
+                        dispatch_uid='metrics_task_prerun')
+    task_postrun.connect(_task_postrun, weak=False,
+                         dispatch_uid='metrics_task_postrun')
+    worker_process_init.connect(start, weak=False,
+                                dispatch_uid='metrics_process_init')
+    worker_init.connect(lambda **kw: clear(), weak=False,
+                        dispatch_uid='metrics_worker_init')
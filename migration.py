@@ -0,0 +1,349 @@
+""" Adaptive live migration strategy.
+
+Before a live migration the dirty page rate of the domain is measured
+(startDirtyRateCalc, libvirt >= 7.2) and a cost model picks one of:
+
+precopy         plain iterative pre-copy
+parallel        pre-copy over several connections (more bandwidth)
+compression     pre-copy with XBZRLE compressed dirty pages
+auto_converge   pre-copy throttling the guest vcpus until it converges
+postcopy        pre-copy switched to post-copy when it does not converge
+
+The model compares the dirty rate with the bandwidth a strategy can
+reach; pre-copy converges when each round sends less than the previous
+one, i.e. dirty rate < bandwidth * MIGRATION_CONVERGENCE. While the
+migration runs, the job statistics are followed: the allowed downtime
+is raised step by step up to MIGRATION_DOWNTIME_LIMIT and, if post-copy
+is allowed, the migration is switched to post-copy when the remaining
+memory stops shrinking.
+
+The chosen strategy, the measured rates and the resulting downtime are
+returned, kept in the 'migrations' state file (last MIGRATION_HISTORY
+migrations) and recorded in the migration_* metrics.
+
+Rates and bandwidths are in MiB/s, memory in KiB, downtime in ms.
+
+"""
+import logging
+import math
+import os
+import threading
+import time
+
+import libvirt
+
+import events
+import hostlock
+import metrics
+
+MIGRATION_LINK_BANDWIDTH = int(os.getenv('MIGRATION_LINK_BANDWIDTH',
+                                         '1100'))
+MIGRATION_STREAM_BANDWIDTH = int(os.getenv('MIGRATION_STREAM_BANDWIDTH',
+                                           '400'))
+MIGRATION_MAX_CONNECTIONS = int(os.getenv('MIGRATION_MAX_CONNECTIONS',
+                                          '8'))
+MIGRATION_CONVERGENCE = float(os.getenv('MIGRATION_CONVERGENCE', '0.5'))
+MIGRATION_COMPRESSION_RATIO = float(
+    os.getenv('MIGRATION_COMPRESSION_RATIO', '0.4'))
+MIGRATION_MAX_DOWNTIME = int(os.getenv('MIGRATION_MAX_DOWNTIME', '300'))
+MIGRATION_DOWNTIME_LIMIT = int(os.getenv('MIGRATION_DOWNTIME_LIMIT',
+                                         '2000'))
+MIGRATION_DIRTY_SAMPLE = int(os.getenv('MIGRATION_DIRTY_SAMPLE', '1'))
+MIGRATION_POLL_INTERVAL = float(os.getenv('MIGRATION_POLL_INTERVAL', '1'))
+MIGRATION_STALL_ROUNDS = int(os.getenv('MIGRATION_STALL_ROUNDS', '3'))
+MIGRATION_HISTORY = int(os.getenv('MIGRATION_HISTORY', '100'))
+
+STRATEGIES = ('precopy', 'parallel', 'compression', 'auto_converge',
+              'postcopy')
+
+_completed = {}
+_completed_lock = threading.Lock()
+_subscribed = []
+
+
+def supported():
+    """ Return the strategies the libvirt bindings support. """
+    required = {'parallel': 'VIR_MIGRATE_PARALLEL',
+                'compression': 'VIR_MIGRATE_COMPRESSED',
+                'auto_converge': 'VIR_MIGRATE_AUTO_CONVERGE',
+                'postcopy': 'VIR_MIGRATE_POSTCOPY'}
+    return [s for s in STRATEGIES
+            if s not in required or hasattr(libvirt, required[s])]
+
+
+def sample_dirty_rates(conn, domains, seconds=MIGRATION_DIRTY_SAMPLE):
+    """ Measure the dirty rate of domains at once.
+
+    Return {domain name: MiB/s}, domains that can not be measured
+    (old libvirt or qemu) are left out.
+
+    """
+    started = []
+    # domainListGetStats accepts plain virDomain objects only
+    domains = [getattr(domain, '_target', domain) for domain in domains]
+    for domain in domains:
+        try:
+            domain.startDirtyRateCalc(seconds, 0)
+            started.append(domain)
+        except (AttributeError, libvirt.libvirtError) as e:
+            logging.debug("Dirty rate not available for %s: %s",
+                          domain.name(), e)
+    if not started:
+        return {}
+    rates = {}
+    deadline = time.time() + seconds + 5
+    time.sleep(seconds)
+    while started and time.time() < deadline:
+        pending = []
+        for domain, stats in conn.domainListGetStats(
+                started, libvirt.VIR_DOMAIN_STATS_DIRTYRATE):
+            # calc_status 2 is measured
+            if stats.get('dirtyrate.calc_status') == 2:
+                rates[domain.name()] = stats.get(
+                    'dirtyrate.megabytes_per_second', 0)
+            else:
+                pending.append(domain)
+        started = pending
+        if started:
+            time.sleep(0.2)
+    return rates
+
+
+def plan(memory, dirty_rate, bandwidth=0, allow_postcopy=False,
+         available=None):
+    """ Choose a strategy for memory KiB dirtied at dirty_rate MiB/s.
+
+    bandwidth limits the migration (0 is MIGRATION_LINK_BANDWIDTH).
+    Return dict of strategy, reason, connections and the estimated
+    seconds of the pre-copy phase (None if it does not converge).
+
+    """
+    available = available or supported()
+    link = min(bandwidth or MIGRATION_LINK_BANDWIDTH,
+               MIGRATION_LINK_BANDWIDTH)
+    memory_mib = memory / 1024.0
+
+    def estimate(rate, speed):
+        if rate >= speed * MIGRATION_CONVERGENCE:
+            return None
+        # Geometric series of the pre-copy rounds
+        return memory_mib / speed / (1 - float(rate) / speed)
+
+    single = min(link, MIGRATION_STREAM_BANDWIDTH)
+    connections = int(min(MIGRATION_MAX_CONNECTIONS,
+                          max(1, math.ceil(float(link) / single))))
+    if dirty_rate is None:
+        return {'strategy': 'precopy', 'connections': 1,
+                'estimate': memory_mib / single,
+                'reason': 'dirty rate unknown'}
+    candidates = [('precopy', dirty_rate, single, 1)]
+    if connections > 1:
+        candidates.append(('parallel', dirty_rate, link, connections))
+    candidates.append(('compression',
+                       dirty_rate * MIGRATION_COMPRESSION_RATIO, single, 1))
+    for strategy, rate, speed, count in candidates:
+        seconds = estimate(rate, speed)
+        if strategy in available and seconds is not None:
+            return {'strategy': strategy, 'connections': count,
+                    'estimate': seconds,
+                    'reason': 'converges at %.0f of %.0f MiB/s' % (
+                        rate, speed)}
+    if allow_postcopy and 'postcopy' in available:
+        return {'strategy': 'postcopy', 'connections': 1,
+                'estimate': memory_mib / single,
+                'reason': 'dirty rate %.0f MiB/s does not converge' %
+                dirty_rate}
+    strategy = 'auto_converge' if 'auto_converge' in available else \
+        'precopy'
+    return {'strategy': strategy, 'connections': 1, 'estimate': None,
+            'reason': 'dirty rate %.0f MiB/s does not converge, '
+            'throttling the guest' % dirty_rate}
+
+
+def _flags_and_params(choice, name, bandwidth, allow_postcopy):
+    flags = (libvirt.VIR_MIGRATE_PEER2PEER | libvirt.VIR_MIGRATE_LIVE)
+    params = {libvirt.VIR_MIGRATE_PARAM_DEST_NAME: name}
+    if bandwidth:
+        params[libvirt.VIR_MIGRATE_PARAM_BANDWIDTH] = int(bandwidth)
+    strategy = choice['strategy']
+    if strategy == 'parallel':
+        flags |= libvirt.VIR_MIGRATE_PARALLEL
+        params[libvirt.VIR_MIGRATE_PARAM_PARALLEL_CONNECTIONS] = \
+            choice['connections']
+    elif strategy == 'compression':
+        flags |= libvirt.VIR_MIGRATE_COMPRESSED
+        params[libvirt.VIR_MIGRATE_PARAM_COMPRESSION] = 'xbzrle'
+    elif strategy == 'auto_converge':
+        flags |= libvirt.VIR_MIGRATE_AUTO_CONVERGE
+    # Post-copy only enabled here, switched to by _Monitor
+    if (strategy == 'postcopy' or allow_postcopy) and \
+            hasattr(libvirt, 'VIR_MIGRATE_POSTCOPY'):
+        flags |= libvirt.VIR_MIGRATE_POSTCOPY
+    return flags, params
+
+
+def _on_job_completed(dom, params):
+    with _completed_lock:
+        _completed[dom.name()] = params
+
+
+def _follow_completed_jobs():
+    """ Keep the statistics of completed jobs from the events. """
+    if not _subscribed:
+        _subscribed.append(True)
+        events.start()
+        events.subscribe(libvirt.VIR_DOMAIN_EVENT_ID_JOB_COMPLETED,
+                         _on_job_completed)
+
+
+class _Monitor(object):
+
+    """ Follow a running migration and escalate if it stalls. """
+
+    def __init__(self, domain, strategy, allow_postcopy):
+        self.domain = domain
+        self.postcopy = strategy == 'postcopy' or allow_postcopy
+        self.downtime = MIGRATION_MAX_DOWNTIME
+        self.escalations = []
+        self.stats = {}
+        self.best_remaining = None
+        self.stalled = 0
+        self.switched = False
+
+    def _escalate(self, action):
+        logging.info("Migration of %s: %s", self.domain.name(), action)
+        self.escalations.append(action)
+
+    def poll(self):
+        try:
+            stats = self.domain.jobStats()
+        except libvirt.libvirtError:
+            return
+        if not stats or stats.get('type', 0) == 0:
+            return
+        if not self.stats:
+            self.domain.migrateSetMaxDowntime(self.downtime, 0)
+        self.stats = stats
+        remaining = stats.get('memory_remaining')
+        if remaining is None or self.switched:
+            return
+        if self.best_remaining is None or remaining < self.best_remaining:
+            self.best_remaining = remaining
+            self.stalled = 0
+            return
+        self.stalled += 1
+        if self.stalled < MIGRATION_STALL_ROUNDS:
+            return
+        self.stalled = 0
+        if self.postcopy:
+            self.domain.migrateStartPostCopy(0)
+            self.switched = True
+            self._escalate('switched to post-copy')
+        elif self.downtime < MIGRATION_DOWNTIME_LIMIT:
+            self.downtime = min(self.downtime * 2, MIGRATION_DOWNTIME_LIMIT)
+            self.domain.migrateSetMaxDowntime(self.downtime, 0)
+            self._escalate('max downtime raised to %d ms' % self.downtime)
+
+    def dirty_rate(self):
+        """ Dirty rate in MiB/s seen by the running job. """
+        pages = self.stats.get('memory_dirty_rate')
+        if pages is None:
+            return None
+        page_size = self.stats.get('memory_page_size', 4096)
+        return pages * page_size / 1048576.0
+
+
+def _record(entry):
+    metrics.inc('migration_strategy_total', strategy=entry['strategy'],
+                status=entry['status'])
+    if entry.get('downtime') is not None:
+        metrics.observe('migration_downtime_seconds',
+                        entry['downtime'] / 1000.0,
+                        strategy=entry['strategy'])
+    with hostlock.locked('migrations'):
+        history = hostlock.load('migrations', [])
+        history.append(entry)
+        hostlock.save('migrations', history[-MIGRATION_HISTORY:])
+
+
+def history():
+    """ Return the recorded migrations, oldest first. """
+    return hostlock.load('migrations', [])
+
+
+def migrate(domain, name, host, bandwidth=0, strategy='auto',
+            allow_postcopy=False, dirty_rate=None):
+    """ Live migrate domain to host as name with the chosen strategy.
+
+    strategy is 'auto' (cost model) or one of STRATEGIES, dirty_rate
+    a previous sample (measured if None). Return the migration record.
+
+    """
+    _follow_completed_jobs()
+    state, maxmem, memory, vcpus, cputime = domain.info()
+    if strategy == 'auto':
+        if dirty_rate is None:
+            dirty_rate = sample_dirty_rates(
+                domain.connect(), [domain]).get(domain.name())
+        choice = plan(memory, dirty_rate, bandwidth, allow_postcopy)
+    elif strategy in supported():
+        choice = {'strategy': strategy, 'reason': 'requested',
+                  'connections': MIGRATION_MAX_CONNECTIONS
+                  if strategy == 'parallel' else 1, 'estimate': None}
+    else:
+        raise Exception("Unsupported migration strategy: %s" % strategy)
+    flags, params = _flags_and_params(choice, name, bandwidth,
+                                      allow_postcopy)
+    logging.info("Migrating %s to %s with %s: %s", name, host,
+                 choice['strategy'], choice['reason'])
+    monitor = _Monitor(domain, choice['strategy'], allow_postcopy)
+    domain_name = domain.name()
+    with _completed_lock:
+        _completed.pop(domain_name, None)
+    result = {}
+
+    def run():
+        try:
+            domain.migrateToURI3("qemu+tcp://%s/system" % host, params,
+                                 flags)
+        except Exception as e:
+            result['error'] = e
+
+    start = time.time()
+    thread = threading.Thread(target=run, name='migrate-%s' % name)
+    thread.daemon = True
+    thread.start()
+    while thread.is_alive():
+        thread.join(MIGRATION_POLL_INTERVAL)
+        if thread.is_alive():
+            try:
+                monitor.poll()
+            except libvirt.libvirtError as e:
+                logging.debug("Migration monitor of %s: %s", name,
+                              e.get_error_message())
+    # The completed job statistics arrive as event
+    deadline = time.time() + 2
+    completed = None
+    while completed is None and time.time() < deadline and \
+            'error' not in result:
+        with _completed_lock:
+            completed = _completed.pop(domain_name, None)
+        if completed is None:
+            time.sleep(0.1)
+    stats = completed or monitor.stats
+    entry = {'name': name, 'target': host, 'time': start,
+             'strategy': choice['strategy'], 'reason': choice['reason'],
+             'memory': memory, 'dirty_rate': dirty_rate,
+             'job_dirty_rate': monitor.dirty_rate(),
+             'estimate': choice['estimate'],
+             'escalations': monitor.escalations,
+             'seconds': time.time() - start,
+             'downtime': stats.get('downtime') if completed else None,
+             'status': 'failed' if 'error' in result else 'completed'}
+    _record(entry)
+    logging.info("Migration of %s %s in %.1fs, downtime %s ms",
+                 name, entry['status'], entry['seconds'],
+                 entry['downtime'])
+    if 'error' in result:
+        raise result['error']
+    return entry
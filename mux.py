@@ -0,0 +1,188 @@
+""" Non-blocking socket multiplexer running in a single thread. """
+import errno
+import logging
+import os
+import select
+import socket
+import threading
+
+READ_SIZE = 65536
+
+_READ_EVENTS = select.POLLIN | select.POLLPRI
+_ERROR_EVENTS = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+
+class Multiplexer(object):
+
+    """ Poll many sockets from one thread.
+
+    on_data(sock, data) is called for every chunk read and
+    on_close(sock) once when the peer closes or the socket fails.
+    Listening sockets call on_accept(sock) with every new client.
+    All run in the multiplexer thread and must not block.
+
+    """
+
+    def __init__(self, name='mux'):
+        self.name = name
+        self.lock = threading.Lock()
+        self.poll = select.poll()
+        self.sockets = {}
+        self.listeners = {}
+        self.pending = {}
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        self.poll.register(self.wakeup_r, select.POLLIN)
+        self.thread = None
+
+    def connect_unix(self, path, on_data, on_close):
+        """ Connect to the unix socket at path without blocking, add it.
+
+        Data sent before the connection completes is queued. Raise
+        socket.error if the peer is missing, refuses or its backlog is
+        full (EAGAIN), rather than waiting for it.
+
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        error = sock.connect_ex(path)
+        if error not in (0, errno.EINPROGRESS):
+            sock.close()
+            raise socket.error(error, os.strerror(error))
+        self.add(sock, on_data, on_close)
+        return sock
+
+    def listen_unix(self, path, on_accept, backlog=128):
+        """ Listen on the unix socket at path (replaced if it exists). """
+        if os.path.exists(path):
+            os.unlink(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        sock.listen(backlog)
+        sock.setblocking(False)
+        with self.lock:
+            self.listeners[sock.fileno()] = (sock, on_accept)
+            self.poll.register(sock.fileno(), _READ_EVENTS)
+        self._wakeup()
+        return sock
+
+    def _accept(self, fd):
+        sock, on_accept = self.listeners[fd]
+        try:
+            client, _ = sock.accept()
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            raise
+        on_accept(client)
+
+    def add(self, sock, on_data, on_close):
+        sock.setblocking(False)
+        with self.lock:
+            self.sockets[sock.fileno()] = (sock, on_data, on_close)
+            self.poll.register(sock.fileno(), _READ_EVENTS)
+        self._wakeup()
+
+    def remove(self, sock):
+        """ Remove and close sock without calling on_close. """
+        with self.lock:
+            self._forget(sock.fileno())
+        sock.close()
+
+    def _forget(self, fd):
+        if self.sockets.pop(fd, None) is not None:
+            self.pending.pop(fd, None)
+            self.poll.unregister(fd)
+
+    def send(self, sock, data):
+        """ Queue data to be written to sock. """
+        with self.lock:
+            fd = sock.fileno()
+            if fd not in self.sockets:
+                raise socket.error(errno.EBADF, "Socket is not registered")
+            self.pending[fd] = self.pending.get(fd, b'') + data
+            self.poll.modify(fd, _READ_EVENTS | select.POLLOUT)
+        self._wakeup()
+
+    def _wakeup(self):
+        if self.thread is not None:
+            os.write(self.wakeup_w, b'x')
+
+    def _close(self, fd):
+        with self.lock:
+            entry = self.sockets.get(fd)
+            self._forget(fd)
+        if entry is not None:
+            try:
+                entry[2](entry[0])
+            finally:
+                entry[0].close()
+
+    def _write(self, fd):
+        with self.lock:
+            entry = self.sockets.get(fd)
+            data = self.pending.get(fd, b'')
+            if entry is None or not data:
+                return
+            try:
+                sent = entry[0].send(data)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            rest = data[sent:]
+            if rest:
+                self.pending[fd] = rest
+            else:
+                self.pending.pop(fd, None)
+                self.poll.modify(fd, _READ_EVENTS)
+
+    def _read(self, fd):
+        entry = self.sockets.get(fd)
+        if entry is None:
+            return
+        try:
+            data = entry[0].recv(READ_SIZE)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = b''
+        if not data:
+            self._close(fd)
+        else:
+            entry[1](entry[0], data)
+
+    def run(self):
+        while True:
+            try:
+                events = self.poll.poll()
+            except (IOError, OSError, select.error) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                if fd == self.wakeup_r:
+                    os.read(self.wakeup_r, 4096)
+                    continue
+                if fd in self.listeners:
+                    try:
+                        self._accept(fd)
+                    except Exception:
+                        logging.exception("%s: accept failed", self.name)
+                    continue
+                try:
+                    if event & select.POLLOUT:
+                        self._write(fd)
+                    if event & _READ_EVENTS:
+                        self._read(fd)
+                    elif event & _ERROR_EVENTS:
+                        self._close(fd)
+                except Exception:
+                    logging.exception("%s: error on fd %d", self.name, fd)
+                    self._close(fd)
+
+    def start(self):
+        """ Start the multiplexer thread. """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name=self.name)
+            self.thread.daemon = True
+            self.thread.start()
@@ -5,24 +5,28 @@ from os import getenv
 
 from argparse import ArgumentParser
 
-parser = ArgumentParser()
-parser.add_argument("-n", "--hostname", dest="hostname",
-                    help="Define the full queue name with"
-                    "with priority", metavar="hostname.queue.priority")
-(args, unknwon_args) = parser.parse_known_args()
-HOSTNAME = vars(args).pop("hostname")
-if HOSTNAME is None:
-    raise Exception("You must define hostname as -n <hostname> or "
-                    "--hostname=<hostname>.\n"
-                    "Hostname format must be hostname.module.priority.")
-
-AMQP_URI = getenv('AMQP_URI')
-
 
 def to_bool(value):
     return value.lower() in ("true", "yes", "y", "t")
 
 
+if to_bool(getenv("LIBVIRT_TEST", "False")):
+    HOSTNAME = "netdriver.test"
+else:
+    parser = ArgumentParser()
+    parser.add_argument("-n", "--hostname", dest="hostname",
+                        help="Define the full queue name with"
+                        "with priority", metavar="hostname.queue.priority")
+    (args, unknwon_args) = parser.parse_known_args()
+    HOSTNAME = vars(args).pop("hostname")
+    if HOSTNAME is None:
+        raise Exception("You must define hostname as -n <hostname> or "
+                        "--hostname=<hostname>.\n"
+                        "Hostname format must be hostname.module.priority.")
+
+AMQP_URI = getenv('AMQP_URI')
+
+
 lib_connection = None
 native_ovs = False
 
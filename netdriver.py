@@ -1,13 +1,35 @@
 """ CIRCLE driver for Open vSwitch. """
 import subprocess
 import logging
+import os
+import tempfile
 
 from netcelery import celery
 from os import getenv
 from vm import VMNetwork
 from vmcelery import native_ovs
+import metrics
+import profiler
+import flowpipeline
 driver = getenv("HYPERVISOR_TYPE", "test")
 
+metrics.install(celery)
+profiler.install(celery)
+
+
+def subprocess_call(command):
+    """ Run command with subprocess.call counting calls and failures.
+
+    The command is labeled by its executable (ovs-vsctl, ovs-ofctl, ip).
+
+    """
+    label = command[1] if command[0] == 'sudo' else command[0]
+    with metrics.timed('subprocess_duration_seconds', command=label):
+        return_val = subprocess.call(command)
+    if return_val != 0:
+        metrics.inc('subprocess_errors_total', command=label)
+    return return_val
+
 
 @celery.task
 def create(network):
@@ -21,14 +43,21 @@ def delete(network):
     port_delete(VMNetwork.deserialize(network))
 
 
+@celery.task(bind=True)
+def profile(self, tasks=None, seconds=None, mode='wall'):
+    """ Profile the next tasks (or seconds) in every pool process. """
+    return profiler.broadcast(self.app, self.request.hostname,
+                              tasks, seconds, mode)
+
+
 def add_tuntap_interface(if_name):
     """ For testing purpose only adding tuntap interface. """
-    subprocess.call(['sudo', 'ip', 'tuntap', 'add', 'mode', 'tap', if_name])
+    subprocess_call(['sudo', 'ip', 'tuntap', 'add', 'mode', 'tap', if_name])
 
 
 def del_tuntap_interface(if_name):
     """ For testing purpose only deleting tuntap interface. """
-    subprocess.call(['sudo', 'ip', 'tuntap', 'del', 'mode', 'tap', if_name])
+    subprocess_call(['sudo', 'ip', 'tuntap', 'del', 'mode', 'tap', if_name])
 
 
 def ovs_command_execute(command):
@@ -39,7 +68,7 @@ def ovs_command_execute(command):
 
     """
     command = ['sudo', 'ovs-vsctl'] + command
-    return_val = subprocess.call(command)
+    return_val = subprocess_call(command)
     logging.info('OVS command: %s executed.', command)
     return return_val
 
@@ -52,11 +81,26 @@ def ofctl_command_execute(command):
 
     """
     command = ['sudo', 'ovs-ofctl'] + command
-    return_val = subprocess.call(command)
+    return_val = subprocess_call(command)
     logging.info('OVS flow command: %s executed.', command)
     return return_val
 
 
+def ofctl_add_flows(bridge, flows):
+    """ Add flows (list of strings) with a single ovs-ofctl call.
+
+    return  -   Command output
+
+    """
+    fd, path = tempfile.mkstemp(prefix='flows-', suffix='.txt')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join(flows) + '\n')
+        return ofctl_command_execute(["add-flows", bridge, path])
+    finally:
+        os.unlink(path)
+
+
 def build_flow_rule(
         in_port=None,
         dl_src=None,
@@ -149,21 +193,31 @@ def ban_dhcp_server(network, port_number, remove=False):
         ofctl_command_execute(["del-flows", network.bridge, flow_cmd])
 
 
-def ipv4_filter(network, port_number, remove=False):
-    """ Apply/Remove ipv4 filter rule to network.  """
+def ipv4_filter(network, port_number, remove=False, address=None):
+    """ Apply/Remove ipv4 filter rule to network.
+
+    address is one of the addresses of network (default network.ipv4).
+
+    """
+    address = address or network.ipv4
     if not remove:
         flow_cmd = build_flow_rule(in_port=port_number, dl_src=network.mac,
-                                   protocol="ip", nw_src=network.ipv4,
+                                   protocol="ip", nw_src=address,
                                    priority=42000, actions="normal")
         ofctl_command_execute(["add-flow", network.bridge, flow_cmd])
     else:
         flow_cmd = build_flow_rule(in_port=port_number, dl_src=network.mac,
-                                   protocol="ip", nw_src=network.ipv4)
+                                   protocol="ip", nw_src=address)
         ofctl_command_execute(["del-flows", network.bridge, flow_cmd])
 
 
-def ipv6_filter(network, port_number, remove=False):
-    """ Apply/Remove ipv6 filter rule to network.  """
+def ipv6_filter(network, port_number, remove=False, address=None):
+    """ Apply/Remove ipv6 filter rule to network.
+
+    address is one of the addresses of network (default network.ipv6).
+
+    """
+    address = address or network.ipv6
 
     LINKLOCAL_SUBNET = "FE80::/64"
     ICMPv6_NA = "136"  # The type of IPv6 Neighbor Advertisement
@@ -174,37 +228,42 @@ def ipv6_filter(network, port_number, remove=False):
         flow_cmd = build_flow_rule(in_port=port_number, dl_src=network.mac,
                                    protocol="icmp6", ipv6_src=LINKLOCAL_SUBNET,
                                    icmp_type=ICMPv6_NA,
-                                   nd_target=network.ipv6,
+                                   nd_target=address,
                                    priority=42001, actions="normal")
         ofctl_command_execute(["add-flow", network.bridge, flow_cmd])
 
         # Enable traffic from valid source
         flow_cmd = build_flow_rule(in_port=port_number, dl_src=network.mac,
-                                   protocol="ipv6", ipv6_src=network.ipv6,
+                                   protocol="ipv6", ipv6_src=address,
                                    priority=42000, actions="normal")
         ofctl_command_execute(["add-flow", network.bridge, flow_cmd])
     else:
         flow_cmd = build_flow_rule(in_port=port_number, dl_src=network.mac,
                                    protocol="icmp6", ipv6_src=LINKLOCAL_SUBNET,
                                    icmp_type=ICMPv6_NA,
-                                   nd_target=network.ipv6)
+                                   nd_target=address)
         ofctl_command_execute(["del-flows", network.bridge, flow_cmd])
 
         flow_cmd = build_flow_rule(in_port=port_number, dl_src=network.mac,
-                                   protocol="ipv6", ipv6_src=network.ipv6)
+                                   protocol="ipv6", ipv6_src=address)
         ofctl_command_execute(["del-flows", network.bridge, flow_cmd])
 
 
-def arp_filter(network, port_number, remove=False):
-    """ Apply/Remove arp filter rule to network. """
+def arp_filter(network, port_number, remove=False, address=None):
+    """ Apply/Remove arp filter rule to network.
+
+    address is one of the addresses of network (default network.ipv4).
+
+    """
+    address = address or network.ipv4
     if not remove:
         flow_cmd = build_flow_rule(in_port=port_number, dl_src=network.mac,
-                                   protocol="arp", nw_src=network.ipv4,
+                                   protocol="arp", nw_src=address,
                                    priority=41000, actions="normal")
         ofctl_command_execute(["add-flow", network.bridge, flow_cmd])
     else:
         flow_cmd = build_flow_rule(in_port=port_number, dl_src=network.mac,
-                                   protocol="arp", nw_src=network.ipv4)
+                                   protocol="arp", nw_src=address)
         ofctl_command_execute(["del-flows", network.bridge, flow_cmd])
 
 
@@ -255,14 +314,22 @@ def port_create(network):
     port_number = get_fport_for_network(network)
 
     # Set Flow rules to avoid mac or IP spoofing
+    if flowpipeline.enabled:
+        # One table 0 flow per port, validation in the next tables
+        ofctl_add_flows(network.bridge,
+                        flowpipeline.network_flows(network, port_number))
+        pull_up_interface(network)
+        return
     if network.managed:
         # Allow traffic from fource MAC and IP
         ban_dhcp_server(network, port_number)
-        if network.ipv4 != "None":
-            ipv4_filter(network, port_number)
-        if network.ipv6 != "None":
-            ipv6_filter(network, port_number)
-        arp_filter(network, port_number)
+        # One rule per address of lists or comma separated strings
+        for address in flowpipeline.addresses(network.ipv4):
+            ipv4_filter(network, port_number, address=address)
+        for address in flowpipeline.addresses(network.ipv6):
+            ipv6_filter(network, port_number, address=address)
+        for address in flowpipeline.addresses(network.ipv4):
+            arp_filter(network, port_number, address=address)
         enable_dhcp_client(network, port_number)
     else:
         # Allow all traffic from source MAC address
@@ -294,6 +361,10 @@ def clear_port_rules(network):
     port_number = get_fport_for_network(network)
     flow_cmd = build_flow_rule(in_port=port_number)
     ofctl_command_execute(["del-flows", network.bridge, flow_cmd])
+    if flowpipeline.enabled:
+        # Pipeline flows of the port in the other tables
+        ofctl_command_execute(["del-flows", network.bridge,
+                               flowpipeline.cookie_match(port_number)])
 
 
 def pull_up_interface(network):
@@ -303,7 +374,7 @@ def pull_up_interface(network):
 
     """
     command = ['sudo', 'ip', 'link', 'set', 'up', network.name]
-    return_val = subprocess.call(command)
+    return_val = subprocess_call(command)
     logging.info('IP command: %s executed.', command)
     return return_val
 
@@ -316,6 +387,9 @@ def get_fport_for_network(network):
     return stripped output string
 
     """
-    output = subprocess.check_output(
-        ['sudo', 'ovs-vsctl', 'get', 'Interface', network.name, 'ofport'])
+    with metrics.timed('subprocess_duration_seconds',
+                       errors='subprocess_errors_total', command='ovs-vsctl'):
+        output = subprocess.check_output(
+            ['sudo', 'ovs-vsctl', 'get', 'Interface', network.name,
+             'ofport'])
     return str(output).strip()
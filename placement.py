@@ -0,0 +1,213 @@
+""" NUMA-aware placement of virtual CPUs and guest memory. """
+import logging
+import lxml.etree as ET
+
+# Scoring weights for a candidate NUMA cell (sum to 1.0)
+MEMORY_WEIGHT = 0.6
+CPU_WEIGHT = 0.4
+
+
+def parse_cpuset(cpuset):
+    """ Parse libvirt cpuset notation (e.g. "0-3,^2,8") into a set. """
+    cpus = set()
+    excluded = set()
+    if not cpuset:
+        return cpus
+    for part in cpuset.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        target = cpus
+        if part.startswith('^'):
+            target = excluded
+            part = part[1:]
+        if '-' in part:
+            first, last = part.split('-')
+            target.update(range(int(first), int(last) + 1))
+        else:
+            target.add(int(part))
+    return cpus - excluded
+
+
+def format_cpuset(cpus):
+    """ Format an iterable of cpu ids as compact libvirt cpuset string. """
+    ranges = []
+    for cpu in sorted(set(cpus)):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(a) if a == b else '%d-%d' % (a, b)
+                    for a, b in ranges)
+
+
+def parse_topology(capabilities_xml):
+    """ Parse the NUMA cells from the host capabilities XML.
+
+    Return list of cell dicts:
+    id      NUMA node id
+    memory  memory of the node in KiB
+    cpus    list of dicts with id, socket_id, core_id and siblings
+
+    """
+    root = ET.fromstring(capabilities_xml)
+    cells = []
+    for cell in root.findall('host/topology/cells/cell'):
+        memory = cell.find('memory')
+        cpus = []
+        for cpu in cell.findall('cpus/cpu'):
+            cpus.append({
+                'id': int(cpu.get('id')),
+                'socket_id': int(cpu.get('socket_id', 0)),
+                'core_id': int(cpu.get('core_id', cpu.get('id'))),
+                'siblings': sorted(parse_cpuset(
+                    cpu.get('siblings', cpu.get('id'))))})
+        cells.append({'id': int(cell.get('id')),
+                      'memory': int(memory.text) if memory is not None else 0,
+                      'cpus': cpus})
+    return cells
+
+
+def committed_resources(cells, domain_xmls):
+    """ Sum up the resources already used by running domains.
+
+    Pinned vcpus count against their cpuset, unpinned vcpus are spread
+    evenly over every host cpu. Memory bound with numatune is divided
+    between the nodes of its nodeset, otherwise spread over all cells.
+
+    Return dict with 'cpus' (cpu id -> load in vcpus) and
+    'memory' (cell id -> KiB).
+
+    """
+    all_cpus = [cpu['id'] for cell in cells for cpu in cell['cpus']]
+    all_cells = [cell['id'] for cell in cells]
+    cpu_load = dict((cpu, 0.0) for cpu in all_cpus)
+    node_memory = dict((cell, 0.0) for cell in all_cells)
+    for xml in domain_xmls:
+        root = ET.fromstring(xml)
+        vcpu = int(root.findtext('vcpu', '1'))
+        memory = int(root.findtext('currentMemory') or
+                     root.findtext('memory') or 0)
+        pinned = 0
+        for pin in root.findall('cputune/vcpupin'):
+            cpuset = [c for c in parse_cpuset(pin.get('cpuset'))
+                      if c in cpu_load]
+            for cpu in cpuset:
+                cpu_load[cpu] += 1.0 / len(cpuset)
+            pinned += 1
+        if vcpu > pinned and all_cpus:
+            for cpu in all_cpus:
+                cpu_load[cpu] += float(vcpu - pinned) / len(all_cpus)
+        numa_memory = root.find('numatune/memory')
+        nodeset = []
+        if numa_memory is not None:
+            nodeset = [n for n in parse_cpuset(numa_memory.get('nodeset'))
+                       if n in node_memory]
+        for node in nodeset or all_cells:
+            node_memory[node] += float(memory) / len(nodeset or all_cells)
+    return {'cpus': cpu_load, 'memory': node_memory}
+
+
+def _score_cell(cell, committed, vcpu, memory):
+    """ Return the explained score of one cell for the requested size. """
+    free_memory = cell['memory'] - committed['memory'].get(cell['id'], 0)
+    cpu_ids = [cpu['id'] for cpu in cell['cpus']]
+    load = sum(committed['cpus'].get(cpu, 0) for cpu in cpu_ids)
+    cpu_load = load / len(cpu_ids) if cpu_ids else 1.0
+    fits_memory = free_memory >= memory
+    fits_cpus = len(cpu_ids) >= vcpu
+    memory_ratio = max(free_memory - memory, 0) / float(cell['memory'] or 1)
+    score = (MEMORY_WEIGHT * memory_ratio +
+             CPU_WEIGHT * max(1.0 - cpu_load, 0.0))
+    if not fits_memory:
+        reason = 'not enough free memory'
+    elif not fits_cpus:
+        reason = 'not enough cpus'
+    else:
+        reason = 'fits'
+    return {'cell': cell['id'],
+            'free_memory': int(free_memory),
+            'cpu_count': len(cpu_ids),
+            'cpu_load': round(cpu_load, 3),
+            'fits': fits_memory and fits_cpus,
+            'score': round(score, 4),
+            'reason': reason}
+
+
+def _pick_cpus(cells, committed, vcpu):
+    """ Choose the least loaded cpus, one thread per core first. """
+    candidates = [cpu for cell in cells for cpu in cell['cpus']]
+    chosen = []
+    used_cores = set()
+    for cpu in sorted(candidates,
+                      key=lambda c: (committed['cpus'].get(c['id'], 0),
+                                     c['id'])):
+        core = (cpu['socket_id'], cpu['core_id'])
+        if core not in used_cores:
+            chosen.append(cpu['id'])
+            used_cores.add(core)
+        if len(chosen) == vcpu:
+            return chosen
+    # More vcpus than physical cores: use siblings, then wrap around
+    rest = [c['id'] for c in sorted(
+        candidates, key=lambda c: committed['cpus'].get(c['id'], 0))
+        if c['id'] not in chosen]
+    chosen.extend(rest[:vcpu - len(chosen)])
+    while len(chosen) < vcpu:
+        chosen.append(chosen[len(chosen) % len(candidates)])
+    return chosen
+
+
+def place(cells, committed, vcpu, memory):
+    """ Compute the placement of a new domain.
+
+    vcpu    - number of virtual cpus
+    memory  - guest memory in KiB
+
+    Return dict:
+    nodeset         cells used for guest memory
+    mode            numatune memory mode
+    vcpu_pinning    list of cpusets indexed by vcpu number
+    emulator_pinning    cpuset for the emulator threads
+    scores          explained per-cell scoring
+    reason          why the nodeset was chosen
+
+    """
+    vcpu = int(vcpu)
+    memory = int(memory)
+    if not cells:
+        return None
+    scores = [_score_cell(cell, committed, vcpu, memory) for cell in cells]
+    ranked = sorted(scores, key=lambda s: (-s['score'], s['cell']))
+    by_id = dict((cell['id'], cell) for cell in cells)
+    fitting = [s for s in ranked if s['fits']]
+    if fitting:
+        chosen = [by_id[fitting[0]['cell']]]
+        mode = 'strict'
+        reason = 'cell %d has the best score of %d fitting cells' % (
+            chosen[0]['id'], len(fitting))
+    else:
+        # Span the fewest, best scored cells that can hold the domain
+        chosen = []
+        free_memory = 0
+        cpu_count = 0
+        for s in ranked:
+            chosen.append(by_id[s['cell']])
+            free_memory += s['free_memory']
+            cpu_count += s['cpu_count']
+            if free_memory >= memory and cpu_count >= vcpu:
+                break
+        mode = 'interleave'
+        reason = 'no single cell fits, interleaving over %d cells' % len(
+            chosen)
+    cpus = _pick_cpus(chosen, committed, vcpu)
+    emulator_cpus = [cpu['id'] for cell in chosen for cpu in cell['cpus']]
+    result = {'nodeset': format_cpuset(cell['id'] for cell in chosen),
+              'mode': mode,
+              'vcpu_pinning': [str(cpu) for cpu in cpus],
+              'emulator_pinning': format_cpuset(emulator_cpus),
+              'scores': scores,
+              'reason': reason}
+    logging.debug("NUMA placement for %d vcpu, %d KiB: %s",
+                  vcpu, memory, reason)
+    return result
@@ -0,0 +1,273 @@
+""" On-demand sampling profiler for running celery workers.
+
+Profiling is switched on for the next N tasks or N seconds in every
+pool process of a worker, either by the profile remote control command
+(celery control profile, or the profile task which broadcasts it to its
+own worker) or by sending PROFILE_SIGNAL (SIGUSR2 by default) to worker
+processes. The command stores the request in RUN_DIR and signals the
+pool processes, which pick it up. Each profiled task is written to
+PROFILE_DIR named by task, pid and start time.
+
+Modes:
+wall    sample the task thread stack every PROFILE_INTERVAL seconds
+cpu     sample on SIGPROF, so only time spent on the cpu is counted
+pstats  deterministic cProfile output (higher overhead)
+
+"""
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+import hostlock
+
+PROFILE_DIR = os.getenv('PROFILE_DIR', '/tmp/vmdriver-profile')
+PROFILE_SIGNAL = os.getenv('PROFILE_SIGNAL', 'SIGUSR2')
+PROFILE_SIGNAL_TASKS = int(os.getenv('PROFILE_SIGNAL_TASKS', '20'))
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.005'))
+# Requests older than this are ignored by the signal handler (seconds)
+PROFILE_REQUEST_MAX_AGE = 10
+
+MODES = ('wall', 'cpu', 'pstats')
+
+_state = {'tasks': 0, 'until': 0.0, 'mode': 'wall', 'request': None}
+# Reentrant, the signal handler may interrupt a holder in the same thread
+_lock = threading.RLock()
+_active = {}
+
+
+def _check_mode(mode):
+    if mode not in MODES:
+        raise Exception("Unknown profiler mode %s (use one of %s)" %
+                        (mode, ', '.join(MODES)))
+
+
+def enable(tasks=None, seconds=None, mode='wall'):
+    """ Profile the next tasks tasks and/or the tasks of seconds.
+
+    Return the new profiler state.
+
+    """
+    _check_mode(mode)
+    with _lock:
+        _state['mode'] = mode
+        _state['tasks'] = int(tasks or 0)
+        _state['until'] = time.time() + float(seconds) if seconds else 0.0
+        logging.info("Profiling enabled in pid %d: %s", os.getpid(), _state)
+        return dict(_state, pid=os.getpid(), directory=PROFILE_DIR)
+
+
+def _take():
+    """ Return the mode if the starting task should be profiled. """
+    with _lock:
+        if _state['tasks'] > 0:
+            _state['tasks'] -= 1
+            return _state['mode']
+        if _state['until'] and time.time() < _state['until']:
+            return _state['mode']
+    return None
+
+
+def _frame_stack(frame):
+    """ Return the collapsed stack of frame, outermost call first. """
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append('%s:%s' % (os.path.basename(code.co_filename),
+                                code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+class _Sampler(object):
+
+    """ Collect collapsed stack samples. """
+
+    def __init__(self):
+        self.samples = {}
+
+    def add(self, frame):
+        if frame is None:
+            return
+        stack = _frame_stack(frame)
+        self.samples[stack] = self.samples.get(stack, 0) + 1
+
+    def save(self, path):
+        with open(path + '.collapsed', 'w') as f:
+            for stack, count in sorted(self.samples.items()):
+                f.write('%s %d\n' % (stack, count))
+        return path + '.collapsed'
+
+
+class WallSampler(_Sampler):
+
+    """ Sample the stack of one thread from a helper thread. """
+
+    def __init__(self, thread_id):
+        super(WallSampler, self).__init__()
+        self.thread_id = thread_id
+        self.running = True
+        self.thread = threading.Thread(target=self._run,
+                                       name='profiler-wall')
+        self.thread.daemon = True
+
+    def _run(self):
+        while self.running:
+            self.add(sys._current_frames().get(self.thread_id))
+            time.sleep(PROFILE_INTERVAL)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+
+class CpuSampler(_Sampler):
+
+    """ Sample the interrupted frame on SIGPROF (main thread only). """
+
+    def _handler(self, signum, frame):
+        self.add(frame)
+
+    def start(self):
+        self.previous = signal.signal(signal.SIGPROF, self._handler)
+        # Restart the interrupted system calls instead of failing (EINTR)
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, PROFILE_INTERVAL,
+                         PROFILE_INTERVAL)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self.previous)
+
+
+class StatsProfiler(object):
+
+    """ Deterministic profiling written as pstats file. """
+
+    def __init__(self):
+        import cProfile
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def save(self, path):
+        self.profile.dump_stats(path + '.pstats')
+        return path + '.pstats'
+
+
+def _task_prerun(task_id=None, task=None, **kw):
+    mode = _take()
+    if mode is None:
+        return
+    if mode == 'wall':
+        profiler = WallSampler(threading.current_thread().ident)
+    elif mode == 'cpu':
+        profiler = CpuSampler()
+    else:
+        profiler = StatsProfiler()
+    _active[task_id] = (profiler, task.name, time.time())
+    profiler.start()
+
+
+def _task_postrun(task_id=None, **kw):
+    active = _active.pop(task_id, None)
+    if active is None:
+        return
+    profiler, name, start = active
+    profiler.stop()
+    try:
+        if not os.path.isdir(PROFILE_DIR):
+            os.makedirs(PROFILE_DIR)
+        path = os.path.join(PROFILE_DIR, '%s-%d-%d' % (
+            name, os.getpid(), int(start * 1000)))
+        path = profiler.save(path)
+        logging.info("Profile of %s (%.3fs) saved to %s",
+                     name, time.time() - start, path)
+    except (IOError, OSError):
+        logging.exception("Unable to save profile of %s", name)
+
+
+def _signal_handler(signum, frame):
+    request = hostlock.load('profile') or {}
+    if (request.get('time') != _state['request'] and
+            time.time() - request.get('time', 0) < PROFILE_REQUEST_MAX_AGE):
+        _state['request'] = request['time']
+        enable(request['tasks'], request['seconds'], request['mode'])
+    else:
+        enable(tasks=PROFILE_SIGNAL_TASKS)
+
+
+def _install_signal(**kw):
+    signum = getattr(signal, PROFILE_SIGNAL)
+    signal.signal(signum, _signal_handler)
+    signal.siginterrupt(signum, False)
+
+
+def profile_command(state, tasks=None, seconds=None, mode='wall'):
+    """ Remote control command enabling profiling in the pool processes.
+
+    The worker main process stores the request and signals every pool
+    process. Return the signaled pids.
+
+    """
+    try:
+        _check_mode(mode)
+    except Exception as e:
+        return {'error': str(e)}
+    with hostlock.locked('profile'):
+        hostlock.save('profile', {'tasks': tasks, 'seconds': seconds,
+                                  'mode': mode, 'time': time.time()})
+    signum = getattr(signal, PROFILE_SIGNAL)
+    pids = []
+    for pid in state.consumer.pool.info.get('processes', []):
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            continue  # Exited meanwhile
+        pids.append(pid)
+    logging.info("Profiling requested in pids %s", pids)
+    return {'ok': 'profiling enabled', 'pids': pids, 'mode': mode,
+            'directory': PROFILE_DIR}
+
+
+def broadcast(app, hostname, tasks=None, seconds=None, mode='wall',
+              timeout=5):
+    """ Send the profile command to the worker called hostname.
+
+    Return the reply of the worker.
+
+    """
+    _check_mode(mode)
+    replies = app.control.broadcast(
+        'profile', arguments={'tasks': tasks, 'seconds': seconds,
+                              'mode': mode},
+        destination=[hostname], reply=True, timeout=timeout)
+    for reply in replies:
+        if hostname in reply:
+            return reply[hostname]
+    raise Exception("No reply to the profile command from %s" % hostname)
+
+
+def install(app):
+    """ Connect the profiler to celery task and worker signals. """
+    from celery.signals import (task_prerun, task_postrun,
+                                worker_process_init, worker_init)
+    from celery.worker.control import Panel
+    Panel.register(profile_command, 'profile')
+    task_prerun.connect(_task_prerun, weak=False,
+                        dispatch_uid='profiler_task_prerun')
+    task_postrun.connect(_task_postrun, weak=False,
+                         dispatch_uid='profiler_task_postrun')
+    worker_process_init.connect(_install_signal, weak=False,
+                                dispatch_uid='profiler_process_init')
+    worker_init.connect(_install_signal, weak=False,
+                        dispatch_uid='profiler_worker_init')
@@ -0,0 +1,20 @@
+""" A temporary RUN_DIR for the tests of the hostlock based modules. """
+import shutil
+import tempfile
+
+import hostlock
+
+_saved = []
+
+
+def setup():
+    """ Point hostlock at a new temporary RUN_DIR. """
+    _saved.append(hostlock.RUN_DIR)
+    hostlock.RUN_DIR = tempfile.mkdtemp()
+    return hostlock.RUN_DIR
+
+
+def teardown():
+    """ Remove the temporary RUN_DIR and restore the previous one. """
+    shutil.rmtree(hostlock.RUN_DIR, ignore_errors=True)
+    hostlock.RUN_DIR = _saved.pop()
@@ -0,0 +1,120 @@
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from nose.tools import raises
+
+import agent
+from mux import Multiplexer
+
+
+def test_encode_qemu_ga():
+    line = agent.encode('guest-ping', None, 7, protocol='qemu-ga')
+    assert json.loads(line.decode('utf-8')) == {'execute': 'guest-ping',
+                                                'id': 7}
+    assert line.endswith(b'\n')
+
+
+def test_encode_decode_circle():
+    line = agent.encode('ping', {'a': 1}, 3, protocol='circle')
+    assert json.loads(line.decode('utf-8')) == {'command': 'ping',
+                                                'args': {'a': 1},
+                                                'uuid': 3}
+    assert agent.decode({'uuid': 3, 'response': 'pong'},
+                        protocol='circle') == (3, 'pong', None)
+
+
+def test_decode_error_description():
+    message = {'id': 1, 'error': {'class': 'GenericError', 'desc': 'bad'}}
+    assert agent.decode(message, protocol='qemu-ga') == (1, None, 'bad')
+
+
+def test_lines_split_and_sync_bytes():
+    lines = agent.Lines()
+    assert lines.feed(b'\xff{"id": 1}\n{"id"') == [{'id': 1}]
+    assert lines.feed(b': 2}\nnot json\n') == [{'id': 2}]
+    assert lines.buffer == b''
+
+
+@raises(socket.error)
+def test_connect_missing_socket():
+    directory = tempfile.mkdtemp()
+    try:
+        Multiplexer().connect_unix(os.path.join(directory, 'none'),
+                                   None, None)
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_connect_does_not_wait_for_full_backlog():
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'guest')
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(0)
+    mux = Multiplexer()
+    connected = []
+    try:
+        start = time.time()
+        for i in range(8):
+            try:
+                connected.append(mux.connect_unix(path, None, None))
+            except socket.error:
+                break
+        else:
+            assert False, "backlog never filled"
+        assert time.time() - start < 1
+    finally:
+        for sock in connected:
+            mux.remove(sock)
+        server.close()
+        shutil.rmtree(directory)
+
+
+def _guest(server):
+    # Minimal qemu-ga: answer every request with its command
+    conn, _ = server.accept()
+    lines = agent.Lines()
+    while True:
+        data = conn.recv(4096)
+        if not data:
+            break
+        for message in lines.feed(data):
+            conn.sendall((json.dumps({'id': message['id'],
+                                      'return': message['execute']}) +
+                          '\n').encode('utf-8'))
+    conn.close()
+
+
+def test_pool_round_trip():
+    directory = tempfile.mkdtemp()
+    socket_format = agent.AGENT_SOCKET
+    agent.AGENT_SOCKET = os.path.join(directory, 'vio-%s')
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(agent.AGENT_SOCKET % 'vm-1')
+    server.listen(1)
+    guest = threading.Thread(target=_guest, args=(server, ))
+    guest.daemon = True
+    guest.start()
+    control = os.path.join(directory, 'agent.sock')
+    pool = agent.AgentPool()
+    pool.mux.listen_unix(control, pool._on_client)
+    pool.mux.start()
+    try:
+        client = agent.Client(control)
+        replies = client.batch([('vm-1', 'guest-ping', None),
+                                ('vm-1', 'guest-get-time', None),
+                                ('vm-2', 'guest-ping', None)], timeout=2)
+        assert replies[0] == ('guest-ping', None)
+        assert replies[1] == ('guest-get-time', None)
+        assert replies[2][0] is None
+        assert replies[2][1].startswith('agent not available')
+        client.sock.close()
+    finally:
+        agent.AGENT_SOCKET = socket_format
+        server.close()
+        shutil.rmtree(directory)
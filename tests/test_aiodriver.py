@@ -0,0 +1,70 @@
+import sys
+from unittest import SkipTest
+
+if sys.version_info < (3, 5):
+    raise SkipTest("aiodriver needs Python 3")
+try:
+    import libvirtaio  # noqa: F401
+except ImportError:
+    raise SkipTest("aiodriver needs libvirt-python with libvirtaio")
+
+import asyncio
+
+import aiodriver
+
+VM_DESC = {'name': 'aiotest', 'vcpu': 1, 'memory_max': 131072,
+           'disk_list': [], 'network_list': [], 'boot_token': 'token'}
+
+
+def _run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+def test_shutdown_on_test_driver():
+    driver = aiodriver.AsyncDriver('test:///default')
+    _run(driver.open())
+    try:
+        xml = _run(driver.create(VM_DESC))
+        assert isinstance(xml, str) and 'aiotest' in xml
+        assert 'aiotest' in _run(driver.list_domains())
+        assert _run(driver.domain_info('aiotest'))['state'] == 'PAUSED'
+        _run(driver.resume('aiotest'))
+        event = _run(driver.shutdown('aiotest', timeout=10))
+        assert event['name'] == 'aiotest'
+        assert 'aiotest' not in _run(driver.list_domains())
+    finally:
+        _run(driver.close())
+    assert driver.waiters == {}
+
+
+def test_waiter_removed_on_timeout():
+    driver = aiodriver.AsyncDriver('test:///default')
+    try:
+        _run(driver.wait_for('missing', timeout=0.01))
+    except asyncio.TimeoutError:
+        pass
+    else:
+        raise AssertionError("wait_for did not time out")
+    assert driver.waiters == {}
+
+
+def test_migrate_resolves_on_job_completed():
+    driver = aiodriver.AsyncDriver('test:///default')
+    calls = []
+
+    class _Domain(object):
+
+        def migrateToURI(self, **kw):
+            calls.append(kw)
+            driver.loop.call_soon_threadsafe(driver._publish, {
+                'name': 'aiotest', 'type': 'job', 'event': None,
+                'stats': {'downtime': 12}})
+
+    async def lookup(name):
+        return _Domain()
+    driver.lookup = lookup
+    stats = _run(driver.migrate('aiotest', 'node2', live=True, timeout=5))
+    assert stats == {'downtime': 12}
+    assert calls[0]['duri'] == 'qemu+tcp://node2/system'
+    assert calls[0]['dname'] == 'aiotest'
+    assert driver.waiters == {}
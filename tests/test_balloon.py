@@ -0,0 +1,77 @@
+import balloon
+
+MiB = 1024
+NOW = 1000000
+
+
+def _domain(name, current, used, floor=256 * MiB, maximum=4096 * MiB,
+            changed=0):
+    return {'name': name, 'current': current, 'used': used,
+            'floor': floor, 'maximum': maximum, 'changed': changed}
+
+
+def test_target_size_headroom_floor_and_maximum():
+    assert balloon.target_size(1024 * MiB, 256 * MiB, 4096 * MiB) == \
+        int(1024 * MiB * (1 + balloon.BALLOON_HEADROOM))
+    assert balloon.target_size(0, 256 * MiB, 4096 * MiB) == 256 * MiB
+    assert balloon.target_size(8192 * MiB, 256 * MiB, 4096 * MiB) == \
+        4096 * MiB
+
+
+def test_grow_without_pressure():
+    domain = _domain('vm-1', 1024 * MiB, 2048 * MiB)
+    changes = balloon.plan([domain], 0, NOW)
+    assert changes == [(domain, domain['target'], 'grow')]
+
+
+def test_no_shrink_without_pressure():
+    assert balloon.plan([_domain('vm-1', 4096 * MiB, 512 * MiB)], 0,
+                        NOW) == []
+
+
+def test_small_changes_ignored():
+    domain = _domain('vm-1', 1024 * MiB, 0)
+    domain['used'] = int(1024 * MiB / (1 + balloon.BALLOON_HEADROOM))
+    assert balloon.plan([domain], 1024 * MiB, NOW) == []
+
+
+def test_cooldown_applies_to_grow_and_reclaim():
+    recent = NOW - balloon.BALLOON_COOLDOWN + 1
+    domains = [_domain('vm-1', 1024 * MiB, 2048 * MiB, changed=recent),
+               _domain('vm-2', 4096 * MiB, 512 * MiB, changed=recent)]
+    assert balloon.plan(domains, 1024 * MiB, NOW) == []
+
+
+def test_reclaim_most_oversized_first_until_relieved():
+    small = _domain('vm-1', 2048 * MiB, 1024 * MiB)
+    large = _domain('vm-2', 4096 * MiB, 512 * MiB)
+    changes = balloon.plan([small, large], 100 * MiB, NOW)
+    assert changes == [(large, 3996 * MiB, 'reclaim')]
+
+
+def test_reclaim_step():
+    domain = _domain('vm-1', 4096 * MiB, 512 * MiB)
+    changes = balloon.plan([domain], 8192 * MiB, NOW)
+    assert changes == [(domain, 4096 * MiB - balloon.BALLOON_STEP,
+                        'reclaim')]
+
+
+def test_growth_capped_under_pressure():
+    urgent = _domain('vm-1', 512 * MiB, 2048 * MiB)
+    other = _domain('vm-2', 1024 * MiB, 1536 * MiB)
+    changes = balloon.plan([other, urgent], 1, NOW)
+    assert changes == [(urgent, 512 * MiB + balloon.BALLOON_STEP, 'grow')]
+
+
+def test_guest_without_stats_skipped():
+    assert balloon.plan([_domain('vm-1', 1024 * MiB, None)], 0, NOW) == []
+
+
+def test_fixed_backing():
+    assert not balloon.fixed_backing('<domain/>')
+    assert not balloon.fixed_backing(
+        '<domain><memoryBacking><source type="file"/>'
+        '</memoryBacking></domain>')
+    for backing in ('<hugepages/>', '<locked/>', '<source type="memfd"/>'):
+        assert balloon.fixed_backing(
+            '<domain><memoryBacking>%s</memoryBacking></domain>' % backing)
@@ -0,0 +1,71 @@
+import os
+
+import blockjobs
+import hostlock
+import rundir
+
+XML = """<domain><devices>
+<disk type='file' device='disk'>
+  <source file='/images/vm-1.qcow2'/>
+  <mirror type='file' job='copy' ready='%s'>
+    <source file='/images/vm-1-copy.qcow2'/>
+  </mirror>
+  <target dev='vda' bus='virtio'/>
+</disk>
+<disk type='file' device='disk'>
+  <source file='/images/vm-1-data.qcow2'/>
+  <target dev='vdb' bus='virtio'/>
+</disk>
+</devices></domain>"""
+
+
+def test_mirror_ready():
+    assert blockjobs.mirror_ready(XML % 'yes', 'vda')
+    assert blockjobs.mirror_ready(XML % 'yes', '/images/vm-1.qcow2')
+
+
+def test_mirror_not_ready():
+    assert not blockjobs.mirror_ready(XML % 'no', 'vda')
+    assert not blockjobs.mirror_ready(XML % 'pivot', 'vda')
+    assert not blockjobs.mirror_ready(XML % 'yes', 'vdb')
+    assert not blockjobs.mirror_ready(XML % 'yes', 'vdc')
+
+
+def test_share_of_budget():
+    rundir.setup()
+    budget = blockjobs.BLOCKJOB_BANDWIDTH
+    blockjobs.BLOCKJOB_BANDWIDTH = 100
+    try:
+        assert blockjobs.acquire('vm-1:vda', 0)
+        assert blockjobs.acquire('vm-2:vda', 20)
+        assert blockjobs.share('vm-1:vda') == 50
+        assert blockjobs.share('vm-2:vda') == 20
+        assert blockjobs.jobs()['vm-1:vda']['pid'] == os.getpid()
+        blockjobs.release('vm-2:vda')
+        assert blockjobs.share('vm-1:vda') == 100
+        assert blockjobs.acquire('vm-2:vda', 0)
+        # No free slot left, waiting is aborted
+        assert len(blockjobs.jobs()) == blockjobs.BLOCKJOB_MAX_JOBS
+        assert not blockjobs.acquire('vm-3:vda', 0, lambda: True)
+    finally:
+        blockjobs.BLOCKJOB_BANDWIDTH = budget
+        rundir.teardown()
+
+
+def test_disk_held_by_another_process():
+    rundir.setup()
+    try:
+        # pid 1 is alive
+        hostlock.save('blockjobs', {'jobs': {'vm-1:vda': {
+            'pid': 1, 'bandwidth': 0, 'started': 0}}})
+        try:
+            blockjobs.acquire('vm-1:vda', 0)
+        except Exception:
+            pass
+        else:
+            raise AssertionError("The slot of pid 1 was taken")
+        # Nor freed by the rejected job
+        blockjobs.release('vm-1:vda')
+        assert blockjobs.jobs()['vm-1:vda']['pid'] == 1
+    finally:
+        rundir.teardown()
@@ -0,0 +1,66 @@
+import bootstorm
+import rundir
+
+
+def _setup():
+    rundir.setup()
+    bootstorm.enabled = True
+
+
+def _teardown():
+    bootstorm.enabled = False
+    rundir.teardown()
+
+
+def test_slots_without_waiting():
+    _setup()
+    concurrency = bootstorm.BOOT_CONCURRENCY
+    bootstorm.BOOT_CONCURRENCY = 1
+    try:
+        waited, ticket = bootstorm.try_acquire('a')
+        assert waited is not None and ticket is None
+        waited, ticket = bootstorm.try_acquire('b')
+        assert waited is None and ticket is not None
+        # Retrying keeps one place in the queue
+        assert bootstorm.try_acquire('b', ticket=ticket) == (None, ticket)
+        assert len(bootstorm.info()['waiting']) == 1
+        assert bootstorm.release('a')
+        waited, ticket = bootstorm.try_acquire('b', ticket=ticket)
+        assert waited is not None and ticket is None
+        assert bootstorm.info()['waiting'] == []
+    finally:
+        bootstorm.BOOT_CONCURRENCY = concurrency
+        _teardown()
+
+
+def test_priority_order():
+    _setup()
+    concurrency = bootstorm.BOOT_CONCURRENCY
+    bootstorm.BOOT_CONCURRENCY = 1
+    try:
+        bootstorm.try_acquire('a')
+        low = bootstorm.try_acquire('low', 'low')[1]
+        high = bootstorm.try_acquire('high', 'high')[1]
+        bootstorm.release('a')
+        assert bootstorm.try_acquire('low', 'low', low) == (None, low)
+        assert bootstorm.try_acquire('high', 'high', high)[0] is not None
+    finally:
+        bootstorm.BOOT_CONCURRENCY = concurrency
+        _teardown()
+
+
+def test_pending_kept_until_granted():
+    _setup()
+    concurrency = bootstorm.BOOT_CONCURRENCY
+    bootstorm.BOOT_CONCURRENCY = 0
+    try:
+        bootstorm.mark_pending('a', 'high')
+        ticket = bootstorm.try_acquire('a', 'high')[1]
+        assert ticket is not None
+        assert bootstorm.pending_priority('a') == 'high'
+        bootstorm.BOOT_CONCURRENCY = 1
+        assert bootstorm.try_acquire('a', 'high', ticket)[0] is not None
+        assert bootstorm.pending_priority('a') is None
+    finally:
+        bootstorm.BOOT_CONCURRENCY = concurrency
+        _teardown()
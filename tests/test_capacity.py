@@ -0,0 +1,103 @@
+from nose.tools import raises
+
+import capacity
+import events
+import rundir
+
+XML = """<domain><vcpu>2</vcpu><memory unit='MiB'>1024</memory></domain>"""
+HUGE_XML = """<domain><vcpu>1</vcpu><memory unit='GiB'>2</memory>
+<memoryBacking><hugepages/></memoryBacking></domain>"""
+
+
+def _model():
+    model = capacity.CapacityModel()
+    model.cpus = 2
+    model.memory = 4 * 1024 * 1024 + capacity.RESERVED_MEMORY
+    return model
+
+
+def _setup():
+    rundir.setup()
+
+
+def _teardown():
+    rundir.teardown()
+
+
+def test_domain_resources():
+    assert capacity.domain_resources(XML) == (2, 1024 * 1024, 0)
+    assert capacity.domain_resources(HUGE_XML) == (1, 0, 2 * 1024 * 1024)
+
+
+def test_limits():
+    assert _model().limits() == (
+        int(2 * capacity.CPU_OVERCOMMIT),
+        int(4 * 1024 * 1024 * capacity.MEMORY_OVERCOMMIT), 0)
+
+
+def test_reservation_is_shared():
+    _setup()
+    try:
+        # Two pool processes with their own model
+        first, second = _model(), _model()
+        first.reserve('a', (1, 3 * 1024 * 1024, 0))
+        assert second.check((1, 2 * 1024 * 1024, 0)) is not None
+        assert second.check((1, 1024 * 1024, 0)) is None
+        first.release('a')
+        assert second.check((1, 2 * 1024 * 1024, 0)) is None
+    finally:
+        _teardown()
+
+
+def test_running_domain_counted_once():
+    _setup()
+    try:
+        model = _model()
+        model.reserve('a', (1, 3 * 1024 * 1024, 0))
+        model.add('a', (1, 3 * 1024 * 1024, 0))
+        assert model.headroom()['free']['memory'] == 1024 * 1024
+    finally:
+        _teardown()
+
+
+@raises(Exception)
+def test_admission_rejected():
+    _setup()
+    try:
+        _model().admit('a', (1, 5 * 1024 * 1024, 0))
+    finally:
+        _teardown()
+
+
+def test_failed_sync_does_not_subscribe_again():
+    calls = []
+    saved = (events.subscribe, events.on_connect, events.start,
+             capacity.model, capacity._subscribed)
+
+    def sync(conn):
+        calls.append(conn)
+        if len(calls) == 1:
+            raise Exception("libvirt unavailable")
+
+    def on_connect(callback):
+        subscribed.append(callback)
+        callback('conn')
+
+    subscribed = []
+    events.subscribe = lambda event_id, callback: subscribed.append(event_id)
+    events.on_connect = on_connect
+    events.start = lambda: 'conn'
+    capacity.model = _model()
+    capacity.model.sync = sync
+    capacity._subscribed = False
+    try:
+        try:
+            capacity.start()
+        except Exception:
+            pass
+        capacity.start()
+        assert calls == ['conn', 'conn']
+        assert len(subscribed) == 2
+    finally:
+        (events.subscribe, events.on_connect, events.start,
+         capacity.model, capacity._subscribed) = saved
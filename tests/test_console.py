@@ -0,0 +1,97 @@
+import os
+import shutil
+import tempfile
+
+import lxml.etree as ET
+
+import console
+import vm
+
+
+def _setup():
+    console.CONSOLE_DIR = tempfile.mkdtemp()
+
+
+def _teardown():
+    shutil.rmtree(console.CONSOLE_DIR)
+
+
+def _write(name, data, mode='ab'):
+    with open(console.log_path(name), mode) as f:
+        f.write(data)
+
+
+def test_ring_keeps_newest_output():
+    _setup()
+    size = console.CONSOLE_BUFFER
+    try:
+        console.CONSOLE_BUFFER = 8
+        ring = console.RingFile('vm-1')
+        for i in range(10):
+            ring.append(b'%d' % i * 2)
+        ring.close()
+        result = console.read('vm-1', offset=0, size=100)
+        assert result['truncated']
+        assert result['start'] == 20 - len(result['data'])
+        assert result['data'].endswith('99')
+        assert result['offset'] == 20
+    finally:
+        console.CONSOLE_BUFFER = size
+        _teardown()
+
+
+def test_tail_follows_rotation():
+    _setup()
+    try:
+        _write('vm-1', b'boot\n')
+        tail = console.LogTail('vm-1')
+        tail.poll()
+        _write('vm-1', b'login: ')
+        tail.poll()
+        # Rotated by virtlogd
+        os.rename(console.log_path('vm-1'), console.log_path('vm-1') + '.0')
+        _write('vm-1', b'root\n')
+        tail.poll()
+        tail.close()
+        assert console.read('vm-1')['data'] == 'boot\nlogin: root\n'
+    finally:
+        _teardown()
+
+
+def test_tail_waits_for_log():
+    _setup()
+    try:
+        tail = console.LogTail('vm-1')
+        tail.poll()
+        _write('vm-1', b'late\n')
+        tail.poll()
+        tail.close()
+        assert console.read('vm-1')['data'] == 'late\n'
+    finally:
+        _teardown()
+
+
+def test_expire_files_of_gone_domains():
+    _setup()
+    try:
+        for filename in ('vm-1.log', 'vm-1.serial', 'vm-1.serial.0',
+                         'vm.2.log', 'vm.2.serial', 'vm-3.log', 'other'):
+            open(os.path.join(console.CONSOLE_DIR, filename), 'w').close()
+        old = os.stat(os.path.join(console.CONSOLE_DIR, 'vm-3.log')).st_mtime
+        # The output of vm.2 is newer
+        os.utime(os.path.join(console.CONSOLE_DIR, 'vm.2.serial'),
+                 (old + 100, old + 100))
+        console.ConsoleCapture().expire(
+            set(['vm-3']), old + console.CONSOLE_EXPIRY + 1)
+        assert sorted(os.listdir(console.CONSOLE_DIR)) == [
+            'other', 'vm-3.log', 'vm.2.log', 'vm.2.serial']
+    finally:
+        _teardown()
+
+
+def test_serial_chardev_log():
+    instance = vm.VMInstance(name='vm-1', vcpu=1, memory_max=1048576,
+                             network_list=[], disk_list=[],
+                             console_log='/console/vm-1.serial')
+    log = ET.fromstring(instance.dump_xml()).find('devices/console/log')
+    assert log.attrib == {'file': '/console/vm-1.serial', 'append': 'on'}
@@ -0,0 +1,71 @@
+import cputune
+import hostlock
+import rundir
+
+
+def test_fair_shares_below_share_keep_use():
+    allocation = cputune.fair_shares({'a': (0.5, 1), 'b': (4, 1),
+                                      'c': (4, 1)}, 4)
+    assert allocation['a'] == 0.5
+    assert allocation['b'] == allocation['c'] == 1.75
+
+
+def test_fair_shares_weighted():
+    allocation = cputune.fair_shares({'a': (8, 3), 'b': (8, 1)}, 4)
+    assert allocation == {'a': 3.0, 'b': 1.0}
+
+
+def test_fair_shares_skips_zero_weight():
+    assert cputune.fair_shares({'a': (1, 0), 'b': (1, 1)}, 4) == {'b': 1}
+
+
+def _domain(name, used, vcpus=2, cpu_class='normal', created=100):
+    return {'name': name, 'used': used, 'vcpus': vcpus, 'class': cpu_class,
+            'created': created}
+
+
+def test_plan_shares_scale_with_class_and_create_time_share():
+    wanted = cputune.plan([_domain('a', 1), _domain('b', 1, created=50),
+                           _domain('c', 1, cpu_class='high')], 8, False)
+    base = cputune.CPU_TUNE_BASE_SHARES
+    assert wanted['a'] == {'cpu_shares': base * 2 * 2}
+    assert wanted['b'] == {'cpu_shares': base * 2}
+    assert wanted['c'] == {'cpu_shares': base * 4 * 2}
+
+
+def test_plan_caps_only_over_share_when_contended():
+    wanted = cputune.plan([_domain('a', 0.5, vcpus=1),
+                           _domain('b', 4, vcpus=4)], 4, True)
+    assert 'vcpu_quota' not in wanted['a']
+    share = 3.5 * (1 + cputune.CPU_TUNE_SLACK) / 4
+    assert wanted['b']['vcpu_quota'] == int(share * cputune.CPU_TUNE_PERIOD)
+    assert wanted['b']['emulator_quota'] == int(
+        cputune.CPU_TUNE_THREAD_LIMIT * cputune.CPU_TUNE_PERIOD)
+
+
+class _Dom(object):
+
+    def __init__(self):
+        self.params = []
+
+    def setSchedulerParametersFlags(self, params, flags):
+        self.params.append(params)
+
+
+def test_new_policy_lifts_persisted_caps():
+    rundir.setup()
+    try:
+        dom = _Dom()
+        capped = {'cpu_shares': 2048, 'vcpu_period': 100000,
+                  'vcpu_quota': 50000}
+        hostlock.save('cputune-applied', {'applied': {'u-1': capped},
+                                          'created': {'u-1': 100}})
+        policy = cputune.Policy(None)
+        assert policy.created == {'u-1': 100}
+        domain = dict(_domain('a', 0.1), dom=dom, uuid='u-1')
+        policy.tune([domain], {'a': {'cpu_shares': 2048}}, False)
+        assert dom.params == [{'vcpu_quota': -1, 'emulator_quota': -1,
+                               'iothread_quota': -1}]
+        assert policy.applied['u-1'] == {'cpu_shares': 2048}
+    finally:
+        rundir.teardown()
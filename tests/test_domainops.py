@@ -0,0 +1,59 @@
+from nose.tools import raises
+
+import domainops
+import metrics
+import vm
+
+XML = """<domain><devices>
+<disk type='file' device='disk'>
+  <source file='/images/vm-1-data.qcow2'/>
+  <target dev='vdb' bus='virtio'/>
+</disk>
+</devices></domain>"""
+
+
+class _Domain(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def suspend(self):
+        self.calls.append('suspend')
+
+    def XMLDesc(self, flags=0):
+        return XML
+
+
+class _Connection(object):
+
+    def __init__(self):
+        self.domain = _Domain()
+
+    def createXML(self, xml, flags):
+        self.domain.calls.append(('createXML', flags))
+        return self.domain
+
+
+def test_prepare_test_driver():
+    instance = vm.VMInstance(name='vm-1', vcpu=1, memory_max=1048576,
+                             network_list=[], disk_list=[])
+    domainops.prepare(instance)
+    assert instance.vm_type == 'test' and instance.arch == 'i686'
+
+
+def test_create_paused_on_test_driver():
+    conn = _Connection()
+    timer = metrics.PhaseTimer('create_phase_duration_seconds')
+    assert domainops.create_paused(conn, '<domain/>', 'test',
+                                   timer) is conn.domain
+    assert conn.domain.calls == [('createXML', 0), 'suspend']
+    assert sorted(timer.phases) == ['create_xml', 'suspend']
+
+
+def test_detached():
+    domainops.check_detached(_Domain(), '/images/vm-1.qcow2')
+
+
+@raises(Exception)
+def test_still_attached():
+    domainops.check_detached(_Domain(), '/images/vm-1-data.qcow2')
@@ -0,0 +1,66 @@
+import domstats
+import rundir
+
+STATS = {'net.count': 2,
+         'net.0.name': 'vm-1-0', 'net.0.rx.bytes': 1000,
+         'net.0.tx.pkts': 10,
+         'net.1.rx.bytes': 5,  # No name, skipped
+         'block.count': 1,
+         'block.0.name': 'vda', 'block.0.rd.bytes': 4096,
+         'block.0.capacity': 1073741824}
+
+
+def test_parse_devices():
+    assert domstats.parse_devices(STATS, 'net', domstats.NET_KEYS) == {
+        'vm-1-0': {'rx_bytes': 1000, 'tx_packets': 10}}
+    assert domstats.parse_devices(STATS, 'block', domstats.BLOCK_KEYS) == {
+        'vda': {'rd_bytes': 4096, 'capacity': 1073741824}}
+    assert domstats.parse_devices({}, 'net', domstats.NET_KEYS) == {}
+
+
+def test_rates_skip_gauges():
+    rundir.setup()
+    try:
+        cache = domstats.RateCache()
+        assert cache.rates({'vda': {'rd_bytes': 0, 'capacity': 10}},
+                           10) == {'vda': None}
+        assert cache.rates({'vda': {'rd_bytes': 2048, 'capacity': 10}},
+                           12) == {'vda': {'rd_bytes': 1024}}
+    finally:
+        rundir.teardown()
+
+
+def test_rates_reset_when_counter_goes_back():
+    rundir.setup()
+    try:
+        cache = domstats.RateCache()
+        cache.rates({'vm-1-0': {'rx_bytes': 1000}}, 10)
+        assert cache.rates({'vm-1-0': {'rx_bytes': 10}}, 11)['vm-1-0'] is None
+        assert cache.rates({'vm-1-0': {'rx_bytes': 20}}, 12) == {
+            'vm-1-0': {'rx_bytes': 10}}
+    finally:
+        rundir.teardown()
+
+
+def test_rates_need_time_to_pass():
+    rundir.setup()
+    try:
+        cache = domstats.RateCache()
+        cache.rates({'vda': {'rd_bytes': 0}}, 10)
+        assert cache.rates({'vda': {'rd_bytes': 10}}, 10)['vda'] is None
+    finally:
+        rundir.teardown()
+
+
+def test_rates_shared_by_processes():
+    rundir.setup()
+    try:
+        # Another worker process served the previous call
+        domstats.RateCache().rates({'a': {'rx_bytes': 0}, 'b': {}}, 1)
+        cache = domstats.RateCache()
+        assert cache.rates({'a': {'rx_bytes': 10}}, 2) == {
+            'a': {'rx_bytes': 10}}
+        # Devices that are gone are dropped
+        assert cache.rates({'b': {}}, 3) == {'b': None}
+    finally:
+        rundir.teardown()
@@ -0,0 +1,105 @@
+import threading
+
+from nose.tools import raises
+
+import drain
+
+
+class _Dom(object):
+
+    def __init__(self, name, memory, vcpus=1):
+        self._name = name
+        self.memory = memory
+        self.vcpus = vcpus
+        self.speeds = []
+
+    def name(self):
+        return self._name
+
+    def info(self):
+        return [1, self.memory, self.memory, self.vcpus, 0]
+
+    def migrateSetMaxSpeed(self, speed, flags):
+        self.speeds.append(speed)
+
+    def jobInfo(self):
+        return [0] * 12
+
+
+class _Conn(object):
+
+    def __init__(self, domains):
+        self.domains = domains
+
+    def listDomainsID(self):
+        return list(range(len(self.domains)))
+
+    def lookupByID(self, i):
+        return self.domains[i]
+
+
+def _conn():
+    return _Conn([_Dom('vm-big', 4096, 2), _Dom('vm-small', 1024, 4),
+                  _Dom('pool-x', 512), _Dom('vm-mid', 2048, 1)])
+
+
+def _resolve(name):
+    return None if name.startswith('pool-') else name
+
+
+@raises(Exception)
+def test_no_target():
+    drain.Drain(_conn(), [], None)
+
+
+def test_candidate_orders():
+    for order, names in (('memory', ['vm-small', 'vm-mid', 'vm-big']),
+                         ('largest', ['vm-big', 'vm-mid', 'vm-small']),
+                         ('vcpus', ['vm-mid', 'vm-big', 'vm-small'])):
+        job = drain.Drain(_conn(), ['h1'], None, order=order)
+        assert [c['name'] for c in job.candidates(_resolve)] == names
+
+
+def test_dirty_rate_order_unmeasured_last():
+    job = drain.Drain(_conn(), ['h1'], None, order='dirty_rate',
+                      sample=lambda conn, domains: {'vm-big': 1.0,
+                                                    'vm-mid': 5.0})
+    assert [c['name'] for c in job.candidates(_resolve)] == [
+        'vm-big', 'vm-mid', 'vm-small']
+
+
+def test_bandwidth_share():
+    job = drain.Drain(_conn(), ['h1'], None, bandwidth_budget=100)
+    assert job.share() == 100
+    job.active = {'a': {}, 'b': {}, 'c': {}}
+    assert job.share() == 33
+    assert drain.Drain(_conn(), ['h1'], None).share() == 0
+
+
+def test_run_retries_on_next_target():
+    lock = threading.Lock()
+    calls = []
+
+    def migrate(domain, name, host, live, bandwidth, dirty_rate):
+        with lock:
+            calls.append((name, host))
+        if name == 'vm-mid' and host == 'h1':
+            raise Exception("target full")
+        if name == 'vm-big':
+            raise Exception("always fails")
+
+    interval = drain.DRAIN_POLL_INTERVAL
+    drain.DRAIN_POLL_INTERVAL = 0.01
+    try:
+        job = drain.Drain(_conn(), ['h1', 'h2'], migrate, max_parallel=1,
+                          retries=1)
+        result = job.run(_resolve)
+    finally:
+        drain.DRAIN_POLL_INTERVAL = interval
+    migrated = dict((m['name'], m['target']) for m in result['migrated'])
+    assert migrated == {'vm-small': 'h1', 'vm-mid': 'h2'}
+    assert result['failed'] == {'vm-big': 'always fails'}
+    assert calls.count(('vm-big', 'h1')) + calls.count(('vm-big', 'h2')) \
+        == 2
+    assert not result['aborted']
+    assert job.progress()['percent'] == 100.0
@@ -0,0 +1,97 @@
+import eventpub
+import rundir
+
+
+class _Dom(object):
+
+    def __init__(self, name):
+        self._name = name
+
+    def name(self):
+        return self._name
+
+
+class _Producer(object):
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.messages = []
+
+    def publish(self, message, routing_key):
+        if self.fail:
+            raise IOError("connection lost")
+        self.messages.append(dict(message))
+
+
+def _setup():
+    rundir.setup()
+    publisher = eventpub.Publisher('memory://', 'node1')
+    publisher.producer = _Producer()
+    return publisher
+
+
+def _teardown():
+    rundir.teardown()
+
+
+def test_host_name():
+    assert eventpub.host_name('node1.vm.fast') == 'node1'
+    assert eventpub.host_name('node1.example.com') == 'node1'
+
+
+def test_coalesce_same_domain_and_kind():
+    publisher = _setup()
+    try:
+        publisher.on_lifecycle(_Dom('vm-1'), 2, 0)
+        publisher.on_lifecycle(_Dom('vm-1'), 5, 1)
+        publisher.on_reboot(_Dom('vm-1'))
+        assert publisher.flush() == 2
+        lifecycle, reboot = publisher.producer.messages
+        assert lifecycle['event'] == 'STOPPED'
+        assert lifecycle['count'] == 2
+        assert (lifecycle['seq'], reboot['seq']) == (1, 2)
+        assert reboot['host'] == 'node1'
+        assert eventpub.info()['seq'] == 2
+    finally:
+        _teardown()
+
+
+def test_io_errors_of_devices_kept_apart():
+    publisher = _setup()
+    try:
+        publisher.on_io_error(_Dom('vm-1'), '/a', 'virtio-disk0', 1, 'eio')
+        publisher.on_io_error(_Dom('vm-1'), '/b', 'virtio-disk1', 1, 'eio')
+        assert publisher.flush() == 2
+    finally:
+        _teardown()
+
+
+def test_dropped_events_leave_sequence_gap():
+    publisher = _setup()
+    max_pending = eventpub.EVENT_MAX_PENDING
+    try:
+        eventpub.EVENT_MAX_PENDING = 1
+        publisher.on_reboot(_Dom('vm-1'))
+        publisher.on_reboot(_Dom('vm-2'))
+        publisher.flush()
+        message, = publisher.producer.messages
+        assert message['name'] == 'vm-2'
+        assert message['seq'] == 2
+    finally:
+        eventpub.EVENT_MAX_PENDING = max_pending
+        _teardown()
+
+
+def test_failed_publish_keeps_events():
+    publisher = _setup()
+    try:
+        publisher.producer = _Producer(fail=True)
+        publisher.on_reboot(_Dom('vm-1'))
+        publisher._connect = lambda: setattr(publisher, 'producer',
+                                             _Producer())
+        assert publisher.flush() == 0
+        assert publisher.producer is None
+        assert publisher.flush() == 1
+        assert publisher.producer.messages[0]['seq'] == 1
+    finally:
+        _teardown()
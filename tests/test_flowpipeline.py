@@ -0,0 +1,125 @@
+import flowpipeline
+import netdriver
+from vm import VMNetwork
+
+MAC = "02:00:00:00:00:01"
+
+
+def _legacy_flows(network, port_number=5):
+    """ Return the add-flow rules of netdriver without the pipeline. """
+    flows = []
+    saved = dict((name, getattr(netdriver, name)) for name in (
+        'ofctl_command_execute', 'ovs_command_execute',
+        'get_fport_for_network', 'pull_up_interface', 'native_ovs',
+        'driver'))
+    enabled = flowpipeline.enabled
+
+    def ofctl(command):
+        if command[0] == 'add-flow':
+            flows.append(command[2])
+    try:
+        flowpipeline.enabled = False
+        netdriver.ofctl_command_execute = ofctl
+        netdriver.ovs_command_execute = lambda command: None
+        netdriver.get_fport_for_network = lambda network: port_number
+        netdriver.pull_up_interface = lambda network: 0
+        netdriver.native_ovs = True
+        netdriver.driver = 'kvm'
+        netdriver.port_create(network)
+    finally:
+        flowpipeline.enabled = enabled
+        for name, value in saved.items():
+            setattr(netdriver, name, value)
+    return flows
+
+
+def _match(flow, key):
+    for item in flow.split(','):
+        if item.startswith(key + '='):
+            return item.split('=', 1)[1]
+
+
+def _priority(flow):
+    return int(_match(flow, 'priority'))
+
+
+def _network(ipv4, ipv6, managed=True):
+    return VMNetwork(name="vm-1", mac=MAC, ipv4=ipv4, ipv6=ipv6,
+                     managed=managed)
+
+
+def test_legacy_flow_count_matches_netdriver():
+    for ipv4, ipv6, count4, count6 in (
+            ("10.0.0.1", "2001:db8::1", 1, 1),
+            (["10.0.0.1", "10.0.0.2"], "2001:db8::1", 2, 1),
+            ("10.0.0.1, 10.0.0.2", ["2001:db8::1", "2001:db8::2"], 2, 2),
+            ("10.0.0.1", "None", 1, 0)):
+        flows = _legacy_flows(_network(ipv4, ipv6))
+        assert len(flows) == flowpipeline.legacy_flow_count(
+            True, count4, count6)
+    assert len(_legacy_flows(_network("10.0.0.1", "None", False))) == \
+        flowpipeline.legacy_flow_count(False)
+
+
+def test_legacy_splits_address_lists():
+    flows = _legacy_flows(_network(["10.0.0.1", "10.0.0.2"],
+                                   "2001:db8::1,2001:db8::2"))
+    sources = set(_match(flow, 'nw_src') or _match(flow, 'ipv6_src')
+                  for flow in flows)
+    assert sources == set([None, "10.0.0.1", "10.0.0.2", "2001:db8::1",
+                           "2001:db8::2", "FE80::/64"])
+
+
+def test_dhcp_rules_match_legacy():
+    legacy = _legacy_flows(_network("10.0.0.1", "None"))
+    ban = [f for f in legacy if _match(f, 'tp_dst') == '68']
+    client = [f for f in legacy if _match(f, 'tp_dst') == '67']
+    assert [_priority(f) for f in ban] == [43000]
+    assert ban[0].endswith('actions=drop')
+    assert [_priority(f) for f in client] == [40000]
+    assert client[0].endswith('actions=normal')
+    pipeline = flowpipeline.global_flows()
+    pipe_ban = [f for f in pipeline if 'tp_dst=68' in f]
+    pipe_client = [f for f in pipeline if 'tp_dst=67' in f]
+    assert pipe_ban[0].endswith('actions=drop')
+    assert pipe_client[0].endswith('actions=normal')
+    # The server ban wins over every allowed address in both
+    allowed = [f for f in flowpipeline.port_flows(5, MAC, True, "10.0.0.1")
+               if _match(f, 'table') == str(flowpipeline.IP_TABLE)]
+    assert _priority(pipe_ban[0]) > max(_priority(f) for f in allowed)
+    assert _priority(ban[0]) > max(
+        _priority(f) for f in legacy if _match(f, 'nw_src'))
+
+
+def test_neighbor_advertisement_matches_legacy():
+    legacy = [f for f in _legacy_flows(_network("None", "2001:db8::1"))
+              if 'icmp6' in f]
+    pipeline = [f for f in flowpipeline.port_flows(
+        5, MAC, True, None, "2001:db8::1") if 'icmp6' in f]
+    assert len(legacy) == len(pipeline) == 1
+    for flow in legacy + pipeline:
+        assert _match(flow, 'ipv6_src').lower() == "fe80::/64"
+        assert _match(flow, 'icmp_type') == "136"
+        assert _match(flow, 'nd_target') == "2001:db8::1"
+    assert _priority(legacy[0]) == 42001
+    # Above the source address rule, like the legacy filter
+    source = [f for f in flowpipeline.port_flows(
+        5, MAC, True, None, "2001:db8::1") if 'ipv6,' in f]
+    assert _priority(pipeline[0]) > _priority(source[0])
+
+
+def test_pipeline_flows_per_port():
+    flows = flowpipeline.port_flows(5, MAC, True, ["10.0.0.1", "10.0.0.2"],
+                                    "2001:db8::1")
+    assert len(flows) == 2 + 2 * 2 + 2
+    cookie = flowpipeline.cookie(5)
+    assert all(f.startswith("cookie=0x%x," % cookie) for f in flows)
+    assert len(flowpipeline.port_flows(5, MAC, False)) == 2
+
+
+def test_addresses():
+    assert flowpipeline.addresses(None) == []
+    assert flowpipeline.addresses("None") == []
+    assert flowpipeline.addresses("10.0.0.1, 10.0.0.2") == [
+        "10.0.0.1", "10.0.0.2"]
+    assert flowpipeline.addresses(["10.0.0.1"]) == ["10.0.0.1"]
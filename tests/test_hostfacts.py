@@ -0,0 +1,36 @@
+import hostfacts
+
+CAPABILITIES = """<capabilities>
+<host><cpu><arch>x86_64</arch><model>Haswell</model><vendor>Intel</vendor>
+<topology sockets="1" cores="2" threads="2"/>
+<feature name="vmx"/><feature name="pdpe1gb"/>
+<pages unit="KiB" size="4"/><pages unit="KiB" size="2048"/>
+<pages unit="KiB" size="1048576"/></cpu>
+<topology><cells num="1"><cell id="0"><memory unit="KiB">8388608</memory>
+<cpus num="1"><cpu id="0" socket_id="0" core_id="0" siblings="0"/></cpus>
+</cell></cells></topology></host>
+<guest><arch name="x86_64"><machine canonical="pc-i440fx-2.1">pc</machine>
+<machine>q35</machine><domain type="kvm"><machine>pc</machine>
+<machine>pc-i440fx-2.1</machine></domain></arch></guest>
+</capabilities>"""
+
+
+def test_parse_capabilities():
+    facts = hostfacts.parse_capabilities(CAPABILITIES)
+    assert facts['arch'] == 'x86_64'
+    assert facts['cpu_model'] == 'Haswell'
+    assert facts['cpu_vendor'] == 'Intel'
+    assert facts['cpu_features'] == ['vmx', 'pdpe1gb']
+    assert facts['topology'] == {'sockets': 1, 'cores': 2, 'threads': 2}
+    assert facts['hugepage_sizes'] == [2048, 1048576]
+    assert facts['machine_types'] == {
+        'x86_64': ['pc', 'pc-i440fx-2.1', 'q35']}
+    assert facts['numa_cells'][0]['memory'] == 8388608
+
+
+def test_parse_minimal_capabilities():
+    facts = hostfacts.parse_capabilities('<capabilities/>')
+    assert facts['topology'] is None
+    assert facts['numa_cells'] == []
+    assert facts['hugepage_sizes'] == []
+    assert facts['machine_types'] == {}
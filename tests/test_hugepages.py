@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+
+import lxml.etree as ET
+
+import hugepages
+import vm
+
+
+def _setup(nodes):
+    """ Fake sysfs and meminfo: nodes is node -> size -> (total, free). """
+    root = tempfile.mkdtemp()
+    for node, sizes in nodes.items():
+        for size, (total, free) in sizes.items():
+            path = os.path.join(root, 'node%d' % node, 'hugepages',
+                                'hugepages-%dkB' % size)
+            os.makedirs(path)
+            for name, value in (('nr_hugepages', total),
+                                ('free_hugepages', free)):
+                with open(os.path.join(path, name), 'w') as f:
+                    f.write('%d\n' % value)
+    with open(os.path.join(root, 'meminfo'), 'w') as f:
+        f.write('MemTotal:       16384000 kB\nHugepagesize:       2048 kB\n')
+    hugepages.SYSFS_NODE_PATH = root
+    hugepages.MEMINFO_PATH = os.path.join(root, 'meminfo')
+    return root
+
+
+def _teardown(root):
+    shutil.rmtree(root)
+    hugepages.SYSFS_NODE_PATH = '/sys/devices/system/node'
+    hugepages.MEMINFO_PATH = '/proc/meminfo'
+
+
+def test_host_hugepages_and_free_pages():
+    root = _setup({0: {2048: (512, 100), 1048576: (2, 1)},
+                   1: {2048: (512, 300)}})
+    try:
+        assert hugepages.default_size() == 2048
+        nodes = hugepages.host_hugepages()
+        assert nodes[0][2048] == {'total': 512, 'free': 100}
+        assert hugepages.free_pages(2048) == 400
+        assert hugepages.free_pages(2048, "1") == 300
+        assert hugepages.free_pages(1048576, "1") == 0
+    finally:
+        _teardown(root)
+
+
+def test_fits():
+    root = _setup({0: {2048: (512, 100)}})
+    try:
+        assert hugepages.pages_needed(2049, 2048) == 2
+        assert hugepages.fits(100 * 2048) == (True, 100, 100, 2048)
+        assert hugepages.fits(100 * 2048 + 1)[0] is False
+    finally:
+        _teardown(root)
+
+
+def test_memory_backing_xml():
+    instance = vm.VMInstance(name="vm-1", vcpu=1, memory_max=2097152,
+                             disk_list=[], network_list=[], hugepages=True,
+                             hugepage_size=2048, hugepage_nodeset="0",
+                             locked=True,
+                             memory_source='memfd', memory_access='shared')
+    backing = ET.fromstring(instance.dump_xml()).find('memoryBacking')
+    page = backing.find('hugepages/page')
+    assert page.attrib == {'size': '2048', 'unit': 'KiB', 'nodeset': '0'}
+    assert backing.find('locked') is not None
+    assert backing.find('source').get('type') == 'memfd'
+    assert backing.find('access').get('mode') == 'shared'
+
+
+def test_no_memory_backing_by_default():
+    instance = vm.VMInstance(name="vm-1", vcpu=1, memory_max=2097152,
+                             disk_list=[], network_list=[])
+    assert ET.fromstring(instance.dump_xml()).find('memoryBacking') is None
@@ -0,0 +1,110 @@
+import time
+
+import libvirt
+
+import hostlock
+import inventory
+import rundir
+import warmpool
+
+
+class _Domain(object):
+
+    def __init__(self, name, memory=1024):
+        self._name = name
+        self.memory = memory
+
+    def name(self):
+        return self._name
+
+    def isActive(self):
+        return True
+
+    def info(self):
+        return [1, 2048, self.memory, 1, 0]
+
+
+class _Connection(object):
+
+    def __init__(self, domains):
+        self.domains = dict((dom.name(), dom) for dom in domains)
+
+    def listDomainsID(self):
+        return sorted(self.domains)
+
+    def lookupByID(self, i):
+        return self.domains[i]
+
+    def lookupByName(self, name):
+        return self.domains[name]
+
+
+def _parse_info(values):
+    return dict(zip(['state', 'maxmem', 'memory', 'virtcpunum', 'cputime'],
+                    values))
+
+
+def _since(table, since_token):
+    hostlock.save('inventory', table.state())
+    return inventory.since(since_token)
+
+
+def test_incremental_changes():
+    rundir.setup()
+    try:
+        table = inventory.Table(_parse_info)
+        conn = _Connection([_Domain('a'), _Domain('b')])
+        assert table.resync(conn)
+        first = _since(table, None)
+        assert first['full'] and sorted(first['added']) == ['a', 'b']
+        # Cputime only does not count
+        assert not table.put('a', _parse_info([1, 2048, 1024, 1, 5]))
+        conn.domains['a'].memory = 512
+        del conn.domains['b']
+        assert table.resync(conn)
+        second = _since(table, first['token'])
+        assert not second['full']
+        assert second['removed'] == ['b']
+        assert [d['name'] for d in second['domains']] == ['a']
+        assert _since(table, 'other-epoch:1')['full']
+    finally:
+        rundir.teardown()
+
+
+def test_tombstone_of_released_pool_domain():
+    rundir.setup()
+    warmpool.enabled = True
+    try:
+        hostlock.save('warmpool', {'templates': {}, 'stats': {},
+                                   'aliases': {'vm-1': 'warm-t-0000aaaa'}})
+        table = inventory.Table(_parse_info)
+        conn = _Connection([_Domain('warm-t-0000aaaa')])
+        table.resync(conn)
+        assert list(table.domains) == ['vm-1']
+        # The alias is released before the stop is handled
+        hostlock.save('warmpool', {'templates': {}, 'stats': {},
+                                   'aliases': {}})
+        time.sleep(0.01)
+        del conn.domains['warm-t-0000aaaa']
+
+        def missing(name):
+            error = libvirt.libvirtError('no domain')
+            error.get_error_code = lambda: libvirt.VIR_ERR_NO_DOMAIN
+            raise error
+        conn.lookupByName = missing
+        assert table.refresh(conn, ['warm-t-0000aaaa'])
+        assert list(table.tombstones) == ['vm-1']
+    finally:
+        warmpool.enabled = False
+        rundir.teardown()
+
+
+def test_stale_table_not_served():
+    rundir.setup()
+    try:
+        state = inventory.Table(_parse_info).state()
+        state['time'] -= inventory.INVENTORY_STALE + 1
+        hostlock.save('inventory', state)
+        assert inventory.since(None) is None
+    finally:
+        rundir.teardown()
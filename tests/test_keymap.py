@@ -0,0 +1,44 @@
+from nose.tools import raises
+
+import keymap
+import linuxkeys as k
+
+
+def test_parse_chord():
+    assert keymap.parse_chord("ctrl+alt+f2") == [k.KEY_LEFTCTRL,
+                                                 k.KEY_LEFTALT, k.KEY_F2]
+    assert keymap.parse_chord("KEY_ENTER") == [k.KEY_ENTER]
+    assert keymap.parse_chord("+") == [k.KEY_LEFTSHIFT, k.KEY_EQUAL]
+
+
+@raises(Exception)
+def test_unknown_key():
+    keymap.parse_chord("ctrl+nokey")
+
+
+@raises(Exception)
+def test_chord_limit():
+    keymap.parse_chord("+".join(["a"] * (keymap.MAX_KEYS + 1)))
+
+
+def test_text_packs_same_shift_state():
+    assert keymap.text_to_calls("ab!A") == [
+        [k.KEY_A, k.KEY_B], [k.KEY_LEFTSHIFT, k.KEY_1, k.KEY_A]]
+
+
+def test_text_repeated_key_starts_new_call():
+    assert keymap.text_to_calls("aa\n") == [[k.KEY_A], [k.KEY_A, k.KEY_ENTER]]
+
+
+def test_text_without_packing():
+    assert keymap.text_to_calls("ab", pack=False) == [[k.KEY_A], [k.KEY_B]]
+
+
+def test_text_pack_limit():
+    calls = keymap.text_to_calls("abcdefghijklmnopqrstuvwxyz")
+    assert [len(call) for call in calls] == [keymap.MAX_KEYS, 10]
+
+
+@raises(Exception)
+def test_untypeable_character():
+    keymap.text_to_calls(u"\xe9")
@@ -0,0 +1,46 @@
+import os
+import tempfile
+
+from nose.tools import raises
+
+import loadtest
+
+
+def test_parse_mix():
+    assert loadtest.parse_mix("create=4, delete") == {'create': 4.0,
+                                                      'delete': 1.0}
+
+
+@raises(Exception)
+def test_parse_mix_unknown_operation():
+    loadtest.parse_mix("create=1,reboot=1")
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert loadtest.percentile(values, 50) == 50
+    assert loadtest.percentile(values, 99) == 99
+    assert loadtest.percentile([7], 90) == 7
+    assert loadtest.percentile([], 50) is None
+
+
+def test_call_counts_from_offset():
+    fd, log = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write("ovs-vsctl get Interface vm-1 ofport\n"
+                    "ovs-ofctl add-flow cloud x\n")
+        counts, offset = loadtest._call_counts(log, 0)
+        assert counts == {'ovs-vsctl': 1, 'ovs-ofctl': 1}
+        with open(log, 'a') as f:
+            f.write("ip link set up vm-1\n")
+        assert loadtest._call_counts(log, offset)[0] == {'ip': 1}
+    finally:
+        os.unlink(log)
+
+
+def test_net_desc_addresses_unique():
+    first, second = loadtest.net_desc('a', 1), loadtest.net_desc('b', 257)
+    assert first['mac'] != second['mac']
+    assert first['ipv4'] == '10.0.0.1'
+    assert second['ipv4'] == '10.0.1.1'
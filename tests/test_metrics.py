@@ -0,0 +1,79 @@
+import os
+import subprocess
+import time
+
+import metrics
+import rundir
+
+
+def _setup():
+    metrics.enabled = True
+    rundir.setup()
+    metrics._flusher.update(pid=os.getpid(), file=os.path.join(
+        metrics._directory(), 'test.json'))
+
+
+def _teardown():
+    metrics.enabled = False
+    metrics._flusher.update(pid=None, file=None)
+    rundir.teardown()
+
+
+def test_render_histogram():
+    # 16 buckets, then the sum and the count
+    data = [1, 0, 2] + [0] * 13 + [0.01, 3]
+    state = ({}, {'latency': {(('call', 'create'), ): data}})
+    text = metrics.render(state)
+    assert 'latency_bucket{call="create",le="0.001"} 1' in text
+    assert 'latency_bucket{call="create",le="0.005"} 3' in text
+
+
+def test_flush_and_collect():
+    _setup()
+    try:
+        metrics.inc('calls_total', call='create')
+        metrics.observe('latency', 0.002, call='create')
+        metrics.flush()
+        # Another pool process
+        with open(os.path.join(metrics._directory(), '1-1.json'), 'w') as f:
+            f.write('{"counters": [["calls_total", [["call", "create"]], 2]'
+                    '], "histograms": []}')
+        counters, histograms = metrics.collect()
+        assert counters['calls_total'][(('call', 'create'), )] == 3
+        assert histograms['latency'][(('call', 'create'), )][-1] == 1
+        text = metrics.render((counters, histograms))
+        assert 'calls_total{call="create"} 3' in text
+        metrics.clear()
+        assert metrics.collect() == ({}, {})
+    finally:
+        _teardown()
+
+
+def test_retire_exited_processes():
+    _setup()
+    try:
+        directory = metrics._directory()
+        dead = subprocess.Popen(['true'])
+        dead.wait()
+        for filename, value in (('%d-1.json' % dead.pid, 2),
+                                ('%d-1.json' % os.getpid(), 5),
+                                ('%d-2.json' % os.getpid(), 1)):
+            with open(os.path.join(directory, filename), 'w') as f:
+                f.write('{"counters": [["calls_total", [], %d]], '
+                        '"histograms": []}' % value)
+        # The dead pid and the older file of the reused pid
+        assert metrics.retire() == 2
+        assert sorted(os.listdir(directory)) == [
+            '%d-2.json' % os.getpid(), 'retired.json']
+        counters, _ = metrics.collect()
+        assert counters['calls_total'][()] == 8
+        assert metrics.retire() == 0
+    finally:
+        _teardown()
+
+
+def test_monotonic_clock():
+    clock = metrics._monotonic()
+    first = clock()
+    assert clock() >= first
+    assert metrics.clock is not time.time
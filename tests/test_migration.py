@@ -0,0 +1,47 @@
+import migration
+
+ALL = list(migration.STRATEGIES)
+GiB = 1048576
+
+
+def test_unknown_dirty_rate():
+    choice = migration.plan(GiB, None, available=ALL)
+    assert choice['strategy'] == 'precopy'
+    assert choice['reason'] == 'dirty rate unknown'
+
+
+def test_precopy_converges():
+    choice = migration.plan(GiB, 100, available=ALL)
+    assert choice['strategy'] == 'precopy'
+    assert choice['connections'] == 1
+    speed = migration.MIGRATION_STREAM_BANDWIDTH
+    assert abs(choice['estimate'] -
+               1024.0 / speed / (1 - 100.0 / speed)) < 1e-9
+
+
+def test_parallel_for_more_bandwidth():
+    choice = migration.plan(GiB, 300, available=ALL)
+    assert choice['strategy'] == 'parallel'
+    assert choice['connections'] == 3
+
+
+def test_compression_without_parallel():
+    available = [s for s in ALL if s != 'parallel']
+    assert migration.plan(GiB, 300, available=available)['strategy'] == \
+        'compression'
+
+
+def test_limited_bandwidth_single_connection():
+    choice = migration.plan(GiB, 100, bandwidth=150, available=ALL)
+    assert choice['strategy'] == 'compression'
+    assert choice['connections'] == 1
+
+
+def test_no_convergence():
+    assert migration.plan(GiB, 2000, allow_postcopy=True,
+                          available=ALL)['strategy'] == 'postcopy'
+    choice = migration.plan(GiB, 2000, available=ALL)
+    assert choice['strategy'] == 'auto_converge'
+    assert choice['estimate'] is None
+    assert migration.plan(GiB, 2000, available=['precopy'])['strategy'] == \
+        'precopy'
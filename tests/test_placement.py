@@ -0,0 +1,74 @@
+import placement
+
+CAPABILITIES = """<capabilities><host><topology><cells num="2">
+<cell id="0"><memory unit="KiB">%d</memory><cpus num="4">
+<cpu id="0" socket_id="0" core_id="0" siblings="0,2"/>
+<cpu id="1" socket_id="0" core_id="1" siblings="1,3"/>
+<cpu id="2" socket_id="0" core_id="0" siblings="0,2"/>
+<cpu id="3" socket_id="0" core_id="1" siblings="1,3"/>
+</cpus></cell>
+<cell id="1"><memory unit="KiB">%d</memory><cpus num="4">
+<cpu id="4" socket_id="1" core_id="0" siblings="4,6"/>
+<cpu id="5" socket_id="1" core_id="1" siblings="5,7"/>
+<cpu id="6" socket_id="1" core_id="0" siblings="4,6"/>
+<cpu id="7" socket_id="1" core_id="1" siblings="5,7"/>
+</cpus></cell>
+</cells></topology></host></capabilities>"""
+
+GiB = 1048576
+
+
+def _cells(memory0=4 * GiB, memory1=4 * GiB):
+    return placement.parse_topology(CAPABILITIES % (memory0, memory1))
+
+
+def test_cpuset_round_trip():
+    assert placement.parse_cpuset("0-3,^2,8") == set([0, 1, 3, 8])
+    assert placement.parse_cpuset("") == set()
+    assert placement.format_cpuset([8, 0, 1, 3]) == "0-1,3,8"
+
+
+def test_parse_topology():
+    cells = _cells()
+    assert [cell['id'] for cell in cells] == [0, 1]
+    assert cells[0]['memory'] == 4 * GiB
+    assert cells[1]['cpus'][0] == {'id': 4, 'socket_id': 1, 'core_id': 0,
+                                   'siblings': [4, 6]}
+
+
+def test_committed_resources():
+    cells = _cells()
+    xml = ("<domain><vcpu>2</vcpu><memory>%d</memory>"
+           "<cputune><vcpupin vcpu='0' cpuset='1'/></cputune>"
+           "<numatune><memory nodeset='1'/></numatune></domain>" % GiB)
+    committed = placement.committed_resources(cells, [xml])
+    assert committed['cpus'][1] == 1 + 1.0 / 8
+    assert committed['cpus'][0] == 1.0 / 8
+    assert committed['memory'] == {0: 0, 1: GiB}
+
+
+def test_place_prefers_free_cell_one_thread_per_core():
+    cells = _cells()
+    committed = placement.committed_resources(cells, [
+        "<domain><vcpu>1</vcpu><memory>%d</memory>"
+        "<numatune><memory nodeset='0'/></numatune></domain>" % (3 * GiB)])
+    result = placement.place(cells, committed, 2, GiB)
+    assert result['nodeset'] == "1"
+    assert result['mode'] == 'strict'
+    assert sorted(result['vcpu_pinning']) == ['4', '5']
+    assert result['emulator_pinning'] == "4-7"
+    assert [s['fits'] for s in result['scores']] == [True, True]
+
+
+def test_place_interleaves_when_no_cell_fits():
+    cells = _cells()
+    committed = placement.committed_resources(cells, [])
+    result = placement.place(cells, committed, 2, 6 * GiB)
+    assert result['mode'] == 'interleave'
+    assert result['nodeset'] == "0-1"
+    reasons = [s['reason'] for s in result['scores']]
+    assert reasons == ['not enough free memory'] * 2
+
+
+def test_place_without_topology():
+    assert placement.place([], {'cpus': {}, 'memory': {}}, 1, GiB) is None
@@ -0,0 +1,45 @@
+import threading
+import time
+
+from nose.tools import raises
+
+import hostlock
+import profiler
+import rundir
+
+
+@raises(Exception)
+def test_unknown_mode():
+    profiler.enable(tasks=1, mode='perf')
+
+
+def test_take_tasks():
+    profiler.enable(tasks=2, mode='cpu')
+    assert profiler._take() == 'cpu'
+    assert profiler._take() == 'cpu'
+    assert profiler._take() is None
+
+
+def test_signal_picks_up_request():
+    rundir.setup()
+    try:
+        hostlock.save('profile', {'tasks': 1, 'seconds': None,
+                                  'mode': 'pstats', 'time': time.time()})
+        profiler._signal_handler(None, None)
+        assert profiler._take() == 'pstats'
+        assert profiler._take() is None
+        # The same request is not applied twice
+        profiler._signal_handler(None, None)
+        assert profiler._state['tasks'] == profiler.PROFILE_SIGNAL_TASKS
+        assert profiler._state['mode'] == 'wall'
+    finally:
+        profiler.enable(tasks=0)
+        rundir.teardown()
+
+
+def test_wall_sampler():
+    sampler = profiler.WallSampler(threading.current_thread().ident)
+    sampler.start()
+    time.sleep(0.05)
+    sampler.stop()
+    assert any('test_wall_sampler' in stack for stack in sampler.samples)
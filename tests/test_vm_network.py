@@ -0,0 +1,43 @@
+import lxml.etree as ET
+
+import vm
+
+
+def test_no_driver_by_default():
+    net = vm.VMNetwork(name="vm-88", mac="02:00:00:00:00:00")
+    assert ET.fromstring(net.dump_xml()).find('driver') is None
+
+
+def test_queues_from_vcpu():
+    net = vm.VMNetwork(name="vm-88", mac="02:00:00:00:00:00")
+    driver = ET.fromstring(net.dump_xml(vcpu=4)).find('driver')
+    assert driver.get('queues') == '4'
+    assert driver.get('name') is None
+
+
+def test_queues_capped():
+    net = vm.VMNetwork(name="vm-88", mac="02:00:00:00:00:00")
+    assert net.get_queues(64) == net.max_queues
+    assert net.get_queues(None) == 1
+
+
+def test_explicit_queues_and_driver():
+    net = vm.VMNetwork(name="vm-88", mac="02:00:00:00:00:00", queues=2,
+                       driver_name='vhost',
+                       driver_options={'txmode': 'iothread'})
+    driver = ET.fromstring(net.dump_xml(vcpu=8)).find('driver')
+    assert driver.attrib == {'name': 'vhost', 'queues': '2',
+                             'txmode': 'iothread'}
+
+
+def test_driver_only_for_virtio():
+    net = vm.VMNetwork(name="vm-88", mac="02:00:00:00:00:00",
+                       model='e1000', driver_name='vhost')
+    assert ET.fromstring(net.dump_xml(vcpu=4)).find('driver') is None
+
+
+def test_qos_bandwidth():
+    net = vm.VMNetwork(name="vm-88", mac="02:00:00:00:00:00",
+                       QoS={'inbound': {'average': 1000, 'burst': 256}})
+    inbound = ET.fromstring(net.dump_xml()).find('bandwidth/inbound')
+    assert inbound.attrib == {'average': '1000', 'burst': '256'}
@@ -0,0 +1,205 @@
+import os
+
+import libvirt
+from nose.tools import raises
+
+import hostlock
+import rundir
+import warmpool
+
+TEMPLATE = {'name': 'template', 'vcpu': 1, 'memory_max': 1048576,
+            'disk_list': [{'name': 'vda', 'source': '/images/base'}],
+            'network_list': [],
+            'graphics': {'type': 'vnc', 'listen': '0.0.0.0', 'port': -1,
+                         'passwd': ''},
+            'boot_token': ''}
+# A create() request of the manager for a pooled template
+REQUEST = {'name': 'cloud-4711', 'vcpu': 1, 'memory_max': 1048576,
+           'memory': 1048576, 'cpu_share': 100, 'boot_menu': False,
+           'raw_data': '', 'acpi': True,
+           'disk_list': [{'source': '/datastore/ubuntu-base',
+                          'driver_type': 'qcow2', 'target_device': 'vda'}],
+           'network_list': [{'name': 'cloud-4711-0', 'bridge': 'vm',
+                             'mac': '02:00:0a:00:00:2a',
+                             'ipv4': '10.0.0.42', 'ipv6': None,
+                             'vlan': 1100, 'managed': True}],
+           'graphics': {'type': 'vnc', 'listen': '0.0.0.0', 'port': -1,
+                        'passwd': 'Xy3kPq9w'},
+           'boot_token': 'b0d7a1c2e3f4'}
+
+
+class _Domain(object):
+
+    def __init__(self, name, persistent=False):
+        self._name = name
+        self.persistent = persistent
+
+    def name(self):
+        return self._name
+
+    def isPersistent(self):
+        return self.persistent
+
+
+class _Connection(object):
+
+    def __init__(self, names):
+        self.names = names
+
+    def listDomainsID(self):
+        return list(range(len(self.names)))
+
+    def lookupByID(self, i):
+        return _Domain(self.names[i])
+
+
+def _request(**kw):
+    desc = dict(TEMPLATE, name='vm-1', boot_token='token',
+                network_list=[{'name': 'vm-1-0', 'mac': '02:00:00:00:00:01'}])
+    desc.update(kw)
+    return desc
+
+
+def test_matches_delivered_keys():
+    assert warmpool.matches(TEMPLATE, _request())
+
+
+def test_mismatch_memory():
+    assert not warmpool.matches(TEMPLATE, _request(memory_max=2097152))
+
+
+def test_mismatch_disks():
+    assert not warmpool.matches(TEMPLATE, _request(
+        disk_list=[{'name': 'vda', 'source': '/images/vm-1'}]))
+
+
+def test_mismatch_graphics():
+    assert not warmpool.matches(TEMPLATE, _request(
+        graphics=dict(TEMPLATE['graphics'], port=5901)))
+
+
+@raises(Exception)
+def test_fixed_graphics_port_rejected():
+    warmpool.configure('small', dict(TEMPLATE, graphics=dict(
+        TEMPLATE['graphics'], port=5900)), 2)
+
+
+def test_matches_realistic_request():
+    template = dict(REQUEST, name='ubuntu', network_list=[], boot_token='',
+                    graphics=dict(REQUEST['graphics'], passwd=''))
+    assert warmpool.matches(template, REQUEST)
+    # A per VM disk is not served from the pool
+    assert not warmpool.matches(template, dict(REQUEST, disk_list=[
+        dict(REQUEST['disk_list'][0], source='/datastore/cloud-4711')]))
+
+
+def test_graphics_password():
+    xml = warmpool.graphics_xml(
+        "<domain><devices><graphics type='vnc' port='5903' "
+        "autoport='yes'/></devices></domain>", 'Xy3kPq9w')
+    assert b"passwd=\"Xy3kPq9w\"" in xml and b"port=\"5903\"" in xml
+
+
+def _pool(aliases, overlays):
+    directory = rundir.setup()
+    warmpool.enabled = True
+    paths = {}
+    for domain_name in overlays:
+        paths[domain_name] = [os.path.join(directory, domain_name + '-0')]
+        open(paths[domain_name][0], 'w').close()
+    state = warmpool._empty_state()
+    state['aliases'] = aliases
+    state['overlays'] = paths
+    hostlock.save('warmpool', state)
+    return paths
+
+
+def _teardown():
+    warmpool.enabled = False
+    rundir.teardown()
+
+
+def test_release_removes_overlays():
+    paths = _pool({'vm-1': 'warm-small-1'}, ['warm-small-1', 'vm-2'])
+    try:
+        warmpool.release('vm-1')
+        assert not os.path.exists(paths['warm-small-1'][0])
+        # A template request created on a pool miss
+        warmpool.release('vm-2')
+        assert not os.path.exists(paths['vm-2'][0])
+        assert hostlock.load('warmpool')['overlays'] == {}
+    finally:
+        _teardown()
+
+
+def test_migrated_vm_keeps_overlays():
+    paths = _pool({'vm-1': 'warm-small-1'}, ['warm-small-1'])
+    try:
+        warmpool.forget('vm-1')
+        assert warmpool.resolve('vm-1') == 'vm-1'
+        assert os.path.exists(paths['warm-small-1'][0])
+    finally:
+        _teardown()
+
+
+def test_saved_domain_keeps_overlays():
+    paths = _pool({'vm-1': 'warm-small-1'}, ['warm-small-1'])
+    try:
+        warmpool.on_lifecycle(_Domain('warm-small-1'),
+                              libvirt.VIR_DOMAIN_EVENT_STOPPED,
+                              libvirt.VIR_DOMAIN_EVENT_STOPPED_SAVED)
+        warmpool.on_lifecycle(_Domain('warm-small-1', persistent=True),
+                              libvirt.VIR_DOMAIN_EVENT_STOPPED,
+                              libvirt.VIR_DOMAIN_EVENT_STOPPED_SHUTDOWN)
+        assert warmpool.resolve('vm-1') == 'warm-small-1'
+        assert os.path.exists(paths['warm-small-1'][0])
+        warmpool.on_lifecycle(_Domain('warm-small-1'),
+                              libvirt.VIR_DOMAIN_EVENT_STOPPED,
+                              libvirt.VIR_DOMAIN_EVENT_STOPPED_SHUTDOWN)
+        assert warmpool.resolve('vm-1') == 'vm-1'
+        assert not os.path.exists(paths['warm-small-1'][0])
+    finally:
+        _teardown()
+
+
+def test_state_reread_on_replace():
+    _pool({'vm-1': 'warm-small-1'}, [])
+    try:
+        assert warmpool.resolve('vm-1') == 'warm-small-1'
+        st = os.stat(hostlock.path('warmpool.json'))
+        state = hostlock.load('warmpool')
+        state['aliases'] = {'vm-1': 'warm-small-2'}
+        hostlock.save('warmpool', state)
+        # Same mtime, new file
+        os.utime(hostlock.path('warmpool.json'), (st.st_atime, st.st_mtime))
+        assert warmpool.resolve('vm-1') == 'warm-small-2'
+    finally:
+        _teardown()
+
+
+def test_claim_mismatch_falls_through():
+    rundir.setup()
+    try:
+        warmpool.configure('small', TEMPLATE, 2)
+        assert warmpool.claim(None, 'small', 'vm-1',
+                              _request(vcpu=4)) is None
+        assert warmpool.claim(None, 'missing', 'vm-1', _request()) is None
+        stats = hostlock.load('warmpool')['stats']
+        assert stats['mismatches'] == 2 and stats['hits'] == 0
+    finally:
+        rundir.teardown()
+
+
+def test_claim_hit():
+    rundir.setup()
+    warmpool.enabled = True
+    try:
+        warmpool.configure('small', TEMPLATE, 2)
+        conn = _Connection(['warm-small-0000aaaa', 'other'])
+        assert warmpool.claim(conn, 'small', 'vm-1',
+                              _request()) == 'warm-small-0000aaaa'
+        assert warmpool.resolve('vm-1') == 'warm-small-0000aaaa'
+        assert warmpool.claim(conn, 'small', 'vm-2', _request()) is None
+    finally:
+        warmpool.enabled = False
+        rundir.teardown()
@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+
+from nose.tools import raises
+
+import xmlstore
+
+XML = u'<domain><name>vm-1</name></domain>'
+
+
+def _setup():
+    xmlstore.XML_STORE_DIR = tempfile.mkdtemp()
+
+
+def _teardown():
+    shutil.rmtree(xmlstore.XML_STORE_DIR)
+    xmlstore.XML_STORE_DIR = None
+
+
+def _object(xml_hash):
+    return os.path.join(xmlstore.XML_STORE_DIR, 'objects',
+                        xml_hash + '.xml')
+
+
+def test_put_get_deduplicated():
+    _setup()
+    try:
+        xml_hash = xmlstore.put('vm-1', XML)
+        assert xmlstore.put('vm-2', XML) == xml_hash
+        assert xmlstore.get('vm-1') == xmlstore.get(xml_hash) == XML
+        assert xmlstore.info()['objects'] == 1
+        assert xmlstore.info()['names'] == 2
+    finally:
+        _teardown()
+
+
+def test_put_rewrites_evicted_object():
+    _setup()
+    try:
+        xml_hash = xmlstore.put('vm-1', XML)
+        os.unlink(_object(xml_hash))
+        xmlstore.put('vm-2', XML)
+        assert xmlstore.get('vm-2') == XML
+    finally:
+        _teardown()
+
+
+def test_evict_least_recent_over_size():
+    _setup()
+    max_bytes = xmlstore.XML_STORE_MAX_BYTES
+    try:
+        old = xmlstore.put('vm-1', XML)
+        os.utime(_object(old), (1000, 1000))
+        new = xmlstore.put('vm-2', XML.replace('vm-1', 'vm-2'))
+        xmlstore.XML_STORE_MAX_BYTES = os.path.getsize(_object(new))
+        assert xmlstore.evict() == 1
+        assert not os.path.exists(_object(old))
+        assert xmlstore.get('vm-2')
+    finally:
+        xmlstore.XML_STORE_MAX_BYTES = max_bytes
+        _teardown()
+
+
+def test_evict_drops_names_of_missing_objects():
+    _setup()
+    try:
+        xml_hash = xmlstore.put('vm-1', XML)
+        os.unlink(_object(xml_hash))
+        xmlstore.evict()
+        assert xmlstore.lookup('vm-1') is None
+    finally:
+        _teardown()
+
+
+@raises(Exception)
+def test_get_missing():
+    _setup()
+    try:
+        xmlstore.get('vm-1')
+    finally:
+        _teardown()
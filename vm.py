@@ -1,6 +1,16 @@
+import os
+
 import lxml.etree as ET
 
-from vmcelery import native_ovs
+# Same switch as vmcelery.native_ovs, read here so the model does not
+# import celery
+native_ovs = os.getenv('NATIVE_OVS', 'False').lower() in (
+    "true", "yes", "y", "t")
+
+# Namespace of the balloon controller metadata (see balloon.py)
+BALLOON_NS = 'http://circlecloud.org/vmdriver/balloon'
+# Namespace of the CPU tuning metadata (see cputune.py)
+CPUTUNE_NS = 'http://circlecloud.org/vmdriver/cputune'
 
 
 # VM Instance class
@@ -36,7 +46,21 @@ class VMInstance:
                  raw_data="",
                  boot_token="",
                  seclabel_type="dynamic",
-                 seclabel_mode="apparmor"):
+                 seclabel_mode="apparmor",
+                 vcpu_pinning=None,
+                 emulator_pinning=None,
+                 numa_nodeset=None,
+                 numa_mode="strict",
+                 hugepages=False,
+                 hugepage_size=None,
+                 hugepage_nodeset=None,
+                 nosharepages=False,
+                 locked=False,
+                 memory_source=None,
+                 memory_access=None,
+                 memory_min=None,
+                 cpu_class=None,
+                 console_log=None):
         '''Default Virtual Machine constructor
         name    - unique name for the instance
         vcpu    - nubmer of processors
@@ -52,6 +76,23 @@ class VMInstance:
         acpi        - True/False to enable acpi
         seclabel_type - libvirt security label type
         seclabel_mode - libvirt security mode (selinux, apparmor)
+        vcpu_pinning  - list of host cpusets indexed by vcpu number
+        emulator_pinning - host cpuset for the emulator threads
+        numa_nodeset  - host NUMA nodes for guest memory (e.g. "0" or "0-1")
+        numa_mode     - numatune memory mode (strict, preferred, interleave)
+        hugepages     - True/False to back guest memory with hugepages
+        hugepage_size - hugepage size in KiB (host default if None)
+        hugepage_nodeset - host NUMA nodes to take the hugepages from
+        nosharepages  - True/False to disable KSM page sharing
+        locked        - True/False to lock guest memory in host RAM
+        memory_source - memory backing source (anonymous, file, memfd)
+        memory_access - memory access mode (shared, private)
+        memory_min    - balloon floor in KiB, the guest is never shrunk
+                        below it by the balloon controller
+        cpu_class     - tenant class of the CPU tuning policy (see
+                        cputune.py), default class if not set
+        console_log   - file the serial console output is appended to
+                        (see console.py), not logged if None
         '''
         self.name = name
         self.emulator = emulator
@@ -73,6 +114,20 @@ class VMInstance:
         self.seclabel_type = seclabel_type
         self.seclabel_mode = seclabel_mode
         self.boot_token = boot_token
+        self.vcpu_pinning = vcpu_pinning
+        self.emulator_pinning = emulator_pinning
+        self.numa_nodeset = numa_nodeset
+        self.numa_mode = numa_mode
+        self.hugepages = hugepages
+        self.hugepage_size = hugepage_size
+        self.hugepage_nodeset = hugepage_nodeset
+        self.nosharepages = nosharepages
+        self.locked = locked
+        self.memory_source = memory_source
+        self.memory_access = memory_access
+        self.memory_min = memory_min
+        self.cpu_class = cpu_class
+        self.console_log = console_log
 
     @classmethod
     def deserialize(cls, desc):
@@ -105,9 +160,56 @@ class VMInstance:
                           'threads': str(1)})
         ET.SubElement(xml_top, 'memory').text = str(self.memory_max)
         ET.SubElement(xml_top, 'currentMemory').text = str(self.memory)
+        if self.memory_min or self.cpu_class:
+            metadata = ET.SubElement(xml_top, 'metadata')
+        if self.memory_min:
+            ET.SubElement(metadata, '{%s}balloon' % BALLOON_NS,
+                          attrib={'min': str(self.memory_min)},
+                          nsmap={'balloon': BALLOON_NS})
+        if self.cpu_class:
+            ET.SubElement(metadata, '{%s}cputune' % CPUTUNE_NS,
+                          attrib={'class': str(self.cpu_class)},
+                          nsmap={'cputune': CPUTUNE_NS})
+        # Memory backing
+        if (self.hugepages or self.nosharepages or self.locked or
+                self.memory_source or self.memory_access):
+            backing = ET.SubElement(xml_top, 'memoryBacking')
+            if self.hugepages:
+                hugepages = ET.SubElement(backing, 'hugepages')
+                if self.hugepage_size:
+                    page = ET.SubElement(hugepages, 'page',
+                                         attrib={
+                                             'size': str(self.hugepage_size),
+                                             'unit': 'KiB'})
+                    if self.hugepage_nodeset:
+                        page.set('nodeset', str(self.hugepage_nodeset))
+            if self.nosharepages:
+                ET.SubElement(backing, 'nosharepages')
+            if self.locked:
+                ET.SubElement(backing, 'locked')
+            if self.memory_source:
+                ET.SubElement(backing, 'source',
+                              attrib={'type': self.memory_source})
+            if self.memory_access:
+                ET.SubElement(backing, 'access',
+                              attrib={'mode': self.memory_access})
         # Cpu tune
         cputune = ET.SubElement(xml_top, 'cputune')
         ET.SubElement(cputune, 'shares').text = str(self.cpu_share)
+        if self.vcpu_pinning:
+            for vcpu, cpuset in enumerate(self.vcpu_pinning):
+                ET.SubElement(cputune, 'vcpupin',
+                              attrib={'vcpu': str(vcpu),
+                                      'cpuset': str(cpuset)})
+        if self.emulator_pinning:
+            ET.SubElement(cputune, 'emulatorpin',
+                          attrib={'cpuset': str(self.emulator_pinning)})
+        # NUMA memory placement
+        if self.numa_nodeset:
+            numatune = ET.SubElement(xml_top, 'numatune')
+            ET.SubElement(numatune, 'memory',
+                          attrib={'mode': self.numa_mode,
+                                  'nodeset': str(self.numa_nodeset)})
         # Os specific options
         os = ET.SubElement(xml_top, 'os')
         ET.SubElement(os, 'type', attrib={'arch': self.arch}).text = "hvm"
@@ -119,7 +221,7 @@ class VMInstance:
         for disk in self.disk_list:
             devices.append(disk.build_xml())
         for network in self.network_list:
-            devices.append(network.build_xml())
+            devices.append(network.build_xml(self.vcpu))
         # Serial console
         serial = ET.SubElement(devices,
                                'console',
@@ -132,6 +234,11 @@ class VMInstance:
                       attrib={'mode': 'bind',
                               'path': '/var/lib/libvirt/serial/%s'
                               % self.name})
+        if self.console_log:
+            ET.SubElement(serial,
+                          'log',
+                          attrib={'file': self.console_log,
+                                  'append': 'on'})
         # Virtio console
         virtio = ET.SubElement(devices,
                                'channel',
@@ -242,12 +349,20 @@ class VMNetwork:
     name            -- network device name
     bridge          -- bridg for the port
     mac             -- the MAC address of the quest interface
-    ipv4            -- the IPv4 address of virtual machine (Flow control)
-    ipv6            -- the IPv6 address of virtual machine (Flow controlo)
+    ipv4            -- the IPv4 address of virtual machine (Flow control),
+                       or several (list or comma separated)
+    ipv6            -- the IPv6 address of virtual machine (Flow controlo),
+                       or several (list or comma separated)
     vlan            -- Port VLAN configuration
     network_type    -- need to be "ethernet" by default
     model           -- available models in libvirt
-    QoS             -- CIRCLE QoS class?
+    QoS             -- bandwidth shaping dict with optional 'inbound' and
+                       'outbound' keys, each a dict of average/peak (KB/s),
+                       burst (KB) and floor (KB/s, inbound only)
+    queues          -- virtio-net queue count (sized from vcpus if None)
+    driver_name     -- virtio-net backend driver (vhost, qemu), libvirt
+                       picks one if None
+    driver_options  -- extra <driver> attributes (e.g. txmode, event_idx)
     comment         -- Any comment
     managed         -- Apply managed flow rules for spoofing prevent
     script          -- Executable network script /bin/true by default
@@ -259,6 +374,10 @@ class VMNetwork:
     mac = None
     model = None
     QoS = None
+    queues = None
+    driver_name = None
+    driver_options = None
+    max_queues = 8
     script_exec = '/bin/true'
     comment = None
     vlan = 0
@@ -277,7 +396,10 @@ class VMNetwork:
                  model='virtio',
                  QoS=None,
                  vlan=0,
-                 managed=False):
+                 managed=False,
+                 queues=None,
+                 driver_name=None,
+                 driver_options=None):
         self.name = name
         self.bridge = bridge
         self.mac = mac
@@ -297,13 +419,27 @@ class VMNetwork:
         self.QoS = QoS
         self.vlan = vlan
         self.managed = managed
+        self.queues = queues
+        self.driver_name = driver_name
+        self.driver_options = driver_options
 
     @classmethod
     def deserialize(cls, desc):
         return cls(**desc)
 
+    def get_queues(self, vcpu=None):
+        ''' Return the queue count: explicit or one per vcpu (capped).
+        '''
+        if self.queues is not None:
+            return int(self.queues)
+        if vcpu is None or self.model != 'virtio':
+            return 1
+        return max(1, min(int(vcpu), self.max_queues))
+
     # XML dump
-    def build_xml(self):
+    def build_xml(self, vcpu=None):
+        ''' Return the interface Element, vcpu sizes multiqueue.
+        '''
         xml_top = ET.Element('interface', attrib={'type': self.network_type})
         if self.vlan > 0 and self.network_type == "bridge":
             xml_vlan = ET.SubElement(xml_top, 'vlan')
@@ -318,11 +454,32 @@ class VMNetwork:
         ET.SubElement(xml_top, 'target', attrib={'dev': self.name})
         ET.SubElement(xml_top, 'mac', attrib={'address': self.mac})
         ET.SubElement(xml_top, 'model', attrib={'type': self.model})
+        if self.model == 'virtio':
+            driver = {}
+            if self.driver_name:
+                driver['name'] = self.driver_name
+            queues = self.get_queues(vcpu)
+            if queues > 1:
+                driver['queues'] = str(queues)
+            if self.driver_options:
+                driver.update((k, str(v))
+                              for k, v in self.driver_options.items())
+            if driver:
+                ET.SubElement(xml_top, 'driver', attrib=driver)
+        # Bandwidth shaping (QoS given as anything else is ignored)
+        if isinstance(self.QoS, dict) and self.QoS:
+            bandwidth = ET.SubElement(xml_top, 'bandwidth')
+            for direction in ('inbound', 'outbound'):
+                limits = self.QoS.get(direction)
+                if limits:
+                    ET.SubElement(bandwidth, direction,
+                                  attrib=dict((k, str(v))
+                                              for k, v in limits.items()))
         # ET.SubElement(xml_top, 'rom', attrib={'bar': 'off'}) Bugged (hot-plug
         # failure)
         return xml_top
 
-    def dump_xml(self):
-        return ET.tostring(self.build_xml(), encoding='utf8',
+    def dump_xml(self, vcpu=None):
+        return ET.tostring(self.build_xml(vcpu), encoding='utf8',
                            method='xml',
                            pretty_print=True)
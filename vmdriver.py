@@ -3,8 +3,9 @@ import libvirt
 import logging
 import os
 import sys
-import socket
-import json
+import functools
+import copy
+import threading
 from decorator import decorator
 import lxml.etree as ET
 
@@ -12,13 +13,45 @@ from psutil import NUM_CPUS, virtual_memory, cpu_percent
 
 from celery.contrib.abortable import AbortableTask
 
-from vm import VMInstance, VMDisk, VMNetwork
-
-from vmcelery import celery, lib_connection, to_bool
+from vm import VMInstance, VMDisk
+
+import placement
+import hugepages
+import metrics
+import profiler
+import capacity
+import warmpool
+import domstats
+import blockjobs
+import console
+import keymap
+import hostfacts
+import eventpub
+import inventory
+import drain
+import migration
+import bootstorm
+import agent
+import balloon
+import cputune
+import xmlstore
+import domainops
+
+from vmcelery import celery, lib_connection, to_bool, HOSTNAME
 
 sys.path.append(os.path.dirname(os.path.basename(__file__)))
 
-vm_xml_dump = None
+metrics.install(celery)
+profiler.install(celery)
+warmpool.install(celery)
+console.install(celery)
+eventpub.install(celery, HOSTNAME)
+agent.install(celery)
+balloon.install(celery)
+cputune.install(celery)
+
+# Name and hash of the domain xml handled by the task (for errors)
+_xml_context = threading.local()
 
 state_dict = {0: 'NOSTATE',
               1: 'RUNNING',
@@ -98,17 +131,22 @@ def wrap_libvirtError(original_function, *args, **kw):
     Return decorated function
 
     """
+    saved = getattr(_xml_context, 'ref', None)
     try:
         return original_function(*args, **kw)
     except libvirt.libvirtError as e:
-        logging.error(e.get_error_message())
+        metrics.inc('libvirt_errors_total',
+                    function=original_function.__name__)
         e_msg = e.get_error_message()
-        if vm_xml_dump is not None:
-            e_msg += "\n"
-            e_msg += vm_xml_dump
-        new_e = Exception(e.get_error_message())
+        ref = getattr(_xml_context, 'ref', None)
+        if ref is not None:
+            e_msg += " (domain xml of %s: %s)" % ref
+        logging.error(e_msg)
+        new_e = Exception(e_msg)
         new_e.libvirtError = True
         raise new_e
+    finally:
+        _xml_context.ref = saved
 
 
 @wrap_libvirtError
@@ -121,12 +159,13 @@ def connect(connection_string='qemu:///system'):
     """
     if not to_bool(os.getenv('LIBVIRT_KEEPALIVE', "False")):
         if Connection.get() is None:
-            Connection.set(libvirt.open(connection_string))
+            Connection.set(metrics.instrument(
+                libvirt.open(connection_string)))
             logging.debug("Connection estabilished to libvirt.")
         else:
             logging.debug("There is already an active connection to libvirt.")
     else:
-        Connection.set(lib_connection)
+        Connection.set(metrics.instrument(lib_connection))
         logging.debug("Using celery libvirt connection connection.")
 
 
@@ -149,17 +188,25 @@ def disconnect():
 @wrap_libvirtError
 def define(vm):
     """ Define permanent virtual machine from xml. """
-    Connection.get().defineXML(vm.dump_xml())
+    xml = vm.dump_xml()
+    _store_domain_xml(vm.name, xml)
+    Connection.get().defineXML(xml)
     logging.info("Virtual machine %s is defined from xml", vm.name)
 
 
 @celery.task
 @req_connection
 @wrap_libvirtError
-def create(vm_desc):
+def create(vm_desc, with_timings=False):
     """ Create and start non-permanent virtual machine from xml.
 
-    Return the domain info dict.
+    Return the domain xml, or if with_timings is set a dict with
+    the xml and the seconds spent in each phase:
+    deserialize, placement, overlays (warm pool templates only),
+    build_xml, admission, create_xml, suspend (test driver only),
+    context and total.
+    The optional boot_priority key of vm_desc (high, normal, low) is
+    the boot throttling class used by the first resume.
     flags can be:
         VIR_DOMAIN_NONE = 0
         VIR_DOMAIN_START_PAUSED = 1
@@ -168,36 +215,203 @@ def create(vm_desc):
         VIR_DOMAIN_START_FORCE_BOOT = 8
 
     """
-    vm = VMInstance.deserialize(vm_desc)
+    timer = metrics.PhaseTimer('create_phase_duration_seconds')
+    template = vm_desc.pop('warm_pool', None)
+    boot_priority = vm_desc.pop('boot_priority', 'normal')
+    # deserialize modifies the descriptor
+    request = copy.deepcopy(vm_desc) if template is not None else None
+    with timer.phase('deserialize'):
+        vm = VMInstance.deserialize(vm_desc)
+    if template is not None and warmpool.enabled:
+        with timer.phase('warm_pool'):
+            domain_name = warmpool.claim(Connection.get(), template,
+                                         vm.name, request)
+        if domain_name is not None:
+            try:
+                vm_xml_dump = _deliver_pooled(vm, domain_name, timer)
+            except Exception:
+                logging.exception("Unable to deliver %s from warm pool, "
+                                  "creating it", vm.name)
+                try:
+                    Connection.get().lookupByName(domain_name).destroy()
+                except libvirt.libvirtError:
+                    pass  # Already gone
+                warmpool.release(vm.name)
+            else:
+                _store_domain_xml(vm.name, vm_xml_dump)
+                bootstorm.mark_pending(vm.name, boot_priority)
+                timings = timer.result()
+                if with_timings:
+                    return {'xml': vm_xml_dump, 'timings': timings}
+                return vm_xml_dump
     # Setting proper hypervisor
-    vm.vm_type = os.getenv("HYPERVISOR_TYPE", "test")
-    if vm.vm_type == "test":
-        vm.arch = "i686"
-    vm_xml_dump = vm.dump_xml()
-    logging.info(vm_xml_dump)
-    # Emulating DOMAIN_START_PAUSED FLAG behaviour on test driver
-    if vm.vm_type == "test":
-        Connection.get().createXML(
-            vm_xml_dump, libvirt.VIR_DOMAIN_NONE)
-        domain = lookupByName(vm.name)
-        domain.suspend()
-    # Real driver create
-    else:
-        Connection.get().createXML(
-            vm_xml_dump, libvirt.VIR_DOMAIN_START_PAUSED)
+    domainops.prepare(vm)
+    with timer.phase('placement'):
+        if (vm.vm_type != "test" and
+                to_bool(os.getenv('NUMA_PLACEMENT', "False")) and
+                not vm.vcpu_pinning and not vm.numa_nodeset):
+            _apply_numa_placement(vm)
+        if vm.hugepages and vm.vm_type != "test":
+            _check_hugepages(vm)
+    if template is not None and warmpool.enabled and vm.vm_type != "test":
+        with timer.phase('overlays'):
+            warmpool.use_overlays(vm)
+    with timer.phase('build_xml'):
+        vm_xml_dump = vm.dump_xml()
+    _store_domain_xml(vm.name, vm_xml_dump)
+    with timer.phase('admission'):
+        resources = _admit(vm.name, vm_xml_dump)
+    try:
+        domainops.create_paused(Connection.get(), vm_xml_dump, vm.vm_type,
+                                timer)
         logging.info("Virtual machine %s is created from xml", vm.name)
+    except Exception:
+        _release(vm.name, resources)
+        warmpool.release(vm.name)
+        raise
+    _commit(vm.name, resources)
+    bootstorm.mark_pending(vm.name, boot_priority)
     # context
-    try:
-        sock = socket.create_connection(('127.0.0.1', 1235), 3)
-        data = {'boot_token': vm.boot_token,
-                'socket': '/var/lib/libvirt/serial/%s' % vm.name}
-        sock.sendall(json.dumps(data))
-        sock.close()
-    except socket.error:
-        logging.error('Unable to connect to context server')
+    with timer.phase('context'):
+        domainops.notify_context(vm.boot_token, vm.name)
+    timings = timer.result()
+    logging.debug("Create phases of %s: %s", vm.name, timings)
+    if with_timings:
+        return {'xml': vm_xml_dump, 'timings': timings}
     return vm_xml_dump
 
 
+def _deliver_pooled(vm, domain_name, timer):
+    """ Turn the claimed pool domain into the VM described by vm.
+
+    Return the xml of the delivered domain.
+
+    """
+    domain = Connection.get().lookupByName(domain_name)
+    with timer.phase('attach_network'):
+        vcpu = domain.info()[3]
+        for net in vm.network_list:
+            domain.attachDevice(net.dump_xml(vcpu))
+    if vm.graphics and vm.graphics.get('passwd'):
+        domain.updateDeviceFlags(
+            warmpool.graphics_xml(domain.XMLDesc(0), vm.graphics['passwd']),
+            libvirt.VIR_DOMAIN_AFFECT_LIVE)
+    domain.setMetadata(libvirt.VIR_DOMAIN_METADATA_TITLE, vm.name,
+                       None, None, libvirt.VIR_DOMAIN_AFFECT_LIVE)
+    with timer.phase('context'):
+        domainops.notify_context(vm.boot_token, domain_name)
+    logging.info("Virtual machine %s is delivered from warm pool as %s",
+                 vm.name, domain_name)
+    return domain.XMLDesc(0)
+
+
+@celery.task
+def warmpool_configure(template, vm_desc, size):
+    """ Keep size paused domains of template ready in the warm pool.
+
+    vm_desc is a create() descriptor, its name, networks, boot token
+    and graphics password are ignored. Only create() requests with an
+    otherwise equal descriptor are served from the pool, the graphics
+    port must be -1 and disk_list names the base images the domains
+    get overlays of. Size 0 stops replenishing the template.
+
+    """
+    warmpool.configure(template, vm_desc, size)
+
+
+@celery.task
+@req_connection
+@wrap_libvirtError
+def warmpool_info():
+    """ Return warm pool sizes, ready domains, hit rate and replenish
+    latency. """
+    return warmpool.info(Connection.get())
+
+
+def _admit(name, xml):
+    """ Check the domain against the host capacity model.
+
+    Only active if ADMISSION_CONTROL is set, see capacity.py.
+    Return the resources of the domain or None.
+
+    """
+    if not to_bool(os.getenv('ADMISSION_CONTROL', "False")):
+        return None
+    resources = capacity.domain_resources(xml)
+    capacity.start().admit(name, resources)
+    return resources
+
+
+def _commit(name, resources):
+    """ Count a started domain before its lifecycle event arrives. """
+    if resources is not None:
+        capacity.model.add(name, resources)
+
+
+def _release(name, resources):
+    """ Give back the admission of a domain which failed to start. """
+    if resources is not None:
+        capacity.model.release(name)
+
+
+@celery.task
+def capacity_info():
+    """ Return the capacity limits, committed and free resources.
+
+    Keys are vcpus, memory (KiB) and hugepage_memory (KiB).
+
+    """
+    return capacity.start().headroom()
+
+
+@celery.task
+def reserve_capacity(name, vcpus, memory, hugepages=False):
+    """ Reserve capacity for an incoming migration of domain name.
+
+    memory is in KiB. The reservation is shared by the worker processes
+    of the host and released when the domain stops or after
+    RESERVATION_TIMEOUT seconds.
+
+    """
+    resources = (vcpus, 0, memory) if hugepages else (vcpus, memory, 0)
+    capacity.start().reserve(name, resources)
+
+
+def _store_domain_xml(name, xml):
+    """ Store the domain xml and log its hash (see xmlstore.py).
+
+    Errors of the running task refer to the stored xml.
+
+    """
+    xml_hash = xmlstore.put(name, xml)
+    _xml_context.ref = (name, xml_hash)
+    logging.info("Domain xml of %s is %s", name, xml_hash)
+
+
+def _check_hugepages(vm):
+    """ Reject or fall back to normal pages if hugepages would not fit.
+
+    If HUGEPAGE_FALLBACK is set the domain is created on normal pages,
+    otherwise an exception is raised.
+
+    """
+    fits, needed, free, size = hugepages.fits(
+        vm.memory_max, vm.hugepage_size,
+        vm.hugepage_nodeset or vm.numa_nodeset)
+    if fits:
+        vm.hugepage_size = size
+        return
+    msg = ("Not enough free %s KiB hugepages for %s: %d needed, %d free" %
+           (size, vm.name, needed, free))
+    if to_bool(os.getenv('HUGEPAGE_FALLBACK', "False")):
+        logging.warning("%s, falling back to normal pages", msg)
+        vm.hugepages = False
+        vm.hugepage_size = None
+        vm.hugepage_nodeset = None
+    else:
+        raise Exception(msg)
+
+
 class shutdown(AbortableTask):
     """ Shutdown virtual machine (need ACPI support).
     Return When domain is missiing.
@@ -218,9 +432,11 @@ class shutdown(AbortableTask):
             logging.info("Domain shutdown called for vm: %s", name)
             while True:
                 try:
-                    Connection.get().lookupByName(name)
+                    Connection.get().lookupByName(warmpool.resolve(name))
                 except libvirt.libvirtError as e:
                     if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
+                        warmpool.release(name)
+                        bootstorm.release(name)
                         return
                     else:
                         raise
@@ -242,6 +458,8 @@ def delete(name):
     """ Destroy the running called 'name' virtual machine. """
     domain = lookupByName(name)
     domain.destroy()
+    warmpool.release(name)
+    bootstorm.release(name)
 
 
 @celery.task
@@ -256,7 +474,9 @@ def list_domains():
     domain_list = []
     for i in Connection.get().listDomainsID():
         dom = Connection.get().lookupByID(i)
-        domain_list.append(dom.name())
+        name = warmpool.alias_of(dom.name())
+        if name is not None:
+            domain_list.append(name)
     return domain_list
 
 
@@ -272,18 +492,66 @@ def list_domains_info():
     domain_list = []
     for i in Connection.get().listDomainsID():
         dom = Connection.get().lookupByID(i)
+        name = warmpool.alias_of(dom.name())
+        if name is None:
+            continue  # Unclaimed warm pool domain
         domain_dict = _parse_info(dom.info())
-        domain_dict['name'] = dom.name()
+        domain_dict['name'] = name
         domain_list.append(domain_dict)
     return domain_list
 
 
+@celery.task
+def list_domains_since(since=None):
+    """ List the running domains changed since the token since.
+
+    Return dict:
+    token       pass it as since to the next call
+    full        True if domains is the complete list
+    domains     names added since the token (all names if full)
+    removed     names removed since the token
+
+    Without a maintained inventory (see inventory.py) the full list
+    is returned with token None.
+
+    """
+    changes = inventory.since(since)
+    if changes is None:
+        return {'token': None, 'full': True, 'domains': list_domains(),
+                'removed': []}
+    return {'token': changes['token'], 'full': changes['full'],
+            'domains': changes['added'], 'removed': changes['removed']}
+
+
+@celery.task
+def list_domains_info_since(since=None):
+    """ List the info of the running domains changed since the token.
+
+    Return dict:
+    token       pass it as since to the next call
+    full        True if domains is the complete list
+    domains     info dicts (like list_domains_info) of the domains
+                added or changed since the token
+    removed     names removed since the token
+
+    Without a maintained inventory (see inventory.py) the full list
+    is returned with token None.
+
+    """
+    changes = inventory.since(since)
+    if changes is None:
+        return {'token': None, 'full': True,
+                'domains': list_domains_info(), 'removed': []}
+    return {'token': changes['token'], 'full': changes['full'],
+            'domains': changes['domains'], 'removed': changes['removed']}
+
+
 @celery.task
 @req_connection
 @wrap_libvirtError
 def lookupByName(name):
     """ Return with the requested Domain. """
-    return Connection.get().lookupByName(name)
+    return Connection.get().lookupByName(warmpool.resolve(name))
 
 
 @celery.task
@@ -299,14 +567,35 @@ def undefine(name):
     domain.undefine()
 
 
-@celery.task
+@celery.task(bind=True, max_retries=None)
 @req_connection
 @wrap_libvirtError
-def start(name):
-    """ Start an already defined virtual machine."""
+def start(self, name, priority='normal', boot_ticket=None):
+    """ Start an already defined virtual machine.
+
+    With BOOT_THROTTLE the start waits for a boot slot of priority
+    (high, normal or low) by retrying the task, see bootstorm.py.
+
+    """
 
     domain = lookupByName(name)
-    domain.create()
+    waited, boot_ticket = bootstorm.try_acquire(name, priority, boot_ticket)
+    if waited is None:
+        raise self.retry(args=(name, priority),
+                         kwargs={'boot_ticket': boot_ticket},
+                         countdown=bootstorm.BOOT_RETRY_INTERVAL)
+    try:
+        resources = _admit(name, domain.XMLDesc(0))
+    except Exception:
+        bootstorm.release(name)
+        raise
+    try:
+        domain.create()
+    except Exception:
+        bootstorm.release(name)
+        _release(name, resources)
+        raise
+    _commit(name, resources)
 
 
 @celery.task
@@ -345,23 +634,50 @@ def restore(name, path):
     Return the domain info dict.
 
     """
-    Connection.get().restore(path)
+    resources = _admit(name, Connection.get().saveImageGetXMLDesc(path, 0))
+    try:
+        Connection.get().restore(path)
+    except Exception:
+        _release(name, resources)
+        raise
+    _commit(name, resources)
     return domain_info(name)
 
 
-@celery.task
+@celery.task(bind=True, max_retries=None)
 @req_connection
 @wrap_libvirtError
-def resume(name):
+def resume(self, name, priority=None, boot_ticket=None):
     """ Resume stopped virtual machines.
 
+    The first resume after create boots the guest, with BOOT_THROTTLE
+    it waits for a boot slot by retrying the task (priority defaults
+    to the boot_priority given to create) and the seconds waited since
+    the first attempt are returned in boot_queue_time.
     Return the domain info dict.
 
     """
 
     domain = lookupByName(name)
-    domain.resume()
-    return _parse_info(domain.info())
+    pending = bootstorm.pending_priority(name)
+    waited = None
+    if pending is not None:
+        waited, boot_ticket = bootstorm.try_acquire(
+            name, priority or pending, boot_ticket)
+        if waited is None:
+            raise self.retry(args=(name, priority),
+                             kwargs={'boot_ticket': boot_ticket},
+                             countdown=bootstorm.BOOT_RETRY_INTERVAL)
+    try:
+        domain.resume()
+    except Exception:
+        if pending is not None:
+            bootstorm.release(name)
+        raise
+    info = _parse_info(domain.info())
+    if waited is not None:
+        info['boot_queue_time'] = waited
+    return info
 
 
 @celery.task
@@ -422,6 +738,79 @@ def node_info():
     return dict(zip(keys, values))
 
 
+def _running_domain_xmls():
+    """ Return the XML description of every running domain. """
+    return [Connection.get().lookupByID(i).XMLDesc(0)
+            for i in Connection.get().listDomainsID()]
+
+
+def _numa_placement(vcpu, memory):
+    """ Compute NUMA placement against the currently running domains. """
+    cells = hostfacts.get(Connection.get())['numa_cells']
+    committed = placement.committed_resources(cells, _running_domain_xmls())
+    return placement.place(cells, committed, vcpu, memory)
+
+
+def _apply_numa_placement(vm):
+    """ Set vcpu/emulator pinning and numatune of vm from placement. """
+    result = _numa_placement(vm.vcpu, vm.memory_max)
+    if result is None:
+        logging.warning("No NUMA topology available for %s", vm.name)
+        return
+    vm.vcpu_pinning = result['vcpu_pinning']
+    vm.emulator_pinning = result['emulator_pinning']
+    vm.numa_nodeset = result['nodeset']
+    vm.numa_mode = result['mode']
+    logging.info("NUMA placement for %s: nodeset %s (%s)",
+                 vm.name, result['nodeset'], result['reason'])
+
+
+@celery.task
+@req_connection
+@wrap_libvirtError
+def numa_placement(vcpu, memory):
+    """ Dry run of NUMA placement for a domain of the given size.
+
+    memory is in KiB.
+    Return the placement dict with the per-cell scores explained.
+
+    """
+    return _numa_placement(vcpu, memory)
+
+
+@celery.task
+@req_connection
+@wrap_libvirtError
+def numa_info():
+    """ Return host NUMA cells with the resources committed to domains. """
+    cells = hostfacts.get(Connection.get())['numa_cells']
+    committed = placement.committed_resources(cells, _running_domain_xmls())
+    result = []
+    for cell in cells:
+        cpus = [cpu['id'] for cpu in cell['cpus']]
+        result.append({
+            'id': cell['id'],
+            'memory': cell['memory'],
+            'committed_memory': int(committed['memory'][cell['id']]),
+            'cpus': placement.format_cpuset(cpus),
+            'cpu_load': dict((cpu, round(committed['cpus'][cpu], 3))
+                             for cpu in cpus)})
+    return result
+
+
+@celery.task
+def hugepage_info():
+    """ Return the hugepage counters of the host per NUMA node.
+
+    Return dict:
+    default_size    default hugepage size in KiB
+    nodes           node id -> page size in KiB -> total/free pages
+
+    """
+    return {'default_size': hugepages.default_size(),
+            'nodes': hugepages.host_hugepages()}
+
+
 def _parse_info(values):
     """ Parse libvirt domain info into dict.
 
@@ -478,6 +867,49 @@ def network_info(name, network):
     return info
 
 
+@celery.task
+@req_connection
+@wrap_libvirtError
+def domains_stats():
+    """ Return the interface and block counters of every running domain.
+
+    One getAllDomainStats call replaces per domain and per device
+    network_info polling. Return dict:
+    name -> {'net': {device: counters}, 'block': {device: counters}}
+    Network counters have the keys of network_info, block counters
+    are rd_req, rd_bytes, rd_times, wr_req, wr_bytes, wr_times,
+    fl_req, fl_times, allocation, capacity and physical.
+    Every device also has a 'rates' dict of per second values since
+    the previous call on the host (None on the first call).
+
+    """
+    stats = Connection.get().getAllDomainStats(
+        libvirt.VIR_DOMAIN_STATS_INTERFACE | libvirt.VIR_DOMAIN_STATS_BLOCK,
+        libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE)
+    result = {}
+    samples = {}
+    devices_counters = []
+    for dom, record in stats:
+        name = warmpool.alias_of(dom.name())
+        if name is None:
+            continue
+        domain_result = {}
+        for group, keys in (('net', domstats.NET_KEYS),
+                            ('block', domstats.BLOCK_KEYS)):
+            devices = domstats.parse_devices(record, group, keys)
+            for device, counters in devices.items():
+                key = '/'.join((dom.UUIDString(), group, device))
+                samples[key] = dict(counters)
+                devices_counters.append((key, counters))
+            domain_result[group] = devices
+        result[name] = domain_result
+    # One locked read and write of the samples shared by the host
+    rates = domstats.rate_cache.rates(samples)
+    for key, counters in devices_counters:
+        counters['rates'] = rates[key]
+    return result
+
+
 @celery.task
 @req_connection
 @wrap_libvirtError
@@ -492,6 +924,62 @@ def send_key(name, key_code):
     domain.sendKey(libvirt.VIR_KEYCODE_SET_LINUX, 100, [key_code], 1, 0)
 
 
+def _send_key_calls(name, calls, hold, interval):
+    """ Send every keycode list in calls with one sendKey each. """
+    from time import sleep
+    domain = lookupByName(name)
+    for i, codes in enumerate(calls):
+        if i and interval:
+            sleep(interval)
+        domain.sendKey(libvirt.VIR_KEYCODE_SET_LINUX, int(hold), codes,
+                       len(codes), 0)
+    return len(calls)
+
+
+@celery.task
+@req_connection
+@wrap_libvirtError
+def send_text(name, text, hold=50, interval=0.02, pack=True):
+    """ Type text (US layout) on the name vm.
+
+    hold is the key press time in milliseconds, interval the seconds
+    between sendKey calls. With pack several characters go in one call,
+    see keymap.text_to_calls.
+    Return the number of sendKey calls.
+
+    """
+    return _send_key_calls(name, keymap.text_to_calls(text, pack),
+                           hold, interval)
+
+
+@celery.task
+@req_connection
+@wrap_libvirtError
+def send_keys(name, keys, hold=100, interval=0.05):
+    """ Send chords like "ctrl+alt+f2" to the name vm.
+
+    keys is a chord or a list of chords sent one after the other.
+    Return the number of sendKey calls.
+
+    """
+    if not isinstance(keys, (list, tuple)):
+        keys = [keys]
+    return _send_key_calls(name, [keymap.parse_chord(k) for k in keys],
+                           hold, interval)
+
+
+@celery.task
+def console_read(name, offset=None, size=4096):
+    """ Return captured serial console output of the name vm.
+
+    Without offset the last size bytes are returned, otherwise the next
+    size bytes from offset. Pass the returned offset to the next call to
+    follow the console. See console.read for the returned dict.
+
+    """
+    return console.read(warmpool.resolve(name), offset, size)
+
+
 def _stream_handler(stream, buf, opaque):
     opaque.write(buf)
 
@@ -536,20 +1024,77 @@ def screenshot(name):
 @celery.task
 @req_connection
 @wrap_libvirtError
-def migrate(name, host, live=False):
-    """ Migrate domain to host. """
-    flags = libvirt.VIR_MIGRATE_PEER2PEER
-    if live:
-        flags = flags | libvirt.VIR_MIGRATE_LIVE
+def migrate(name, host, live=False, strategy=None, allow_postcopy=False):
+    """ Migrate domain to host.
+
+    Live migrations with strategy (MIGRATION_STRATEGY by default) go
+    through the adaptive layer (see migration.py): 'auto' lets the cost
+    model choose, or one of migration.STRATEGIES is forced. They return
+    the migration record with the strategy and the downtime.
+
+    """
     domain = lookupByName(name)
-    domain.migrateToURI(
-        duri="qemu+tcp://" + host + "/system",
-        flags=flags,
-        dname=name,
-        bandwidth=0)
+    return _migrate_domain(domain, name, host, live, strategy=strategy,
+                           allow_postcopy=allow_postcopy)
     # return _parse_info(domain.info())
 
 
+def _migrate_domain(domain, name, host, live=False, bandwidth=0,
+                    dirty_rate=None, strategy=None, allow_postcopy=False):
+    """ Migrate domain to host as name, bandwidth in MiB/s. """
+    strategy = strategy or os.getenv('MIGRATION_STRATEGY')
+    if live and strategy:
+        record = migration.migrate(domain, name, host, bandwidth, strategy,
+                                   allow_postcopy, dirty_rate)
+        # The disk overlays are on the datastore, they go with the VM
+        warmpool.forget(name)
+        return record
+    domainops.migrate(domain, name, host, live, bandwidth)
+    warmpool.forget(name)
+
+
+class drain_host(AbortableTask):
+    """ Migrate every running domain to the targets hosts.
+
+    At most max_parallel migrations run at once, sharing
+    bandwidth_budget MiB/s (0 is unlimited). Domains are taken in
+    order (memory, largest, vcpus, name or dirty_rate) and retried
+    retries times on the next target. Live migrations use the adaptive
+    strategy if strategy is set (see migrate). Progress is reported as
+    PROGRESS task state.
+    Return dict of migrated (name, target, attempts), failed
+    (name -> error) and aborted.
+    This job is abortable:
+        AbortableAsyncResult(id="<<jobid>>").abort()
+    """
+
+    @req_connection
+    @wrap_libvirtError
+    def run(self, targets, max_parallel=2, bandwidth_budget=0,
+            order='memory', live=True, retries=1, strategy=None,
+            allow_postcopy=False):
+        job = drain.Drain(Connection.get(), targets,
+                          functools.partial(_migrate_domain,
+                                            strategy=strategy,
+                                            allow_postcopy=allow_postcopy),
+                          max_parallel, bandwidth_budget, order, live,
+                          retries, migration.sample_dirty_rates)
+        logging.info("Drain started to %s", ', '.join(targets))
+        result = job.run(
+            warmpool.alias_of,
+            lambda meta: self.update_state(state='PROGRESS', meta=meta),
+            self.is_aborted)
+        logging.info("Drain finished: %d migrated, %d failed",
+                     len(result['migrated']), len(result['failed']))
+        return result
+
+
+@celery.task
+def migration_history():
+    """ Return the recorded adaptive migrations, oldest first. """
+    return migration.history()
+
+
 @celery.task
 @req_connection
 @wrap_libvirtError
@@ -568,31 +1113,23 @@ def detach_disk(name, disk):
     domain = lookupByName(name)
     disk = VMDisk.deserialize(disk)
     domain.detachDevice(disk.dump_xml())
-    # Libvirt does NOT report failed detach so test it.
-    __check_detach(domain, disk.source)
-
-
-def __check_detach(domain, disk):
-    """ Test if detach was successfull by searching
-    for disk in the XML"""
-    xml = domain.XMLDesc()
-    root = ET.fromstring(xml)
-    devices = root.find('devices')
-    for d in devices.findall("disk"):
-        if disk in d.find('source').attrib.values()[0]:
-            raise Exception("Disk could not been detached. "
-                            "Check if hot plug support is "
-                            "enabled (acpiphp module on Linux).")
+    domainops.check_detached(domain, disk.source)
 
 
 @celery.task
 @req_connection
 @wrap_libvirtError
 def attach_network(name, net):
+    """ Attach network to a running virtual machine.
+
+    Multiqueue is sized from the vcpu count of the domain
+    the same way as at create time.
+
+    """
     domain = lookupByName(name)
-    net = VMNetwork.deserialize(net)
-    logging.error(net.dump_xml())
-    domain.attachDevice(net.dump_xml())
+    net_xml = domainops.network_xml(domain, net)
+    logging.debug(net_xml)
+    domain.attachDevice(net_xml)
 
 
 @celery.task
@@ -600,8 +1137,7 @@ def attach_network(name, net):
 @wrap_libvirtError
 def detach_network(name, net):
     domain = lookupByName(name)
-    net = VMNetwork.deserialize(net)
-    domain.detachDevice(net.dump_xml())
+    domain.detachDevice(domainops.network_xml(domain, net))
 
 
 @celery.task
@@ -615,18 +1151,363 @@ def resize_disk(name, path, size):
     domain.blockResize(path, int(size)/1024, 0)
 
 
+class BlockJobTask(AbortableTask):
+    """ Base of the block job tasks.
+
+    Subclasses start their job in start_job(domain, disk, bandwidth,
+    *args), with bandwidth in MiB/s (0 is unlimited), and call follow()
+    from run().
+    The job waits for a slot of the host wide I/O budget (see
+    blockjobs.py), then its progress from blockJobInfo is reported
+    as PROGRESS task state with cur, end, bandwidth and percent.
+    Copy and active commit jobs are pivoted when libvirt reports the
+    mirror ready. Aborting the task or any failure cancels the job
+    without pivot. A job on a disk that already has one fails.
+    """
+    abstract = True
+
+    def follow(self, name, disk, bandwidth, pivot, *args):
+        from time import sleep
+        key = '%s:%s' % (name, disk)
+        if not blockjobs.acquire(key, bandwidth, self.is_aborted):
+            return {'status': 'aborted'}
+        domain = None
+        running = False
+        try:
+            domain = lookupByName(name)
+            speed = blockjobs.share(key)
+            self.start_job(domain, disk, speed, *args)
+            running = True
+            logging.info("Block job started on %s of %s at %s MiB/s",
+                         disk, name, speed or 'unlimited')
+            while True:
+                info = domain.blockJobInfo(disk, 0)
+                if not info:
+                    running = False
+                    return {'status': 'completed'}
+                cur, end = info.get('cur', 0), info.get('end', 0)
+                self.update_state(state='PROGRESS', meta={
+                    'cur': cur, 'end': end, 'bandwidth': info['bandwidth'],
+                    'percent': 100.0 * cur / end if end else 0.0})
+                if self.is_aborted():
+                    domain.blockJobAbort(disk, 0)
+                    running = False
+                    logging.info("Block job aborted on %s of %s", disk, name)
+                    return {'status': 'aborted'}
+                if pivot and blockjobs.mirror_ready(domain.XMLDesc(0), disk):
+                    domain.blockJobAbort(
+                        disk, libvirt.VIR_DOMAIN_BLOCK_JOB_ABORT_PIVOT)
+                    running = False
+                    logging.info("Block job pivoted on %s of %s", disk, name)
+                    return {'status': 'pivoted'}
+                new_speed = blockjobs.share(key)
+                if new_speed != speed:
+                    domain.blockJobSetSpeed(disk, new_speed, 0)
+                    speed = new_speed
+                sleep(blockjobs.POLL_INTERVAL)
+        finally:
+            if running:
+                # Do not leave the job running outside of the budget
+                try:
+                    domain.blockJobAbort(disk, 0)
+                    logging.warning("Block job cancelled on %s of %s",
+                                    disk, name)
+                except libvirt.libvirtError as e:
+                    logging.error("Unable to cancel block job on %s of %s: "
+                                  "%s", disk, name, e.get_error_message())
+            blockjobs.release(key)
+
+
+class block_copy(BlockJobTask):
+    """ Copy the disk of a running virtual machine to dest and pivot.
+
+    Return dict with status (completed, pivoted or aborted).
+    bandwidth is in MiB/s, 0 means the host budget share.
+    """
+
+    def start_job(self, domain, disk, bandwidth, dest, dest_format,
+                  shallow):
+        xml = ET.Element('disk', attrib={'type': 'file'})
+        ET.SubElement(xml, 'source', attrib={'file': dest})
+        ET.SubElement(xml, 'driver', attrib={'type': dest_format})
+        params = {}
+        if bandwidth:
+            params[libvirt.VIR_DOMAIN_BLOCK_COPY_BANDWIDTH] = (
+                bandwidth * 1024 * 1024)
+        flags = libvirt.VIR_DOMAIN_BLOCK_COPY_TRANSIENT_JOB
+        if shallow:
+            flags |= libvirt.VIR_DOMAIN_BLOCK_COPY_SHALLOW
+        domain.blockCopy(disk, ET.tostring(xml), params, flags)
+
+    @req_connection
+    @wrap_libvirtError
+    def run(self, name, disk, dest, dest_format='qcow2', bandwidth=0,
+            shallow=False):
+        return self.follow(name, disk, bandwidth, True, dest, dest_format,
+                           shallow)
+
+
+class block_pull(BlockJobTask):
+    """ Pull the backing chain of disk into it (flatten).
+
+    Return dict with status (completed or aborted).
+    """
+
+    def start_job(self, domain, disk, bandwidth, base):
+        if base is None:
+            domain.blockPull(disk, bandwidth, 0)
+        else:
+            domain.blockRebase(disk, base, bandwidth, 0)
+
+    @req_connection
+    @wrap_libvirtError
+    def run(self, name, disk, bandwidth=0, base=None):
+        return self.follow(name, disk, bandwidth, False, base)
+
+
+class block_commit(BlockJobTask):
+    """ Commit top (the active layer if None) of disk into base.
+
+    Committing the active layer ends with a pivot.
+    Return dict with status (completed, pivoted or aborted).
+    """
+
+    def start_job(self, domain, disk, bandwidth, base, top):
+        flags = 0
+        if top is None:
+            flags |= libvirt.VIR_DOMAIN_BLOCK_COMMIT_ACTIVE
+        domain.blockCommit(disk, base, top, bandwidth, flags)
+
+    @req_connection
+    @wrap_libvirtError
+    def run(self, name, disk, base=None, top=None, bandwidth=0):
+        return self.follow(name, disk, bandwidth, top is None, base, top)
+
+
+@celery.task
+def block_jobs():
+    """ Return the block jobs holding a slot of the host I/O budget. """
+    return blockjobs.jobs()
+
+
+@celery.task
+def agent_command(name, command, arguments=None, timeout=None):
+    """ Run a guest agent command in name and return its result. """
+    result, error = agent.batch([(name, command, arguments)],
+                                timeout or agent.AGENT_TIMEOUT)[0]
+    if error is not None:
+        raise Exception("Guest agent error on %s: %s" % (name, error))
+    return result
+
+
+@celery.task
+@req_connection
+@wrap_libvirtError
+def agent_query(names, queries=('ping', ), timeout=None):
+    """ Query the guests of names in one batch.
+
+    queries are keys of agent.QUERIES (ping, filesystems, addresses,
+    os, users, time) or memory, the balloon driver statistics read
+    through libvirt. A successful ping completes the boot (see
+    boot_completed).
+    Return dict name -> query -> result, failed queries have a dict
+    with the error instead.
+
+    """
+    unknown = set(queries) - set(agent.QUERIES) - set(['memory'])
+    if unknown:
+        raise Exception("Unknown agent queries: %s" % ', '.join(unknown))
+    replies = dict((name, {}) for name in names)
+    requests = [(name, query) for name in names for query in queries
+                if query != 'memory']
+    results = agent.batch(
+        [(name, agent.QUERIES[query], None) for name, query in requests],
+        timeout or agent.AGENT_TIMEOUT) if requests else []
+    for (name, query), (result, error) in zip(requests, results):
+        if error is not None:
+            replies[name][query] = {'error': error}
+        else:
+            replies[name][query] = result
+            if query == 'ping':
+                bootstorm.release(name)
+    if 'memory' in queries:
+        wanted = dict((warmpool.resolve(name), name) for name in names)
+        for dom, stats in Connection.get().getAllDomainStats(
+                libvirt.VIR_DOMAIN_STATS_BALLOON,
+                libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE):
+            name = wanted.get(dom.name())
+            if name is not None:
+                replies[name]['memory'] = dict(
+                    (key[8:], value) for key, value in stats.items()
+                    if key.startswith('balloon.'))
+        for name in names:
+            replies[name].setdefault('memory', {'error': 'not running'})
+    return replies
+
+
+@celery.task
+def boot_completed(name):
+    """ Signal that the guest of name finished booting.
+
+    Called on the context server handshake or guest agent ping, it
+    frees the boot slot of the domain. Return False if it held none.
+
+    """
+    return bootstorm.release(name)
+
+
+@celery.task
+def boot_info():
+    """ Return the boot throttling state (see bootstorm.info). """
+    return bootstorm.info()
+
+
+@celery.task
+def balloon_info():
+    """ Return the state of the last balloon controller round.
+
+    Return dict of time, pressure (KiB the host wanted back) and
+    domains (name -> current, maximum, used, floor and target KiB),
+    empty if the controller is disabled or did not run yet.
+
+    """
+    return balloon.info()
+
+
+@celery.task
+@req_connection
+@wrap_libvirtError
+def get_cpu_tune(name):
+    """ Return the CPU tuning of the running domain name.
+
+    Return dict of params (live scheduler parameters), class (tenant
+    class) and held (True if tuned by hand, see set_cpu_tune).
+
+    """
+    domain = lookupByName(name)
+    return {'params': cputune.get(domain),
+            'class': cputune.get_class(domain),
+            'held': name in cputune.holds()}
+
+
+@celery.task
+@req_connection
+@wrap_libvirtError
+def set_cpu_tune(name, params, config=False, hold=True):
+    """ Change the scheduler parameters of the running domain name.
+
+    params is a dict of cputune.PARAMETERS (cpu_shares, vcpu_period,
+    vcpu_quota, emulator_*, iothread_*, global_*), quotas of -1 are
+    unlimited. With config the persistent definition is changed too.
+    With hold the CPU tune policy leaves the domain alone until it is
+    called again with hold=False.
+
+    """
+    domain = lookupByName(name)
+    if params:
+        cputune.apply(domain, params, config)
+    cputune.hold(name, (params or {}) if hold else None)
+    return cputune.get(domain)
+
+
+@celery.task
+@req_connection
+@wrap_libvirtError
+def set_cpu_class(name, cpu_class):
+    """ Set the tenant class of domain name for the CPU tune policy. """
+    cputune.set_class(lookupByName(name), cpu_class)
+
+
+@celery.task
+def cpu_tune_info():
+    """ Return the state of the last CPU tune policy round. """
+    return cputune.info()
+
+
+@celery.task
+def get_domain_xml(key):
+    """ Return the stored domain xml of a hash or domain name.
+
+    Domain names return the xml of their last create or define.
+
+    """
+    return xmlstore.get(key)
+
+
+@celery.task
+def xml_store_info():
+    """ Return the size of the domain xml store (see xmlstore.info). """
+    return xmlstore.info()
+
+
+@celery.task
+def event_stream_info():
+    """ Return where the domain events of this host are published.
+
+    Return dict of exchange, epoch and seq (last published sequence
+    number), empty if publishing is disabled or not started yet.
+
+    """
+    return eventpub.info()
+
+
 @celery.task
 def ping():
     return True
 
 
-@celery.task
 @req_connection
 @wrap_libvirtError
+def _load_host_facts():
+    return hostfacts.refresh(Connection.get())
+
+
+def _host_facts(refresh=False):
+    """ Return the cached host facts (see hostfacts.py).
+
+    libvirt is only contacted on first use or refresh.
+
+    """
+    facts = hostfacts.cached()
+    if facts is None or refresh:
+        facts = _load_host_facts()
+    return facts
+
+
+hostfacts.install(celery, _load_host_facts)
+inventory.install(celery, _parse_info)
+
+
+@celery.task
 def get_architecture():
-    xml = Connection.get().getCapabilities()
-    return ET.fromstring(xml).getchildren()[0].getchildren(
-    )[1].getchildren()[0].text
+    return _host_facts()['arch']
+
+
+@celery.task
+def host_facts():
+    """ Return the cached host facts: arch, cpu model and features,
+    NUMA cells, hugepage sizes, machine types, core number, RAM size
+    and driver version. """
+    return _host_facts()
+
+
+@celery.task
+def refresh_host_facts():
+    """ Re-read the host capabilities and driver version. """
+    return _host_facts(refresh=True)
+
+
+@celery.task(bind=True)
+def profile(self, tasks=None, seconds=None, mode='wall'):
+    """ Profile the next tasks (or seconds) in every pool process.
+
+    mode can be wall, cpu or pstats; see profiler.py.
+    Return the reply of the worker with the signaled pids and the
+    output directory.
+
+    """
+    return profiler.broadcast(self.app, self.request.hostname,
+                              tasks, seconds, mode)
 
 
 @celery.task
@@ -641,25 +1522,16 @@ def get_ram_size():
 
 @celery.task
 def get_driver_version():
-    from git import Repo
-    try:
-        repo = Repo(path=os.getcwd())
-        lc = repo.head.commit
-        return {'branch': repo.active_branch.name,
-                'commit': lc.hexsha,
-                'commit_text': lc.summary,
-                'is_dirty': repo.is_dirty()}
-    except Exception as e:
-        logging.exception("Unhandled exception: %s", e)
-        return None
+    return _host_facts()['driver_version']
 
 
 @celery.task
 def get_info():
-    return {'core_num': get_core_num(),
-            'ram_size': get_ram_size(),
-            'architecture': get_architecture(),
-            'driver_version': get_driver_version()}
+    facts = _host_facts()
+    return {'core_num': facts['core_num'],
+            'ram_size': facts['ram_size'],
+            'architecture': facts['arch'],
+            'driver_version': facts['driver_version']}
 
 
 @celery.task
@@ -0,0 +1,419 @@
+""" Pool of pre-created paused domains for instant VM delivery.
+
+Enabled with WARM_POOL. The manager registers templates (a VM
+descriptor without networks) and a pool size with warmpool_configure.
+One worker process per host (the leader) keeps that many paused domains
+named warm-<template>-<id> for each of them, within these budgets:
+
+WARM_POOL_MAX_CPU   replenish only below this host cpu usage (percent)
+WARM_POOL_MEMORY    KiB of memory the pooled domains may hold in total
+
+When create() is called with a template that has a ready domain and
+the descriptor of the request equals the template descriptor apart from
+the name, networks, boot token and graphics password, that domain is
+handed out: the user's NICs are attached, the graphics password is set
+and the user's VM name is recorded as an alias of the pooled domain,
+which lookupByName and the domain lists resolve transparently. Any
+other request is created the normal way, as a pooled domain keeps the
+disks, vcpus and memory of its template. Templates must use an
+automatic graphics port (-1).
+
+The disk_list of a template, and of every create() request naming
+one, lists the base images: each domain of such a request, pooled or
+created on a pool miss, runs on qcow2 overlays created next to them on
+the datastore as <domain>-<index>.qcow2 (see the xml returned by
+create()). The overlays are removed when the VM is deleted or its
+domain stops for good, and are kept when it is saved or migrated.
+
+"""
+import copy
+import json
+import libvirt
+import logging
+import os
+import re
+import subprocess
+import threading
+import time
+import uuid
+
+import lxml.etree as ET
+from psutil import cpu_percent, virtual_memory
+
+import domainops
+import events
+import hostlock
+import metrics
+from vm import VMInstance
+
+enabled = os.getenv('WARM_POOL', 'False').lower() in (
+    "true", "yes", "y", "t")
+WARM_POOL_MAX_CPU = float(os.getenv('WARM_POOL_MAX_CPU', '50'))
+WARM_POOL_MEMORY = int(os.getenv('WARM_POOL_MEMORY', str(8 * 1024 ** 2)))
+WARM_POOL_INTERVAL = int(os.getenv('WARM_POOL_INTERVAL', '10'))
+PREFIX = 'warm-'
+# Keys of a create() descriptor a pooled domain is delivered with
+DELIVERED_KEYS = ('name', 'network_list', 'boot_token')
+DELIVERED_GRAPHICS_KEYS = ('passwd', )
+# A stopped domain with these details keeps its disks
+KEPT_DETAILS = (libvirt.VIR_DOMAIN_EVENT_STOPPED_SAVED,
+                libvirt.VIR_DOMAIN_EVENT_STOPPED_MIGRATED,
+                libvirt.VIR_DOMAIN_EVENT_STOPPED_FROM_SNAPSHOT)
+
+_cache = {'key': None, 'state': None}
+
+
+def _empty_state():
+    return {'templates': {}, 'aliases': {}, 'overlays': {},
+            'stats': {'hits': 0, 'misses': 0, 'mismatches': 0,
+                      'replenished': 0, 'replenish_seconds': 0.0}}
+
+
+def _state():
+    """ Return the shared pool state, re-read only if it changed. """
+    try:
+        st = os.stat(hostlock.path('warmpool.json'))
+    except OSError:
+        return _empty_state()
+    # save() renames a new file over it, the inode changes too
+    key = (st.st_ino, st.st_mtime)
+    if key != _cache['key']:
+        with hostlock.locked('warmpool'):
+            _cache['state'] = hostlock.load('warmpool', _empty_state())
+        _cache['key'] = key
+    return _cache['state']
+
+
+def _update(function):
+    """ Modify the shared state with function(state) under the lock. """
+    with hostlock.locked('warmpool'):
+        state = hostlock.load('warmpool', _empty_state())
+        result = function(state)
+        hostlock.save('warmpool', state)
+    return result
+
+
+def resolve(name):
+    """ Return the libvirt domain name of the VM called name. """
+    if not enabled:
+        return name
+    return _state()['aliases'].get(name, name)
+
+
+def alias_of(domain_name):
+    """ Return the VM name of a domain, None for unclaimed pool domains. """
+    if not enabled or not domain_name.startswith(PREFIX):
+        return domain_name
+    for name, target in _state()['aliases'].items():
+        if target == domain_name:
+            return name
+    return None
+
+
+def _pool_name(template):
+    return '%s%s-%s' % (PREFIX, re.sub(r'[^A-Za-z0-9_]', '_',
+                                       str(template)), uuid.uuid4().hex[:8])
+
+
+def _pooled(conn, template, aliases):
+    """ Return the names of the unclaimed pool domains of template. """
+    prefix = _pool_name(template)[:-8]
+    claimed = set(aliases.values())
+    names = []
+    for i in conn.listDomainsID():
+        try:
+            name = conn.lookupByID(i).name()
+        except libvirt.libvirtError:
+            continue
+        if name.startswith(prefix) and name not in claimed:
+            names.append(name)
+    return names
+
+
+def _normalized(vm_desc):
+    """ Return vm_desc without the delivered keys as comparable JSON. """
+    desc = dict((key, value) for key, value in vm_desc.items()
+                if key not in DELIVERED_KEYS)
+    if desc.get('graphics'):
+        desc['graphics'] = dict(
+            (key, value) for key, value in desc['graphics'].items()
+            if key not in DELIVERED_GRAPHICS_KEYS)
+    return json.dumps(desc, sort_keys=True)
+
+
+def matches(template_desc, vm_desc):
+    """ Return True if a domain of template_desc can serve vm_desc. """
+    return _normalized(template_desc) == _normalized(vm_desc)
+
+
+def configure(template, vm_desc, size):
+    """ Register template with its descriptor and pool size. """
+    graphics = vm_desc.get('graphics')
+    if graphics and str(graphics.get('port')) != '-1':
+        raise Exception("Warm pool template %s must use an automatic "
+                        "graphics port (-1)" % template)
+
+    def change(state):
+        state['templates'][str(template)] = {'desc': vm_desc,
+                                             'size': int(size)}
+    _update(change)
+
+
+def claim(conn, template, name, vm_desc):
+    """ Hand out a ready domain of template as VM name.
+
+    vm_desc is the create() descriptor of the request. Return the pool
+    domain name, or None on a pool miss or if the template does not
+    match the descriptor.
+
+    """
+    def take(state):
+        t = state['templates'].get(str(template))
+        if t is None or not matches(t['desc'], vm_desc):
+            stats = state['stats']
+            stats['mismatches'] = stats.get('mismatches', 0) + 1
+            return False
+        available = _pooled(conn, template, state['aliases'])
+        if not available:
+            state['stats']['misses'] += 1
+            return None
+        state['aliases'][name] = available[0]
+        state['stats']['hits'] += 1
+        return available[0]
+    domain_name = _update(take)
+    if domain_name is False:
+        logging.info("Warm pool template %s does not match %s",
+                     template, name)
+        metrics.inc('warmpool_requests_total', result='mismatch')
+        return None
+    metrics.inc('warmpool_requests_total',
+                result='hit' if domain_name else 'miss')
+    return domain_name
+
+
+def graphics_xml(domain_xml, passwd):
+    """ Return the graphics device of domain_xml with passwd set. """
+    graphics = ET.fromstring(domain_xml).find('devices/graphics')
+    if graphics is None:
+        raise Exception("Domain has no graphics device")
+    graphics.set('passwd', passwd)
+    return ET.tostring(graphics)
+
+
+def _drop(state, domain_name):
+    """ Drop domain_name from state, return the paths of its overlays. """
+    for name, target in list(state['aliases'].items()):
+        if target == domain_name:
+            del state['aliases'][name]
+    return state.setdefault('overlays', {}).pop(domain_name, [])
+
+
+def _remove(overlays):
+    for overlay in overlays:
+        try:
+            os.unlink(overlay)
+        except OSError as e:
+            logging.warning("Unable to remove warm pool overlay %s: %s",
+                            overlay, e)
+
+
+def release(name):
+    """ Forget the alias of VM name and remove its disk overlays.
+
+    Call it when the VM is deleted, its disks are not needed any more.
+
+    """
+    if not enabled:
+        return
+
+    def drop(state):
+        return _drop(state, state['aliases'].get(name, name))
+    _remove(_update(drop))
+
+
+def forget(name):
+    """ Forget the alias of VM name but keep its disk overlays.
+
+    Call it when the VM leaves the host with its disks (migration).
+
+    """
+    if not enabled:
+        return
+
+    _update(lambda state: _drop(state, state['aliases'].get(name, name)))
+
+
+def info(conn):
+    """ Return pool sizes, ready domains and hit/replenish statistics. """
+    state = _state()
+    stats = dict(state['stats'])
+    stats.setdefault('mismatches', 0)
+    requests = stats['hits'] + stats['misses'] + stats['mismatches']
+    stats['hit_rate'] = float(stats['hits']) / requests if requests else None
+    stats['replenish_avg_seconds'] = (
+        stats['replenish_seconds'] / stats['replenished']
+        if stats['replenished'] else None)
+    return {'templates': dict(
+        (template, {'size': t['size'],
+                    'ready': len(_pooled(conn, template, state['aliases']))})
+        for template, t in state['templates'].items()),
+        'claimed': len(state['aliases']),
+        'stats': stats}
+
+
+def _overlay(source, domain_name, index):
+    """ Create a qcow2 overlay of source next to it. """
+    overlay = os.path.join(os.path.dirname(source),
+                           '%s-%d.qcow2' % (domain_name, index))
+    subprocess.check_call(['qemu-img', 'create', '-f', 'qcow2',
+                           '-b', source, overlay])
+    return overlay
+
+
+def use_overlays(vm):
+    """ Put the disks of vm on new overlays of its base images.
+
+    Used for every domain of a template request, pooled or created on
+    a pool miss. The overlays are removed by release(vm.name).
+
+    """
+    overlays = []
+    try:
+        for index, disk in enumerate(vm.disk_list):
+            if disk.disk_device == 'disk':
+                disk.source = _overlay(disk.source, vm.name, index)
+                disk.driver_type = 'qcow2'
+                overlays.append(disk.source)
+    except Exception:
+        _remove(overlays)
+        raise
+
+    def record(state):
+        state.setdefault('overlays', {})[vm.name] = overlays
+    _update(record)
+
+
+def _create_pooled(conn, template, vm_desc):
+    """ Create one paused pool domain of template. """
+    start = metrics.clock()
+    desc = copy.deepcopy(vm_desc)
+    desc['name'] = _pool_name(template)
+    desc['network_list'] = []
+    desc['boot_token'] = ''
+    vm = VMInstance.deserialize(desc)
+    domainops.prepare(vm)
+    timer = metrics.PhaseTimer('warmpool_create_phase_duration_seconds')
+    try:
+        if vm.vm_type != "test":
+            use_overlays(vm)
+        domainops.create_paused(conn, vm.dump_xml(), vm.vm_type, timer)
+    except Exception:
+        try:
+            conn.lookupByName(vm.name).destroy()
+        except libvirt.libvirtError:
+            pass  # Not created
+        _remove(_update(lambda state: _drop(state, vm.name)))
+        raise
+    duration = metrics.clock() - start
+    metrics.observe('warmpool_replenish_duration_seconds', duration,
+                    template=template)
+
+    def count(state):
+        state['stats']['replenished'] += 1
+        state['stats']['replenish_seconds'] += duration
+    _update(count)
+    logging.info("Warm pool domain %s created in %.2fs", vm.name, duration)
+
+
+def on_lifecycle(dom, event, detail):
+    """ Remove the overlays of a domain that is gone for good.
+
+    The domains are transient: a domain that stops without being saved
+    or migrated does not come back. A saved one keeps its alias and
+    disks until the VM is deleted.
+
+    """
+    if event == libvirt.VIR_DOMAIN_EVENT_STOPPED:
+        if detail in KEPT_DETAILS:
+            return
+        try:
+            if dom.isPersistent():
+                return
+        except libvirt.libvirtError:
+            pass  # Transient domains are gone when stopped
+    elif event != libvirt.VIR_DOMAIN_EVENT_UNDEFINED:
+        return
+    domain_name = dom.name()
+    state = _state()
+    if (domain_name not in state.get('overlays', {}) and
+            domain_name not in state['aliases'].values()):
+        return
+    overlays = _update(lambda state: _drop(state, domain_name))
+    if overlays:
+        logging.info("Warm pool domain %s is gone", domain_name)
+    _remove(overlays)
+
+
+def replenish(conn):
+    """ Fill every template pool within the cpu and memory budget. """
+    state = _state()
+    pool_memory = 0
+    missing = []
+    for template, t in state['templates'].items():
+        ready = len(_pooled(conn, template, state['aliases']))
+        pool_memory += ready * int(t['desc']['memory_max'])
+        missing.extend([template] * max(t['size'] - ready, 0))
+    for template in missing:
+        desc = state['templates'][template]['desc']
+        memory = int(desc['memory_max'])
+        if pool_memory + memory > WARM_POOL_MEMORY:
+            logging.debug("Warm pool memory budget reached")
+            break
+        if virtual_memory().available < memory * 1024:
+            logging.debug("Not enough free memory for warm pool")
+            break
+        if cpu_percent(1) > WARM_POOL_MAX_CPU:
+            logging.debug("Host too busy to replenish warm pool")
+            break
+        try:
+            _create_pooled(conn, template, desc)
+            pool_memory += memory
+        except Exception:
+            logging.exception("Unable to create warm pool domain of %s",
+                              template)
+
+
+def _run():
+    while not hostlock.leader('warmpool'):
+        time.sleep(WARM_POOL_INTERVAL)
+    events.start()
+    events.subscribe(libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, on_lifecycle)
+    conn = None
+    while True:
+        try:
+            if conn is None:
+                conn = libvirt.open(os.getenv('LIBVIRT_URI',
+                                              'qemu:///system'))
+            replenish(conn)
+        except Exception:
+            logging.exception("Warm pool replenish failed")
+            conn = None
+        time.sleep(WARM_POOL_INTERVAL)
+
+
+def start(**kw):
+    """ Start the replenish thread of this process. """
+    if not enabled:
+        return
+    thread = threading.Thread(target=_run, name='warmpool')
+    thread.daemon = True
+    thread.start()
+
+
+def install(app):
+    """ Start replenishing in the worker pool processes (one leads). """
+    if not enabled:
+        return
+    from celery.signals import worker_process_init
+    worker_process_init.connect(start, weak=False,
+                                dispatch_uid='warmpool_process_init')
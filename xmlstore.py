@@ -0,0 +1,184 @@
+""" Content addressed store of the generated domain xmls.
+
+Every xml is kept once under its SHA-256 hash in XML_STORE_DIR/objects
+(default RUN_DIR/xml), so domains created from the same template share
+one file. The last hash of every domain name is kept in
+XML_STORE_DIR/names. Logs and errors refer to the xml by name and hash
+only, get() returns it.
+
+Files older than XML_STORE_MAX_AGE seconds are evicted, then the least
+recently stored ones until the objects take at most XML_STORE_MAX_BYTES.
+Names whose xml is gone are dropped. Eviction runs at most every
+XML_STORE_EVICT_INTERVAL seconds per process.
+
+"""
+import hashlib
+import logging
+import os
+import re
+import time
+
+import hostlock
+
+XML_STORE_DIR = os.getenv('XML_STORE_DIR')
+XML_STORE_MAX_BYTES = int(os.getenv('XML_STORE_MAX_BYTES', '67108864'))
+XML_STORE_MAX_AGE = int(os.getenv('XML_STORE_MAX_AGE', '604800'))
+XML_STORE_EVICT_INTERVAL = int(os.getenv('XML_STORE_EVICT_INTERVAL', '60'))
+
+HASH_RE = re.compile(r'^[0-9a-f]{64}$')
+
+_last_evict = {'time': 0}
+
+
+def _dir(kind):
+    directory = os.path.join(XML_STORE_DIR or hostlock.path('xml'), kind)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+    return directory
+
+
+def _write(path, data):
+    """ Write data to path atomically. """
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.rename(tmp, path)
+
+
+def _safe_name(name):
+    return name.replace('/', '_')
+
+
+def digest(xml):
+    """ Return the hash of xml. """
+    if not isinstance(xml, bytes):
+        xml = xml.encode('utf-8')
+    return hashlib.sha256(xml).hexdigest()
+
+
+def put(name, xml):
+    """ Store the xml of domain name, return its hash. """
+    data = xml if isinstance(xml, bytes) else xml.encode('utf-8')
+    xml_hash = digest(data)
+    try:
+        path = os.path.join(_dir('objects'), xml_hash + '.xml')
+        try:
+            # Deduplicated, mark it as recently used
+            os.utime(path, None)
+        except OSError:
+            # New or evicted meanwhile
+            _write(path, data)
+        _write(os.path.join(_dir('names'), _safe_name(name)),
+               xml_hash.encode('ascii'))
+        if time.time() - _last_evict['time'] > XML_STORE_EVICT_INTERVAL:
+            evict()
+    except (IOError, OSError) as e:
+        # The store only helps debugging, never fail the create
+        logging.warning("Unable to store domain xml of %s: %s", name, e)
+    return xml_hash
+
+
+def lookup(name):
+    """ Return the hash of the last xml of domain name or None. """
+    try:
+        with open(os.path.join(_dir('names'), _safe_name(name))) as f:
+            return f.read().strip() or None
+    except (IOError, OSError):
+        return None
+
+
+def get(key):
+    """ Return the xml of hash or domain name key. """
+    xml_hash = key if HASH_RE.match(key) else lookup(key)
+    if xml_hash is not None:
+        try:
+            with open(os.path.join(_dir('objects'),
+                                   xml_hash + '.xml'), 'rb') as f:
+                return f.read().decode('utf-8')
+        except (IOError, OSError):
+            pass
+    raise Exception("No stored domain xml for %s" % key)
+
+
+def _entries(kind):
+    directory = _dir(kind)
+    entries = []
+    for filename in os.listdir(directory):
+        path = os.path.join(directory, filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue  # Removed meanwhile
+        entries.append((stat.st_mtime, stat.st_size, path))
+    return entries
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def _stored(name_path):
+    """ Return whether the xml of the name file still exists. """
+    try:
+        with open(name_path) as f:
+            xml_hash = f.read().strip()
+    except (IOError, OSError):
+        return True  # Removed or replaced meanwhile
+    return os.path.exists(os.path.join(_dir('objects'), xml_hash + '.xml'))
+
+
+def evict(now=None):
+    """ Drop the expired and the least recently stored xmls.
+
+    Return the number of xml files removed.
+
+    """
+    now = now or time.time()
+    _last_evict['time'] = now
+    removed = 0
+    objects = sorted(_entries('objects'))
+    total = sum(size for mtime, size, path in objects)
+    for mtime, size, path in objects:
+        if path.endswith('.tmp') and now - mtime < XML_STORE_EVICT_INTERVAL:
+            continue  # Being written
+        if now - mtime <= XML_STORE_MAX_AGE and total <= XML_STORE_MAX_BYTES:
+            break
+        if _mtime(path) != mtime:
+            continue  # Stored again meanwhile
+        _remove(path)
+        total -= size
+        removed += 1
+    for mtime, size, path in _entries('names'):
+        if path.endswith('.tmp'):
+            if now - mtime >= XML_STORE_EVICT_INTERVAL:
+                _remove(path)
+            continue
+        if now - mtime > XML_STORE_MAX_AGE or not _stored(path):
+            _remove(path)
+    if removed:
+        logging.info("Evicted %d domain xmls from the store", removed)
+    return removed
+
+
+def info():
+    """ Return the object count and bytes of the store. """
+    objects = _entries('objects')
+    return {'objects': len(objects),
+            'bytes': sum(size for mtime, size, path in objects),
+            'names': len(_entries('names')),
+            'max_bytes': XML_STORE_MAX_BYTES,
+            'max_age': XML_STORE_MAX_AGE}